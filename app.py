@@ -1,4 +1,4 @@
-from flask import Flask, send_from_directory, render_template, request, jsonify
+from flask import Flask, Response, send_from_directory, render_template, request, jsonify, stream_with_context
 import requests
 import os
 
@@ -6,6 +6,26 @@ app = Flask(__name__, static_folder="static", template_folder="templates")
 
 # FastAPI backend URL
 FASTAPI_URL = "http://localhost:8000"  # Change this if FastAPI is hosted elsewhere
+# Lets the backend trust X-Client-Id when this proxy does not connect from
+# one of its TRUSTED_PROXY_ADDRESSES.
+PROXY_SHARED_SECRET = os.getenv("PROXY_SHARED_SECRET")
+
+
+def backend_headers():
+    # The backend rate-limits per client, so it needs the browser's address
+    # rather than this proxy's.
+    headers = {"Content-Type": "application/json", "X-Client-Id": request.remote_addr}
+    if PROXY_SHARED_SECRET:
+        headers["X-Proxy-Secret"] = PROXY_SHARED_SECRET
+    priority = request.headers.get("X-Request-Priority")
+    if priority:
+        headers["X-Request-Priority"] = priority
+    return headers
+
+
+def passthrough_headers(response):
+    retry_after = response.headers.get("Retry-After")
+    return {"Retry-After": retry_after} if retry_after else {}
 
 @app.route("/")
 def serve_index():
@@ -18,21 +38,42 @@ def static_proxy(path):
 @app.route("/chat", methods=['GET', 'POST', 'PUT', 'DELETE', 'PATCH'])
 def chat_proxy():
     user_query = request.json.get("query")
+    session_id = request.json.get("session_id")
     try:
         response = requests.post(
             f"{FASTAPI_URL}/chat",
-            json={"query": user_query},
-            headers={"Content-Type": "application/json"},
+            json={"query": user_query, "session_id": session_id},
+            headers=backend_headers(),
+        )
+        return jsonify(response.json()), response.status_code, passthrough_headers(response)
+    except requests.exceptions.RequestException as e:
+        return jsonify({"error": "Failed to reach backend", "details": str(e)}), 500
+
+@app.route("/chat/stream", methods=["POST"])
+def chat_stream_proxy():
+    user_query = request.json.get("query")
+    session_id = request.json.get("session_id")
+    try:
+        response = requests.post(
+            f"{FASTAPI_URL}/chat/stream",
+            json={"query": user_query, "session_id": session_id},
+            headers=backend_headers(),
+            stream=True,
         )
-        return jsonify(response.json()), response.status_code
     except requests.exceptions.RequestException as e:
         return jsonify({"error": "Failed to reach backend", "details": str(e)}), 500
+    return Response(
+        stream_with_context(response.iter_content(chunk_size=None)),
+        status=response.status_code,
+        content_type=response.headers.get("Content-Type"),
+        headers=passthrough_headers(response),
+    )
 
 @app.route("/ingest", methods=["POST"])
 def ingest_proxy():
     try:
-        response = requests.post(f"{FASTAPI_URL}/ingest")
-        return jsonify(response.json()), response.status_code
+        response = requests.post(f"{FASTAPI_URL}/ingest", headers=backend_headers())
+        return jsonify(response.json()), response.status_code, passthrough_headers(response)
     except requests.exceptions.RequestException as e:
         return jsonify({"error": "Failed to reach backend", "details": str(e)}), 500
 
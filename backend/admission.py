@@ -0,0 +1,288 @@
+import asyncio
+import heapq
+import itertools
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+# Per-client token bucket: sustained requests per second and burst size.
+CLIENT_RATE_PER_SECOND = float(os.getenv("ADMISSION_CLIENT_RATE", "0.5"))
+CLIENT_BURST = float(os.getenv("ADMISSION_CLIENT_BURST", "5"))
+MAX_TRACKED_CLIENTS = 10000
+# /ingest only starts a background run, so it gets a much lower rate.
+INGEST_RATE_PER_SECOND = float(os.getenv("ADMISSION_INGEST_RATE", str(1 / 60)))
+INGEST_BURST = float(os.getenv("ADMISSION_INGEST_BURST", "2"))
+# Requests served at once; batch requests may take at most MAX_BATCH_CONCURRENT
+# of those slots so that interactive users always find one.
+MAX_CONCURRENT = int(os.getenv("ADMISSION_MAX_CONCURRENT", "8"))
+MAX_BATCH_CONCURRENT = int(os.getenv("ADMISSION_MAX_BATCH_CONCURRENT", "4"))
+MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "32"))
+QUEUE_TIMEOUT_SECONDS = float(os.getenv("ADMISSION_QUEUE_TIMEOUT_SECONDS", "30"))
+READINESS_REFRESH_SECONDS = float(os.getenv("INDEX_READINESS_REFRESH_SECONDS", "30"))
+# A client ID forwarded in X-Client-Id is only trusted from the Flask proxy:
+# a request from one of these addresses, or one carrying PROXY_SHARED_SECRET.
+TRUSTED_PROXY_ADDRESSES = {
+    address.strip()
+    for address in os.getenv("TRUSTED_PROXY_ADDRESSES", "127.0.0.1,::1").split(",")
+    if address.strip()
+}
+PROXY_SHARED_SECRET = os.getenv("PROXY_SHARED_SECRET")
+
+INTERACTIVE = "interactive"
+BATCH = "batch"
+_PRIORITY_ORDER = {INTERACTIVE: 0, BATCH: 1}
+
+
+class AdmissionRejected(Exception):
+    """
+    Raised when a request is not admitted. status_code is 429 for a client
+    over its rate limit and 503 when the server sheds load.
+    """
+
+    def __init__(self, status_code: int, reason: str, retry_after: float):
+        super().__init__(
+            f"Request rejected ({reason}). Retry after {retry_after:.0f} seconds."
+        )
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = max(1.0, retry_after)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+
+    def take(self) -> float:
+        """Takes a token. Returns 0 on success, else seconds until one is available."""
+        now = time.monotonic()
+        refill = (now - self.updated_at) * self.rate
+        self.tokens = min(self.burst, self.tokens + refill)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate if self.rate > 0 else 60.0
+
+
+def client_id(peer_address, forwarded_id=None, proxy_secret=None) -> str:
+    """
+    The ID a client is rate-limited under: the forwarded ID when the request
+    comes from the proxy, else the address it was received from.
+    """
+    if forwarded_id:
+        if peer_address in TRUSTED_PROXY_ADDRESSES:
+            return forwarded_id
+        if (
+            PROXY_SHARED_SECRET
+            and proxy_secret
+            and secrets.compare_digest(proxy_secret, PROXY_SHARED_SECRET)
+        ):
+            return forwarded_id
+    return peer_address or "unknown"
+
+
+class RateLimiter:
+    """Token buckets per client, forgetting the least recently seen clients."""
+
+    def __init__(
+        self, rate: float = CLIENT_RATE_PER_SECOND, burst: float = CLIENT_BURST
+    ):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def check(self, client_id: str):
+        with self._lock:
+            bucket = self._buckets.get(client_id)
+            if bucket is None:
+                bucket = self._buckets[client_id] = TokenBucket(self.rate, self.burst)
+                while len(self._buckets) > MAX_TRACKED_CLIENTS:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(client_id)
+            wait = bucket.take()
+        if wait:
+            raise AdmissionRejected(429, "rate_limited", wait)
+
+
+class AdmissionController:
+    """
+    Bounds the number of requests served at once.
+
+    Requests beyond MAX_CONCURRENT wait in a bounded priority queue where
+    interactive requests go ahead of batch ones. When the queue is full, an
+    interactive request displaces the newest queued batch request; otherwise
+    the new request is shed. Rejections carry a Retry-After estimate based
+    on recent service times.
+
+    Must be used from a single event loop.
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int = MAX_CONCURRENT,
+        max_batch_concurrent: int = MAX_BATCH_CONCURRENT,
+        max_queue: int = MAX_QUEUE,
+        queue_timeout: float = QUEUE_TIMEOUT_SECONDS,
+    ):
+        self.max_concurrent = max_concurrent
+        self.max_batch_concurrent = max_batch_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = {INTERACTIVE: 0, BATCH: 0}
+        self._queue = []
+        self._sequence = itertools.count()
+        self._mean_service_seconds = 5.0
+        self.stats = {"admitted": 0, "queued": 0, "shed": 0, "queue_timeouts": 0}
+
+    def retry_after(self) -> float:
+        slots = max(1, self.max_concurrent)
+        return self._mean_service_seconds * (1 + len(self._queue) / slots)
+
+    def _can_start(self, priority: str) -> bool:
+        if sum(self.active.values()) >= self.max_concurrent:
+            return False
+        return priority != BATCH or self.active[BATCH] < self.max_batch_concurrent
+
+    async def acquire(self, priority: str = INTERACTIVE):
+        """
+        Waits for a slot and returns a ticket to pass to release(). Raises
+        AdmissionRejected if the request is shed.
+        """
+        if priority not in _PRIORITY_ORDER:
+            raise ValueError(f"Unknown priority class '{priority}'.")
+        rank = _PRIORITY_ORDER[priority]
+        queued_ahead = any(e[0] <= rank and not e[3].done() for e in self._queue)
+        if not queued_ahead and self._can_start(priority):
+            return self._start(priority)
+
+        if len(self._queue) >= self.max_queue and not self._displace_batch(priority):
+            self.stats["shed"] += 1
+            raise AdmissionRejected(503, "overloaded", self.retry_after())
+
+        waiter = asyncio.get_running_loop().create_future()
+        entry = (rank, next(self._sequence), priority, waiter)
+        heapq.heappush(self._queue, entry)
+        self.stats["queued"] += 1
+        try:
+            done, _ = await asyncio.wait({waiter}, timeout=self.queue_timeout)
+        except asyncio.CancelledError:
+            self._abandon(entry)
+            raise
+        if not done:
+            self._abandon(entry)
+            self.stats["queue_timeouts"] += 1
+            self.stats["shed"] += 1
+            raise AdmissionRejected(503, "queue_timeout", self.retry_after())
+        return waiter.result()
+
+    def release(self, ticket):
+        priority, started_at = ticket
+        self.active[priority] -= 1
+        elapsed = time.monotonic() - started_at
+        self._mean_service_seconds += 0.1 * (elapsed - self._mean_service_seconds)
+        self._dispatch()
+
+    def _start(self, priority):
+        self.active[priority] += 1
+        self.stats["admitted"] += 1
+        return (priority, time.monotonic())
+
+    def _dispatch(self):
+        while self._queue:
+            _, _, priority, waiter = self._queue[0]
+            if waiter.done():
+                heapq.heappop(self._queue)
+                continue
+            if not self._can_start(priority):
+                # A batch request at the head may only be blocked by the batch
+                # limit; let a queued interactive request through instead.
+                interactive = self._first_waiting(INTERACTIVE)
+                if interactive is None or not self._can_start(INTERACTIVE):
+                    return
+                self._remove(interactive)
+                interactive[3].set_result(self._start(INTERACTIVE))
+                continue
+            heapq.heappop(self._queue)
+            waiter.set_result(self._start(priority))
+
+    def _first_waiting(self, priority):
+        candidates = [e for e in self._queue if e[2] == priority and not e[3].done()]
+        return min(candidates) if candidates else None
+
+    def _displace_batch(self, priority) -> bool:
+        if priority != INTERACTIVE:
+            return False
+        batch = [e for e in self._queue if e[2] == BATCH and not e[3].done()]
+        if not batch:
+            return False
+        newest = max(batch, key=lambda e: e[1])
+        self._remove(newest)
+        self.stats["shed"] += 1
+        newest[3].set_exception(
+            AdmissionRejected(503, "displaced", self.retry_after())
+        )
+        return True
+
+    def _abandon(self, entry):
+        """Gives up a queue entry, handing back a slot granted in the meantime."""
+        waiter = entry[3]
+        if waiter.done():
+            if not waiter.cancelled() and waiter.exception() is None:
+                self.release(waiter.result())
+            return
+        waiter.cancel()
+        self._remove(entry)
+
+    def _remove(self, entry):
+        try:
+            self._queue.remove(entry)
+        except ValueError:
+            return
+        heapq.heapify(self._queue)
+
+    def metrics(self):
+        return {
+            **self.stats,
+            "active_interactive": self.active[INTERACTIVE],
+            "active_batch": self.active[BATCH],
+            "queue_length": len(self._queue),
+            "mean_service_seconds": round(self._mean_service_seconds, 3),
+        }
+
+
+class CachedReadiness:
+    """
+    Caches the result of a blocking readiness check so request handlers do not
+    run it. The value is refreshed in the background every refresh_seconds and
+    can be refreshed explicitly, e.g. after an ingestion run.
+    """
+
+    def __init__(self, check, refresh_seconds: float = READINESS_REFRESH_SECONDS):
+        self.check = check
+        self.refresh_seconds = refresh_seconds
+        self.ready = False
+        self.error = None
+        self.checked_at = None
+
+    def refresh(self) -> bool:
+        try:
+            self.ready = bool(self.check())
+            self.error = None
+        except Exception as e:
+            print(f"Readiness check failed: {e}")
+            self.ready = False
+            self.error = str(e)
+        self.checked_at = time.time()
+        return self.ready
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.refresh_seconds)
+            await asyncio.to_thread(self.refresh)
@@ -0,0 +1,27 @@
+#!/bin/bash
+
+# Performance benchmarks together with the offline evaluation, so that a
+# speedup is only accepted when retrieval recall holds up. Exits non-zero
+# when recall on the fixture corpus or, once it is set up, on the gold set
+# falls too low (see evaluation.py).
+set -e
+
+echo "Search on the labelled fixture corpus..."
+python evaluation.py fixture
+
+echo "Chunking benchmark..."
+python bench_chunking.py --text-store text_store --limit 200
+
+# The gold-set runs need labelled questions in eval/gold_set.json, recorded
+# LLM responses and a baseline: label questions, then run
+#   python evaluation.py record && python evaluation.py run --save-baseline
+if [ ! -f eval/llm_fixtures.json ] || [ ! -f eval/baseline.json ]; then
+    echo "No eval/llm_fixtures.json or eval/baseline.json yet, skipping the gold set."
+    exit 0
+fi
+
+echo "Flat chunk search..."
+python evaluation.py --offline retrieval --shortlist 0
+
+echo "Current retrieval configuration, answers replayed from fixtures..."
+python evaluation.py --offline run
@@ -0,0 +1,176 @@
+"""
+Compares the character-based RecursiveCharacterTextSplitter with the
+structure-aware ScientificTextSplitter on a folder of PDFs.
+
+Reports index size, embedding calls and a retrieval hit-rate@k. Retrieval is
+scored offline with BM25 so no embedding API calls are needed; a query is a hit
+when one of the top-k chunks comes from the query's source file. Queries are
+read from --queries (a JSON list of {"query", "source_file"}) or generated
+from sentences on the first page of each PDF.
+
+    python bench_chunking.py --pdf-dir pdf_documents --limit 50
+    python bench_chunking.py --text-store text_store --limit 500
+"""
+
+import argparse
+import json
+import math
+import random
+import re
+import time
+from collections import Counter, defaultdict
+from pathlib import Path
+
+from chunking import ScientificTextSplitter, estimate_tokens
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_community.document_loaders import PyPDFLoader
+from text_store import TextStore
+
+_WORD_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def load_pages(pdf_file):
+    return list(PyPDFLoader(str(pdf_file)).lazy_load())
+
+
+def split_recursive(pages):
+    splitter = RecursiveCharacterTextSplitter(
+        chunk_size=1000, chunk_overlap=200, length_function=len
+    )
+    return splitter.split_documents(pages)
+
+
+def split_scientific(pages):
+    return ScientificTextSplitter().split_documents(pages)
+
+
+class BM25Index:
+    def __init__(self, texts, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = defaultdict(list)
+        self.lengths = []
+        for i, text in enumerate(texts):
+            terms = Counter(_WORD_PATTERN.findall(text.lower()))
+            self.lengths.append(sum(terms.values()))
+            for term, tf in terms.items():
+                self.postings[term].append((i, tf))
+        self.avg_length = sum(self.lengths) / max(1, len(self.lengths))
+
+    def search(self, query, k):
+        n = len(self.lengths)
+        scores = defaultdict(float)
+        for term in set(_WORD_PATTERN.findall(query.lower())):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for i, tf in postings:
+                length_ratio = self.lengths[i] / self.avg_length
+                norm = self.k1 * (1 - self.b + self.b * length_ratio)
+                scores[i] += idf * tf * (self.k1 + 1) / (tf + norm)
+        return sorted(scores, key=scores.get, reverse=True)[:k]
+
+
+def generate_queries(pages_by_file, per_file, rng):
+    queries = []
+    for source_file, pages in pages_by_file.items():
+        if not pages:
+            continue
+        first_page = " ".join(pages[0].page_content.split())
+        sentences = [
+            s
+            for s in re.split(r"(?<=[.!?])\s+", first_page)
+            if 12 <= len(s.split()) <= 40
+        ]
+        for sentence in rng.sample(sentences, min(per_file, len(sentences))):
+            # Half of the words in shuffled order, so a hit needs more than an
+            # exact phrase match.
+            words = sentence.split()
+            query = " ".join(rng.sample(words, len(words) // 2))
+            queries.append({"query": query, "source_file": source_file})
+    return queries
+
+
+def run_benchmark(name, split_fn, pages_by_file, queries, batch_size, k):
+    start = time.perf_counter()
+    chunks = []
+    embedding_calls = 0
+    for pages in pages_by_file.values():
+        doc_chunks = split_fn(pages)
+        embedding_calls += math.ceil(len(doc_chunks) / batch_size)
+        chunks.extend(doc_chunks)
+    split_seconds = time.perf_counter() - start
+
+    texts = [c.page_content for c in chunks]
+    index = BM25Index(texts)
+    hits = 0
+    for q in queries:
+        top = index.search(q["query"], k)
+        if any(chunks[i].metadata.get("source_file") == q["source_file"] for i in top):
+            hits += 1
+
+    total_tokens = sum(estimate_tokens(t) for t in texts)
+    return {
+        "splitter": name,
+        "chunks": len(chunks),
+        "stored_chars": sum(len(t) for t in texts),
+        "estimated_tokens": total_tokens,
+        "mean_tokens_per_chunk": round(total_tokens / max(1, len(chunks)), 1),
+        "embedding_calls": embedding_calls,
+        "split_seconds": round(split_seconds, 2),
+        f"hit_rate@{k}": round(hits / max(1, len(queries)), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--pdf-dir", default="pdf_documents")
+    parser.add_argument(
+        "--text-store", help="Read page text from this text store instead of PDFs"
+    )
+    parser.add_argument("--limit", type=int, default=50)
+    parser.add_argument("--queries", help="JSON file of {query, source_file}")
+    parser.add_argument("--queries-per-file", type=int, default=2)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("-k", type=int, default=10)
+    args = parser.parse_args()
+
+    pages_by_file = {}
+    if args.text_store:
+        store = TextStore(Path(args.text_store))
+        rows = sorted(store.documents.values(), key=lambda r: r["source_file"])
+        for row in rows[: args.limit]:
+            pages_by_file[row["source_file"]] = list(
+                store.iter_pages(
+                    row["content_hash"], {"source_file": row["source_file"]}
+                )
+            )
+    else:
+        pdf_files = sorted(Path(args.pdf_dir).glob("*.pdf"))[: args.limit]
+        for pdf_file in pdf_files:
+            pages = load_pages(pdf_file)
+            for page in pages:
+                page.metadata["source_file"] = pdf_file.name
+            pages_by_file[pdf_file.name] = pages
+
+    if args.queries:
+        queries = json.loads(Path(args.queries).read_text())
+    else:
+        queries = generate_queries(
+            pages_by_file, args.queries_per_file, random.Random(645)
+        )
+
+    print(f"{len(pages_by_file)} PDFs, {len(queries)} queries")
+    for name, split_fn in (
+        ("recursive", split_recursive),
+        ("scientific", split_scientific),
+    ):
+        result = run_benchmark(
+            name, split_fn, pages_by_file, queries, args.batch_size, args.k
+        )
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,338 @@
+import math
+import os
+import re
+
+from langchain_core.documents import Document
+
+CHUNK_TOKENS = int(os.getenv("CHUNK_TOKENS", "350"))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "40"))
+# "drop" discards the references section, "separate" emits it as chunks with
+# content_type "references" so ingestion can store them in their own collection.
+REFERENCES_MODE = os.getenv("CHUNK_REFERENCES_MODE", "drop").lower()
+
+_TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+_SENTENCE_END_PATTERN = re.compile(r"(?<=[.!?])\s+(?=[A-Z(\[])")
+
+_SECTION_NAMES = (
+    "abstract",
+    "introduction",
+    "background",
+    "results",
+    "discussion",
+    "results and discussion",
+    "methods",
+    "online methods",
+    "materials and methods",
+    "experimental",
+    "experimental section",
+    "experimental methods",
+    "conclusion",
+    "conclusions",
+    "summary",
+    "outlook",
+    "acknowledgements",
+    "acknowledgments",
+    "author contributions",
+    "competing interests",
+    "data availability",
+    "code availability",
+    "additional information",
+    "supplementary information",
+)
+_REFERENCE_SECTION_NAMES = (
+    "references",
+    "reference list",
+    "references and notes",
+    "bibliography",
+    "literature cited",
+)
+_NUMBERING = r"(?:(?:\d+(?:\.\d+)*|[IVX]+)\.?\s+)?"
+_SECTION_HEADING_PATTERN = re.compile(
+    rf"^{_NUMBERING}({'|'.join(_SECTION_NAMES)})\s*:?$", re.IGNORECASE
+)
+_REFERENCE_HEADING_PATTERN = re.compile(
+    rf"^{_NUMBERING}({'|'.join(_REFERENCE_SECTION_NAMES)})\s*:?$", re.IGNORECASE
+)
+# Numbered headings such as "2.1 Sample preparation". The title has to start
+# with a capitalised word or an acronym, so quantities at the start of a
+# wrapped line ("300 K and the films...", "5 GPa was reached") do not match.
+_NUMBERED_HEADING_PATTERN = re.compile(
+    r"^(?:\d{1,2}(?:\.\d{1,2})*\.?|[IVX]+\.)\s+"
+    r"(?:[A-Z][a-z]+|[A-Z]{2,})\b[^.!?;:=]{0,60}$"
+)
+_MAX_HEADING_WORDS = 8
+# A line ending in one of these is a sentence wrapped onto the next line.
+_CONTINUATION_WORDS = frozenset(
+    "a an and are as at by for from in is of on or the to was were with".split()
+)
+_CAPTION_PATTERN = re.compile(
+    r"^(?:Extended Data\s+)?(?:Fig\.|Figure|Table|Supplementary Fig\.)\s*\d+[a-z]?\s*[|:.]",
+    re.IGNORECASE,
+)
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Approximates subword token counts without a tokenizer: every punctuation
+    mark is one token and words cost one token per four characters.
+    """
+    return sum(
+        math.ceil(len(piece) / 4) if piece[0].isalnum() or piece[0] == "_" else 1
+        for piece in _TOKEN_PATTERN.findall(text)
+    )
+
+
+def _is_dense_line(line: str) -> bool:
+    """Equation and table rows: short lines dominated by digits and symbols."""
+    if len(line) > 120:
+        return False
+    letters = sum(ch.isalpha() for ch in line)
+    return letters < 0.5 * len(line.replace(" ", ""))
+
+
+def _is_numbered_heading(line: str) -> bool:
+    if not _NUMBERED_HEADING_PATTERN.match(line):
+        return False
+    words = line.split()[1:]
+    return (
+        len(words) <= _MAX_HEADING_WORDS
+        and words[-1].lower() not in _CONTINUATION_WORDS
+    )
+
+
+def classify_line(line: str, after_blank: bool = True) -> str:
+    """
+    Numbered headings are only recognised at the start of a paragraph
+    (after_blank), since a wrapped body line can look like one.
+    """
+    if _REFERENCE_HEADING_PATTERN.match(line):
+        return "references_heading"
+    if len(line) <= 90 and (
+        _SECTION_HEADING_PATTERN.match(line)
+        or (after_blank and _is_numbered_heading(line))
+    ):
+        return "heading"
+    if _CAPTION_PATTERN.match(line):
+        return "caption"
+    if _is_dense_line(line):
+        return "dense"
+    return "text"
+
+
+class ScientificTextSplitter:
+    """
+    Token-sized, structure-aware splitter for scientific papers.
+
+    Pages are consumed as a stream. Section headings start a new chunk (whose
+    first line is the heading) and are carried as the "section" metadata of the
+    chunks that follow, figure and table captions become chunks of their own,
+    runs of equation/table lines are kept together, and the references section
+    is dropped or emitted separately depending on references_mode. Captions
+    are kept wherever they appear, including after the reference list.
+    """
+
+    def __init__(
+        self,
+        chunk_tokens=CHUNK_TOKENS,
+        overlap_tokens=CHUNK_OVERLAP_TOKENS,
+        references_mode=REFERENCES_MODE,
+    ):
+        self.chunk_tokens = chunk_tokens
+        self.overlap_tokens = overlap_tokens
+        self.references_mode = references_mode
+
+    def split_pages(self, pages):
+        state = _SplitState()
+        for page_doc in pages:
+            state.base_metadata = dict(page_doc.metadata)
+            for kind, text in self._iter_units(page_doc.page_content):
+                yield from self._consume_unit(state, kind, text)
+        yield from self._flush(state)
+
+    def split_documents(self, documents):
+        return list(self.split_pages(documents))
+
+    def _iter_units(self, page_text):
+        """Groups the lines of a page into (kind, text) units."""
+        paragraph = []
+        dense = []
+        after_blank = True
+
+        def flush_paragraph():
+            if paragraph:
+                yield "text", " ".join(paragraph)
+                paragraph.clear()
+            if dense:
+                yield "dense", "\n".join(dense)
+                dense.clear()
+
+        for raw_line in page_text.splitlines():
+            line = raw_line.strip()
+            if not line:
+                yield from flush_paragraph()
+                after_blank = True
+                continue
+            kind = classify_line(line, after_blank)
+            after_blank = False
+            if kind in ("heading", "references_heading", "caption"):
+                yield from flush_paragraph()
+                yield kind, line
+            elif kind == "dense":
+                if paragraph:
+                    yield "text", " ".join(paragraph)
+                    paragraph.clear()
+                dense.append(line)
+            else:
+                if dense:
+                    yield "dense", "\n".join(dense)
+                    dense.clear()
+                # Re-join words hyphenated across line breaks.
+                if paragraph and paragraph[-1].endswith("-"):
+                    paragraph[-1] = paragraph[-1][:-1] + line
+                else:
+                    paragraph.append(line)
+        yield from flush_paragraph()
+
+    def _consume_unit(self, state, kind, text):
+        if kind == "references_heading":
+            yield from self._flush(state)
+            state.section = text
+            state.in_references = True
+            if self.references_mode != "drop":
+                state.append(text, estimate_tokens(text))
+            return
+        if kind == "heading":
+            yield from self._flush(state)
+            state.section = text
+            state.in_references = False
+            state.append(text, estimate_tokens(text))
+            return
+        # Captions are kept even inside the references section, where figures
+        # placed at the end of a paper often follow the reference list.
+        if kind == "caption":
+            # Captions run until the next blank line or structural line, so the
+            # following text unit is usually the rest of the caption.
+            yield from self._flush(state)
+            state.in_caption = True
+            state.append(text, estimate_tokens(text))
+            return
+        if state.in_caption and kind == "text":
+            # Without blank lines in the extracted text the caption cannot be
+            # delimited reliably, so it is capped at one chunk and the rest of
+            # the paragraph is treated as body text.
+            sentences = _split_sentences(text)
+            while sentences:
+                sentence_tokens = estimate_tokens(sentences[0])
+                if state.tokens + sentence_tokens > self.chunk_tokens:
+                    break
+                state.append(sentences.pop(0), sentence_tokens)
+            yield from self._flush(state)
+            if sentences:
+                yield from self._consume_unit(state, "text", " ".join(sentences))
+            return
+        if state.in_caption:
+            yield from self._flush(state)
+        if state.in_references and self.references_mode == "drop":
+            return
+
+        if kind == "dense":
+            tokens = estimate_tokens(text)
+            if state.tokens + tokens > self.chunk_tokens:
+                yield from self._flush(state, keep_overlap=True)
+            # Equation and table blocks are never split, even if oversized.
+            state.append(text, tokens)
+            return
+        yield from self._append_text(state, text)
+
+    def _append_text(self, state, text):
+        tokens = estimate_tokens(text)
+        if state.tokens + tokens <= self.chunk_tokens:
+            state.append(text, tokens)
+            return
+        for sentence in _split_sentences(text):
+            sentence_tokens = estimate_tokens(sentence)
+            if state.tokens and state.tokens + sentence_tokens > self.chunk_tokens:
+                yield from self._flush(state, keep_overlap=True)
+            if sentence_tokens > self.chunk_tokens:
+                for piece in _split_words(sentence, self.chunk_tokens):
+                    state.append(piece, estimate_tokens(piece))
+                    yield from self._flush(state)
+                continue
+            state.append(sentence, sentence_tokens)
+
+    def _flush(self, state, keep_overlap=False):
+        if state.has_content:
+            if state.in_caption:
+                content_type = "caption"
+            elif state.in_references:
+                content_type = "references"
+            else:
+                content_type = "body"
+            metadata = {
+                **state.start_metadata,
+                "section": state.section,
+                "content_type": content_type,
+                "token_count": state.tokens,
+            }
+            yield Document(page_content="\n".join(state.parts), metadata=metadata)
+        overlap = []
+        if keep_overlap and not state.in_caption and self.overlap_tokens > 0:
+            overlap = _tail_sentences(state.parts, self.overlap_tokens)
+        state.reset(overlap)
+
+
+class _SplitState:
+    def __init__(self):
+        self.section = "Front matter"
+        self.in_references = False
+        self.base_metadata = {}
+        self.reset()
+
+    def reset(self, overlap=()):
+        self.in_caption = False
+        self.has_content = False
+        self.parts = list(overlap)
+        self.tokens = sum(estimate_tokens(part) for part in self.parts)
+        self.start_metadata = dict(self.base_metadata)
+
+    def append(self, text, tokens):
+        if not self.parts:
+            self.start_metadata = dict(self.base_metadata)
+        self.has_content = True
+        self.parts.append(text)
+        self.tokens += tokens
+
+
+def _split_sentences(text):
+    return [s for s in _SENTENCE_END_PATTERN.split(text) if s]
+
+
+def _split_words(text, max_tokens):
+    words = text.split()
+    piece = []
+    piece_tokens = 0
+    for word in words:
+        word_tokens = estimate_tokens(word)
+        if piece and piece_tokens + word_tokens > max_tokens:
+            yield " ".join(piece)
+            piece = []
+            piece_tokens = 0
+        piece.append(word)
+        piece_tokens += word_tokens
+    if piece:
+        yield " ".join(piece)
+
+
+def _tail_sentences(parts, max_tokens):
+    """Trailing sentences of the current chunk that fit into max_tokens."""
+    if not parts:
+        return []
+    tail = []
+    tokens = 0
+    for sentence in reversed(_split_sentences(parts[-1])):
+        sentence_tokens = estimate_tokens(sentence)
+        if tokens + sentence_tokens > max_tokens:
+            break
+        tail.insert(0, sentence)
+        tokens += sentence_tokens
+    return [" ".join(tail)] if tail else []
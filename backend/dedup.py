@@ -0,0 +1,214 @@
+import json
+import os
+import re
+import zlib
+from pathlib import Path
+
+import fitz
+import numpy as np
+
+NUM_PERMUTATIONS = 128
+# 32 bands of 4 rows: pairs with Jaccard similarity above roughly 0.45 become
+# LSH candidates, and candidates are then confirmed against SIMILARITY_THRESHOLD.
+NUM_BANDS = 32
+ROWS_PER_BAND = NUM_PERMUTATIONS // NUM_BANDS
+SHINGLE_SIZE = 5
+SIMILARITY_THRESHOLD = float(os.getenv("DEDUP_SIMILARITY_THRESHOLD", "0.8"))
+
+# a * x + b stays below 2**64 for 32-bit shingle hashes and 31-bit coefficients,
+# so the permutations can be evaluated in uint64 without overflow.
+_PRIME = np.uint64(4294967311)
+_rng = np.random.default_rng(seed=645)
+_PERM_A = _rng.integers(1, 1 << 31, size=NUM_PERMUTATIONS, dtype=np.uint64)
+_PERM_B = _rng.integers(0, 1 << 31, size=NUM_PERMUTATIONS, dtype=np.uint64)
+
+_WORD_PATTERN = re.compile(r"[a-z0-9]+")
+
+UNKNOWN_DOI = "Unknown DOI"
+
+
+def _shingle_hashes(text: str) -> np.ndarray:
+    words = _WORD_PATTERN.findall(text.lower())
+    if len(words) < SHINGLE_SIZE:
+        return np.empty(0, dtype=np.uint64)
+    shingles = {
+        " ".join(words[i : i + SHINGLE_SIZE])
+        for i in range(len(words) - SHINGLE_SIZE + 1)
+    }
+    return np.fromiter(
+        (zlib.crc32(s.encode("utf-8")) for s in shingles),
+        dtype=np.uint64,
+        count=len(shingles),
+    )
+
+
+def update_signature(signature: np.ndarray, text: str) -> np.ndarray:
+    """Fold the shingles of text into an existing MinHash signature."""
+    hashes = _shingle_hashes(text)
+    if hashes.size == 0:
+        return signature
+    permuted = (np.outer(hashes, _PERM_A) + _PERM_B) % _PRIME
+    return np.minimum(signature, permuted.min(axis=0))
+
+
+def empty_signature() -> np.ndarray:
+    return np.full(NUM_PERMUTATIONS, np.iinfo(np.uint64).max, dtype=np.uint64)
+
+
+def compute_minhash_signature(pdf_path: Path):
+    """
+    Computes a MinHash signature over the extracted text of a PDF, one page at
+    a time. Returns None if the PDF has no usable text layer.
+    """
+    signature = empty_signature()
+    try:
+        with fitz.open(pdf_path) as doc:
+            for page in doc:
+                signature = update_signature(signature, page.get_text("text"))
+    except Exception as e:
+        print(f"Error computing MinHash signature for {pdf_path}: {e}")
+        return None
+    if np.all(signature == np.iinfo(np.uint64).max):
+        return None
+    return signature
+
+
+def estimate_similarity(sig_a: np.ndarray, sig_b: np.ndarray) -> float:
+    return float(np.mean(sig_a == sig_b))
+
+
+class NearDuplicateIndex:
+    """
+    MinHash/LSH index over already ingested documents, persisted as JSON.
+
+    Documents are keyed by source file name. Each entry keeps its DOI so that a
+    duplicate can be linked to the canonical document by DOI when available.
+    """
+
+    def __init__(self, index_path: Path):
+        self.index_path = index_path
+        self.documents = {}
+        self.signatures = {}
+        self.doi_to_source = {}
+        self.buckets = {}
+        self.load()
+
+    def load(self):
+        if not self.index_path.exists():
+            return
+        with open(self.index_path, "r") as f:
+            try:
+                data = json.load(f)
+            except json.JSONDecodeError:
+                return
+        for source_file, entry in data.items():
+            signature = entry.get("signature")
+            self._insert(
+                source_file,
+                {"doi": entry["doi"], "aliases": entry.get("aliases", [])},
+                None if signature is None else np.array(signature, dtype=np.uint64),
+            )
+
+    def save(self):
+        data = {
+            source_file: {
+                **entry,
+                "signature": (
+                    None
+                    if self.signatures[source_file] is None
+                    else self.signatures[source_file].tolist()
+                ),
+            }
+            for source_file, entry in self.documents.items()
+        }
+        with open(self.index_path, "w") as f:
+            json.dump(data, f)
+
+    def _band_keys(self, signature: np.ndarray):
+        for band in range(NUM_BANDS):
+            start = band * ROWS_PER_BAND
+            yield band, signature[start : start + ROWS_PER_BAND].tobytes()
+
+    def _insert(self, source_file, entry, signature):
+        self.documents[source_file] = entry
+        self.signatures[source_file] = signature
+        if entry["doi"] != UNKNOWN_DOI:
+            self.doi_to_source.setdefault(entry["doi"], source_file)
+        if signature is None:
+            return
+        for band_key in self._band_keys(signature):
+            self.buckets.setdefault(band_key, set()).add(source_file)
+
+    def add(self, core_metadata: dict, signature):
+        self._insert(
+            core_metadata["source_file"],
+            {"doi": core_metadata["doi"], "aliases": []},
+            signature,
+        )
+
+    def find_duplicate(self, core_metadata: dict, signature):
+        """
+        Returns (canonical_source_file, similarity) for the best matching
+        indexed document, or None if the PDF is not a near-duplicate.
+
+        A document with the same DOI is always a candidate, but it still has to
+        pass SIMILARITY_THRESHOLD: DOIs are often scraped from the first pages,
+        where a cited paper's DOI can be picked up instead of the document's.
+        """
+        if signature is None:
+            return None
+
+        candidates = set()
+        for band_key in self._band_keys(signature):
+            candidates.update(self.buckets.get(band_key, ()))
+        doi = core_metadata["doi"]
+        if doi != UNKNOWN_DOI and doi in self.doi_to_source:
+            candidates.add(self.doi_to_source[doi])
+        candidates.discard(core_metadata["source_file"])
+
+        best = None
+        for candidate in candidates:
+            if self.signatures[candidate] is None:
+                continue
+            similarity = estimate_similarity(signature, self.signatures[candidate])
+            if similarity >= SIMILARITY_THRESHOLD and (
+                best is None or similarity > best[1]
+            ):
+                best = (candidate, similarity)
+        return best
+
+    def link_duplicate(self, canonical_source_file, duplicate_source_file):
+        aliases = self.documents[canonical_source_file]["aliases"]
+        if duplicate_source_file not in aliases:
+            aliases.append(duplicate_source_file)
+
+    def canonical_doi(self, source_file: str) -> str:
+        return self.documents[source_file]["doi"]
+
+
+if __name__ == "__main__":
+    # Backfill the index from PDFs that were ingested before dedup existed.
+    from index_versions import ServingIndex, ingestion_lock
+    from utils import extract_metadata_from_pdf
+
+    pdf_directory = Path("pdf_documents")
+    root = Path("chroma_db")
+    # Written next to the served version, where ingestion reads it from.
+    with ingestion_lock(root):
+        serving = ServingIndex(root)
+        persist_directory = serving.current().base_directory
+        serving.close()
+        processed_log = persist_directory / "processed_files.json"
+
+        index = NearDuplicateIndex(persist_directory / "minhash_index.json")
+        processed = set()
+        if processed_log.exists():
+            processed = set(json.loads(processed_log.read_text()))
+        for pdf_file in sorted(pdf_directory.glob("*.pdf")):
+            if pdf_file.name not in processed or pdf_file.name in index.documents:
+                continue
+            core_metadata = extract_metadata_from_pdf(pdf_file)
+            index.add(core_metadata, compute_minhash_signature(pdf_file))
+            print(f"Indexed {pdf_file.name}")
+        index.save()
+    print(f"MinHash index now covers {len(index.documents)} documents.")
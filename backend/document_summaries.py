@@ -0,0 +1,148 @@
+"""
+Per-document summaries for two-stage retrieval.
+
+Ingestion embeds one short summary per PDF (its title followed by the
+abstract, or the first-page text when no abstract heading was found) into
+the documents collection of the index (see ShardedIndex.search_two_stage).
+The summary is assembled from the chunks as they stream past, so the PDF is
+not read again.
+
+Indexes built before summaries existed are backfilled at the start of the
+next ingestion run; until then queries search all chunks.
+
+    python document_summaries.py backfill   # summarise documents ingested earlier
+    python document_summaries.py stats
+"""
+
+import argparse
+import os
+import re
+
+SUMMARY_MAX_CHARS = int(os.getenv("DOC_SUMMARY_MAX_CHARS", "2000"))
+BACKFILL_BATCH_SIZE = 32
+
+_CHUNK_NUMBER_PATTERN = re.compile(r"_chunk(\d+)$")
+
+
+class SummaryCollector:
+    """Keeps the abstract and first-page text of the chunks passing through."""
+
+    def __init__(self, max_chars: int = SUMMARY_MAX_CHARS):
+        self.max_chars = max_chars
+        self.abstract = []
+        self.first_page = []
+
+    def collecting(self, chunks):
+        self.abstract = []
+        self.first_page = []
+        for chunk in chunks:
+            self.keep(chunk.page_content, chunk.metadata)
+            yield chunk
+
+    def keep(self, text: str, metadata: dict):
+        if metadata.get("content_type") == "references":
+            return
+        if "abstract" in (metadata.get("section") or "").lower():
+            _append_within(self.abstract, text, self.max_chars)
+        elif metadata.get("page") in (0, "0"):
+            _append_within(self.first_page, text, self.max_chars)
+
+    def summary(self, core_metadata: dict) -> str:
+        body = " ".join(self.abstract or self.first_page)
+        title = core_metadata.get("title")
+        if title and title != "Unknown Title":
+            body = f"{title}\n\n{body}"
+        return body[: self.max_chars].strip()
+
+
+def _append_within(parts, text, max_chars):
+    if sum(len(part) for part in parts) < max_chars:
+        parts.append(text)
+
+
+def _chunk_number(chunk_id: str) -> int:
+    match = _CHUNK_NUMBER_PATTERN.search(chunk_id)
+    return int(match.group(1)) if match else 0
+
+
+def backfill(target_index, embeddings, source_files=()):
+    """
+    Adds summaries for documents in the index that have none, built from
+    their stored first-page and abstract chunks. Covers the shard manifest
+    and source_files, which lists documents that may predate the manifest;
+    those found in a shard are added to it.
+    """
+    documents = target_index.documents_collection()
+    manifest = target_index.load_manifest()
+    missing = sorted(target_index.unsummarised_documents(source_files))
+    print(f"Summarising {len(missing)} document(s) without a summary...")
+
+    pending = []
+    listed = 0
+    for source_file in missing:
+        shard_key = manifest.get(source_file) or target_index.find_shard(source_file)
+        if shard_key is None:
+            continue
+        if source_file not in manifest:
+            manifest[source_file] = shard_key
+            listed += 1
+        result = target_index.collection(shard_key).get(
+            where={"source_file": {"$eq": source_file}},
+            include=["documents", "metadatas"],
+        )
+        if not result["ids"]:
+            target_index.record_missing_summary(source_file)
+            continue
+        collector = SummaryCollector()
+        chunks = sorted(
+            zip(result["ids"], result["documents"], result["metadatas"]),
+            key=lambda chunk: _chunk_number(chunk[0]),
+        )
+        for _, text, metadata in chunks:
+            collector.keep(text, metadata)
+        core_metadata = chunks[0][2]
+        summary = collector.summary(core_metadata)
+        if not summary:
+            target_index.record_missing_summary(source_file)
+            continue
+        pending.append((core_metadata, shard_key, summary))
+        if len(pending) >= BACKFILL_BATCH_SIZE:
+            _upsert_summaries(target_index, embeddings, pending)
+            pending = []
+    if pending:
+        _upsert_summaries(target_index, embeddings, pending)
+    if listed:
+        target_index.save_manifest(manifest)
+    print(f"Document summaries in index: {documents.count()}")
+
+
+def _upsert_summaries(target_index, embeddings, pending):
+    vectors = embeddings.embed_documents([summary for _, _, summary in pending])
+    for (core_metadata, shard_key, summary), vector in zip(pending, vectors):
+        target_index.upsert_document(core_metadata, shard_key, vector, summary)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-document summary index.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("backfill")
+    subparsers.add_parser("stats")
+    args = parser.parse_args()
+
+    # Imported here so that the collector can be used without credentials.
+    from ingestion import embeddings, index, unlisted_source_files
+
+    target_index = index.current()
+    if args.command == "backfill":
+        backfill(target_index, embeddings, unlisted_source_files(target_index))
+    elif args.command == "stats":
+        print(f"Document summaries: {target_index.documents_collection().count()}")
+        print(
+            "Documents without summary text: "
+            f"{len(target_index.load_documents_without_summary())}"
+        )
+        print(f"Documents in shard manifest: {len(target_index.load_manifest())}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+# "google" uses the Gemini embedding API; "local" runs an ONNX model on CPU.
+EMBEDDING_PROVIDER = os.getenv("EMBEDDING_PROVIDER", "google").lower()
+
+GOOGLE_EMBEDDING_MODEL_NAME = "models/text-embedding-004"
+
+# Directory with tokenizer.json and an ONNX export of a sentence embedding
+# model, e.g. `optimum-cli export onnx --model sentence-transformers/all-MiniLM-L6-v2`
+# followed by dynamic int8 quantization.
+LOCAL_EMBEDDING_MODEL_DIR = Path(
+    os.getenv("LOCAL_EMBEDDING_MODEL_DIR", "models/all-MiniLM-L6-v2")
+)
+LOCAL_EMBEDDING_ONNX_FILE = os.getenv(
+    "LOCAL_EMBEDDING_ONNX_FILE", "model_quantized.onnx"
+)
+LOCAL_EMBEDDING_MAX_LENGTH = int(os.getenv("LOCAL_EMBEDDING_MAX_LENGTH", "512"))
+LOCAL_EMBEDDING_BATCH_SIZE = int(os.getenv("LOCAL_EMBEDDING_BATCH_SIZE", "32"))
+LOCAL_EMBEDDING_WORKERS = int(
+    os.getenv("LOCAL_EMBEDDING_WORKERS", str(os.cpu_count() or 1))
+)
+# Some models (e5, bge) expect instruction prefixes on queries and passages.
+LOCAL_EMBEDDING_QUERY_PREFIX = os.getenv("LOCAL_EMBEDDING_QUERY_PREFIX", "")
+LOCAL_EMBEDDING_DOCUMENT_PREFIX = os.getenv("LOCAL_EMBEDDING_DOCUMENT_PREFIX", "")
+
+
+class LocalOnnxEmbeddings(Embeddings):
+    """
+    CPU sentence embeddings with onnxruntime.
+
+    Texts are sorted by length and grouped into batches to minimise padding,
+    and batches are run concurrently on a thread pool sharing one inference
+    session (each run uses a single intra-op thread).
+    """
+
+    def __init__(
+        self,
+        model_dir: Path = LOCAL_EMBEDDING_MODEL_DIR,
+        onnx_file: str = LOCAL_EMBEDDING_ONNX_FILE,
+        max_length: int = LOCAL_EMBEDDING_MAX_LENGTH,
+        batch_size: int = LOCAL_EMBEDDING_BATCH_SIZE,
+        workers: int = LOCAL_EMBEDDING_WORKERS,
+    ):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        self.model_name = model_dir.name
+        self.batch_size = batch_size
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = 1
+        options.inter_op_num_threads = 1
+        options.graph_optimization_level = (
+            ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        )
+        self.session = ort.InferenceSession(
+            str(model_dir / onnx_file),
+            sess_options=options,
+            providers=["CPUExecutionProvider"],
+        )
+        self.input_names = {
+            model_input.name for model_input in self.session.get_inputs()
+        }
+
+        self.tokenizer = Tokenizer.from_file(str(model_dir / "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=max_length)
+        self.tokenizer.enable_padding()
+
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="local-embeddings"
+        )
+
+    def _embed_batch(self, texts):
+        encodings = self.tokenizer.encode_batch(texts)
+        input_ids = np.array([e.ids for e in encodings], dtype=np.int64)
+        attention_mask = np.array(
+            [e.attention_mask for e in encodings], dtype=np.int64
+        )
+        feeds = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self.input_names:
+            feeds["token_type_ids"] = np.array(
+                [e.type_ids for e in encodings], dtype=np.int64
+            )
+
+        output = self.session.run(None, feeds)[0]
+        if output.ndim == 3:
+            # Mean pooling over non-padding token embeddings.
+            mask = attention_mask[:, :, None].astype(output.dtype)
+            output = (output * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        norms = np.linalg.norm(output, axis=1, keepdims=True)
+        return (output / np.maximum(norms, 1e-12)).tolist()
+
+    def embed_documents(self, texts):
+        if not texts:
+            return []
+        texts = [LOCAL_EMBEDDING_DOCUMENT_PREFIX + text for text in texts]
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        batches = [
+            order[start : start + self.batch_size]
+            for start in range(0, len(order), self.batch_size)
+        ]
+        results = [None] * len(texts)
+        batch_outputs = self.executor.map(
+            lambda batch: self._embed_batch([texts[i] for i in batch]), batches
+        )
+        for batch, embeddings in zip(batches, batch_outputs):
+            for i, embedding in zip(batch, embeddings):
+                results[i] = embedding
+        return results
+
+    def embed_query(self, text):
+        return self._embed_batch([LOCAL_EMBEDDING_QUERY_PREFIX + text])[0]
+
+
+def embedding_model_id() -> str:
+    """Identifies the provider and model that produced a set of vectors."""
+    if EMBEDDING_PROVIDER == "local":
+        return f"local/{LOCAL_EMBEDDING_MODEL_DIR.name}"
+    return f"google/{GOOGLE_EMBEDDING_MODEL_NAME}"
+
+
+def create_embeddings() -> Embeddings:
+    if EMBEDDING_PROVIDER == "local":
+        return LocalOnnxEmbeddings()
+    if EMBEDDING_PROVIDER != "google":
+        raise ValueError(f"Unknown EMBEDDING_PROVIDER '{EMBEDDING_PROVIDER}'.")
+
+    from langchain_google_genai import GoogleGenerativeAIEmbeddings
+    from pydantic import SecretStr
+
+    google_api_key = os.getenv("GOOGLE_API_KEY")
+    if not google_api_key:
+        raise ValueError("GOOGLE_API_KEY not found in environment variables.")
+    return GoogleGenerativeAIEmbeddings(
+        model=GOOGLE_EMBEDDING_MODEL_NAME, google_api_key=SecretStr(google_api_key)
+    )
+
+
+def collection_name_for(base_name: str) -> str:
+    """
+    Collections are named per embedding model so that vectors from different
+    providers never share a collection. The original Google collection keeps
+    its unsuffixed name.
+    """
+    if EMBEDDING_PROVIDER == "google":
+        return base_name
+    slug = re.sub(r"[^a-zA-Z0-9_-]+", "-", embedding_model_id()).strip("-")
+    return f"{base_name}__{slug}"
+
+
+def get_tagged_collection(client, base_name: str):
+    """
+    Opens the collection for the configured embedding model, tagging it with
+    the provider/model on first use and refusing to open a collection that was
+    built with a different one.
+    """
+    model_id = embedding_model_id()
+    collection = client.get_or_create_collection(
+        name=collection_name_for(base_name),
+        embedding_function=None,
+    )
+    metadata = dict(collection.metadata or {})
+    tagged_model_id = metadata.get("embedding_model")
+    if tagged_model_id is None:
+        # Index settings such as hnsw:space cannot be changed with modify().
+        metadata = {k: v for k, v in metadata.items() if not k.startswith("hnsw:")}
+        collection.modify(metadata={**metadata, "embedding_model": model_id})
+    elif tagged_model_id != model_id:
+        raise ValueError(
+            f"Collection '{collection.name}' was built with embedding model "
+            f"'{tagged_model_id}', but '{model_id}' is configured."
+        )
+    return collection
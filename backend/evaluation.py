@@ -0,0 +1,564 @@
+"""
+Retrieval and answer evaluation against a gold set.
+
+The gold set (eval/gold_set.json) lists materials-science questions with the
+DOIs of the papers that answer them. Questions without DOIs are kept for the
+answer checks and can be labelled with the help of `candidates`; retrieval
+metrics need at least one labelled question and fail otherwise.
+
+    python evaluation.py retrieval --offline     # recall@k, MRR, context tokens
+    python evaluation.py answers --offline       # replay recorded LLM responses
+    python evaluation.py run --offline           # both, compared with the baseline
+    python evaluation.py record                  # record LLM responses (live calls)
+    python evaluation.py bootstrap --limit 100   # add questions from paper chunks
+    python evaluation.py candidates              # papers close to unlabelled questions
+    python evaluation.py fixture                 # recall on the bundled fixture corpus
+
+`fixture` needs neither an index nor credentials: it indexes the small
+labelled corpus in eval/fixture_corpus.json with a word-hashing embedding and
+checks the sharded and two-stage search against eval/fixture_gold_set.json.
+
+With --offline no network request is made: query embeddings must be in the
+query embedding cache (any earlier online run puts them there) unless the
+local embedding provider is used, and LLM responses come from
+eval/llm_fixtures.json. Each run reports latency next to recall, so a change
+that speeds retrieval up can be checked for recall loss in the same run.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import numpy as np
+
+from chunking import estimate_tokens
+from embedding_providers import EMBEDDING_PROVIDER
+from langchain_core.embeddings import Embeddings
+
+EVAL_DIRECTORY = Path(os.getenv("EVAL_DIRECTORY", "eval"))
+GOLD_SET_PATH = EVAL_DIRECTORY / "gold_set.json"
+FIXTURES_PATH = EVAL_DIRECTORY / "llm_fixtures.json"
+BASELINE_PATH = EVAL_DIRECTORY / "baseline.json"
+FIXTURE_CORPUS_PATH = EVAL_DIRECTORY / "fixture_corpus.json"
+FIXTURE_GOLD_SET_PATH = EVAL_DIRECTORY / "fixture_gold_set.json"
+# The fixture run fails when recall@5 on the fixture corpus is below this.
+FIXTURE_MIN_RECALL = 0.9
+HASHING_DIMENSIONS = 256
+# A run fails when recall@k falls more than this below the baseline.
+MAX_RECALL_DROP = float(os.getenv("EVAL_MAX_RECALL_DROP", "0.02"))
+DEFAULT_KS = (1, 3, 5, 10)
+
+_CITATION_PATTERN = re.compile(r"\[(\d+)\]")
+_SENTENCE_PATTERN = re.compile(r"(?<=[.!?])\s+")
+_WORD_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def normalize_doi(doi) -> str:
+    return str(doi or "").strip().lower()
+
+
+def load_gold_set(path: Path = GOLD_SET_PATH):
+    if not path.exists():
+        return []
+    return json.loads(path.read_text())
+
+
+def save_json(path: Path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(data, indent=2) + "\n")
+
+
+def labelled(gold_set):
+    return [entry for entry in gold_set if entry.get("expected_dois")]
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def prompt_hash(prompt: str) -> str:
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+
+class OfflineEmbeddings(Embeddings):
+    """Stands in for the embedding API so that a cache miss fails loudly."""
+
+    def embed_documents(self, texts):
+        raise RuntimeError("Embedding API calls are disabled in offline mode.")
+
+    def embed_query(self, text):
+        raise RuntimeError(
+            f"Query embedding for '{text}' is not cached. Run once without "
+            "--offline to cache it."
+        )
+
+
+class HashingEmbeddings(Embeddings):
+    """
+    Deterministic bag-of-words embeddings for the fixture corpus, so that the
+    search code can be checked without an embedding model.
+    """
+
+    def __init__(self, dimensions: int = HASHING_DIMENSIONS):
+        self.dimensions = dimensions
+
+    def _embed(self, text: str):
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        for word in _WORD_PATTERN.findall(text.lower()):
+            digest = hashlib.md5(word.encode("utf-8")).digest()
+            vector[int.from_bytes(digest[:4], "little") % self.dimensions] += 1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts):
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._embed(text)
+
+
+class ReplayBackend:
+    """
+    Generation backend that answers from recorded responses. A response is
+    looked up by the hash of its prompt; when retrieval has changed the
+    prompt, the response recorded for the same question is used and counted
+    as stale.
+    """
+
+    def __init__(self, fixtures: dict):
+        self.by_prompt = {
+            fixture["prompt_sha256"]: fixture["response"]
+            for fixture in fixtures.values()
+        }
+        self.fixtures = fixtures
+        self.question_id = None
+        self.stale = False
+
+    async def agenerate(self, prompt: str) -> str:
+        response = self.by_prompt.get(prompt_hash(prompt))
+        if response is not None:
+            self.stale = False
+            return response
+        fixture = self.fixtures.get(self.question_id)
+        if fixture is None:
+            raise KeyError(f"No recorded response for '{self.question_id}'.")
+        self.stale = True
+        return fixture["response"]
+
+    async def astream(self, prompt: str):
+        yield await self.agenerate(prompt)
+
+
+class RecordingBackend:
+    """Passes generations through to a live backend and keeps the responses."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.question_id = None
+        self.fixtures = {}
+
+    async def agenerate(self, prompt: str) -> str:
+        response = await self.backend.agenerate(prompt)
+        self.fixtures[self.question_id] = {
+            "prompt_sha256": prompt_hash(prompt),
+            "response": response,
+            "recorded_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+        return response
+
+    async def astream(self, prompt: str):
+        yield await self.agenerate(prompt)
+
+
+def load_pipeline(offline: bool):
+    """Imports rag_pipeline, cut off from the network when offline."""
+    if offline:
+        # rag_pipeline requires a key at import time; no request is made with it.
+        os.environ.setdefault("GOOGLE_API_KEY", "offline-evaluation")
+    import rag_pipeline
+
+    if offline and EMBEDDING_PROVIDER != "local":
+        rag_pipeline.embeddings.embeddings = OfflineEmbeddings()
+    return rag_pipeline
+
+
+def evaluate_retrieval(pipeline, gold_set, ks=DEFAULT_KS, shortlist_size=None):
+    """
+    Recall@k of expected DOIs among the papers of the top-k chunks, mean
+    reciprocal rank of the first expected paper, and the size of the context
+    sent to the LLM for the pipeline's k.
+    """
+    if shortlist_size is None:
+        shortlist_size = pipeline.retriever.shortlist_size
+    entries = labelled(gold_set)
+    if not entries:
+        raise ValueError(
+            "No gold questions have expected DOIs; label some with "
+            "`candidates` or add them with `bootstrap`."
+        )
+    depth = max(max(ks), pipeline.retriever.k)
+    recalls = {k: [] for k in ks}
+    reciprocal_ranks = []
+    context_tokens = []
+    search_seconds = []
+    misses = []
+
+    for entry in entries:
+        expected = {normalize_doi(doi) for doi in entry["expected_dois"]}
+        query_embedding = pipeline.embeddings.embed_query(entry["question"])
+        start = time.perf_counter()
+        hits = pipeline.index.search_two_stage(query_embedding, depth, shortlist_size)
+        search_seconds.append(time.perf_counter() - start)
+
+        hit_dois = [normalize_doi((hit["metadata"] or {}).get("doi")) for hit in hits]
+        for k in ks:
+            found = expected & set(hit_dois[:k])
+            recalls[k].append(len(found) / len(expected))
+        ranked_papers = list(dict.fromkeys(hit_dois))
+        rank = next(
+            (i for i, doi in enumerate(ranked_papers, start=1) if doi in expected),
+            None,
+        )
+        reciprocal_ranks.append(1 / rank if rank else 0.0)
+        if rank is None:
+            misses.append(entry["id"])
+
+        docs = [pipeline.hit_to_document(hit) for hit in hits[: pipeline.retriever.k]]
+        context = pipeline.process_retrieved_docs(docs)["context_with_numbers"]
+        context_tokens.append(estimate_tokens(context))
+
+    count = len(entries)
+    return {
+        "questions": len(entries),
+        "shortlist_size": shortlist_size,
+        **{f"recall@{k}": round(sum(recalls[k]) / count, 4) for k in ks},
+        "mrr": round(sum(reciprocal_ranks) / count, 4),
+        "mean_context_tokens": round(sum(context_tokens) / count, 1),
+        "search_p50_ms": round(percentile(search_seconds, 0.5) * 1000, 2),
+        "search_p95_ms": round(percentile(search_seconds, 0.95) * 1000, 2),
+        "missed_questions": misses,
+    }
+
+
+def evaluate_answers(pipeline, gold_set, fixtures):
+    """
+    Runs every question with a recorded response through the full pipeline,
+    replaying the response, and checks the citations of the answer.
+    """
+    backend = ReplayBackend(fixtures)
+    pipeline.generation_gateway = pipeline.GenerationGateway(
+        backend, hedge_enabled=False
+    )
+    results = {
+        "answers": 0,
+        "stale_fixtures": 0,
+        "with_references": 0,
+        "invalid_citations": 0,
+        "cited_expected_paper": 0,
+        "labelled_answers": 0,
+    }
+    for entry in gold_set:
+        if entry["id"] not in fixtures:
+            continue
+        backend.question_id = entry["id"]
+        result = pipeline.answer_query(entry["question"])
+        results["answers"] += 1
+        results["stale_fixtures"] += backend.stale
+
+        citations = {c["number"]: c for c in result["citations"]}
+        cited = {int(n) for n in _CITATION_PATTERN.findall(result["answer"])}
+        if citations:
+            results["with_references"] += 1
+            results["invalid_citations"] += len(cited - set(citations))
+        if entry.get("expected_dois"):
+            results["labelled_answers"] += 1
+            expected = {normalize_doi(doi) for doi in entry["expected_dois"]}
+            cited_dois = {
+                normalize_doi(citations[n]["doi"]) for n in cited if n in citations
+            }
+            results["cited_expected_paper"] += bool(expected & cited_dois)
+    return results
+
+
+def record_answers(pipeline, gold_set, path: Path = FIXTURES_PATH):
+    """Answers every gold question with the live LLM and saves the responses."""
+    recorder = RecordingBackend(pipeline.generation_backend)
+    pipeline.generation_gateway = pipeline.GenerationGateway(
+        recorder, hedge_enabled=False
+    )
+    fixtures = json.loads(path.read_text()) if path.exists() else {}
+    for entry in gold_set:
+        recorder.question_id = entry["id"]
+        print(f"Recording answer to {entry['id']}: {entry['question']}")
+        try:
+            pipeline.answer_query(entry["question"])
+        except Exception as e:
+            print(f"Error answering {entry['id']}: {e}")
+    fixtures.update(recorder.fixtures)
+    save_json(path, fixtures)
+    print(f"Recorded {len(recorder.fixtures)} response(s) to {path}.")
+
+
+def bootstrap_questions(pipeline, gold_set, limit: int, seed: int = 645):
+    """
+    Adds one question per paper, taken from a sentence of one of its body
+    chunks with every other word dropped, so that a hit needs more than a
+    phrase match. The expected DOI is the paper's own. Abstract, first-page
+    and reference chunks are skipped: document summaries are built from the
+    first two, and questions taken from them would favour the two-stage search.
+    """
+    rng = random.Random(seed)
+    known_dois = {
+        normalize_doi(doi)
+        for entry in gold_set
+        for doi in entry.get("expected_dois", [])
+    }
+    index = pipeline.index
+    papers = sorted(index.load_manifest().items())
+    rng.shuffle(papers)
+    added = 0
+    for source_file, shard_key in papers:
+        if added >= limit:
+            break
+        result = index.collection(shard_key).get(
+            where={"source_file": {"$eq": source_file}},
+            include=["documents", "metadatas"],
+        )
+        if not result["ids"]:
+            continue
+        doi = result["metadatas"][0].get("doi")
+        if not doi or doi == "Unknown DOI" or normalize_doi(doi) in known_dois:
+            continue
+        sentences = [
+            sentence
+            for text, metadata in zip(result["documents"], result["metadatas"])
+            if _is_body_chunk(metadata)
+            for sentence in _SENTENCE_PATTERN.split(text)
+            if 12 <= len(sentence.split()) <= 40
+        ]
+        if not sentences:
+            continue
+        words = rng.choice(sentences).split()
+        gold_set.append(
+            {
+                "id": f"bootstrap-{normalize_doi(doi)}",
+                "question": " ".join(words[::2]),
+                "expected_dois": [doi],
+                "source": "bootstrap-chunk",
+            }
+        )
+        known_dois.add(normalize_doi(doi))
+        added += 1
+    return added
+
+
+def _is_body_chunk(metadata) -> bool:
+    if metadata.get("content_type") == "references":
+        return False
+    if metadata.get("page") in (0, "0"):
+        return False
+    return "abstract" not in (metadata.get("section") or "").lower()
+
+
+def print_candidates(pipeline, gold_set, count: int = 5):
+    """Closest papers to each unlabelled question, to help label the gold set."""
+    for entry in gold_set:
+        if entry.get("expected_dois"):
+            continue
+        print(f"\n{entry['id']}: {entry['question']}")
+        query_embedding = pipeline.embeddings.embed_query(entry["question"])
+        for paper in pipeline.index.search_documents(query_embedding, count):
+            print(f"  {paper['distance']:.3f}  {paper['doi']}  {paper['title']}")
+
+
+class FixturePipeline:
+    """The parts of rag_pipeline that evaluate_retrieval uses, over an index."""
+
+    def __init__(self, index, embeddings, k: int = 5, shortlist_size: int = 3):
+        self.index = index
+        self.embeddings = embeddings
+        self.retriever = SimpleNamespace(k=k, shortlist_size=shortlist_size)
+
+    @staticmethod
+    def hit_to_document(hit):
+        return hit
+
+    @staticmethod
+    def process_retrieved_docs(hits):
+        context = "\n\n".join(
+            f"[{i}] {hit['document']}" for i, hit in enumerate(hits, start=1)
+        )
+        return {"context_with_numbers": context}
+
+
+def build_fixture_index(directory: Path, embeddings, corpus_path=FIXTURE_CORPUS_PATH):
+    """Indexes the fixture corpus, with document summaries, in two shards."""
+    # Imported here so that the replay tools do not need Chroma.
+    from document_summaries import SummaryCollector
+    from sharding import ShardedIndex
+
+    index = ShardedIndex(directory, strategy="doi_hash", num_shards=2)
+    manifest = {}
+    for paper in json.loads(corpus_path.read_text()):
+        core_metadata = {
+            key: paper[key] for key in ("source_file", "title", "doi", "year")
+        }
+        shard_key = index.shard_for(core_metadata)
+        stem = Path(paper["source_file"]).stem
+        metadatas = [
+            {**core_metadata, "page": chunk["page"], "section": chunk["section"]}
+            for chunk in paper["chunks"]
+        ]
+        texts = [chunk["text"] for chunk in paper["chunks"]]
+        index.collection(shard_key).upsert(
+            ids=[
+                f"{stem}_page{chunk['page']}_chunk{i}"
+                for i, chunk in enumerate(paper["chunks"])
+            ],
+            embeddings=embeddings.embed_documents(texts),
+            documents=texts,
+            metadatas=metadatas,
+        )
+        collector = SummaryCollector()
+        for text, metadata in zip(texts, metadatas):
+            collector.keep(text, metadata)
+        summary = collector.summary(core_metadata)
+        index.upsert_document(
+            core_metadata, shard_key, embeddings.embed_query(summary), summary
+        )
+        manifest[paper["source_file"]] = shard_key
+    index.save_manifest(manifest)
+    return index
+
+
+def evaluate_fixture(gold_path=FIXTURE_GOLD_SET_PATH, corpus_path=FIXTURE_CORPUS_PATH):
+    """Retrieval reports for the flat and two-stage search of the fixture corpus."""
+    embeddings = HashingEmbeddings()
+    with tempfile.TemporaryDirectory() as directory:
+        index = build_fixture_index(Path(directory), embeddings, corpus_path)
+        try:
+            pipeline = FixturePipeline(index, embeddings)
+            gold_set = load_gold_set(gold_path)
+            return {
+                "flat": evaluate_retrieval(pipeline, gold_set, shortlist_size=0),
+                "two_stage": evaluate_retrieval(pipeline, gold_set),
+            }
+        finally:
+            index.close()
+
+
+def compare_with_baseline(report: dict, baseline: dict, max_drop=MAX_RECALL_DROP):
+    """Returns the recall metrics that fell more than max_drop below baseline."""
+    regressions = []
+    for name, value in report["retrieval"].items():
+        if not name.startswith("recall@") or name not in baseline["retrieval"]:
+            continue
+        drop = baseline["retrieval"][name] - value
+        if drop > max_drop:
+            regressions.append(
+                f"{name} {value:.4f} is {drop:.4f} below baseline "
+                f"{baseline['retrieval'][name]:.4f}"
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Retrieval and answer evaluation.")
+    parser.add_argument("--gold", type=Path, default=GOLD_SET_PATH)
+    parser.add_argument("--fixtures", type=Path, default=FIXTURES_PATH)
+    parser.add_argument(
+        "--offline", action="store_true", help="Make no network requests."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for name in ("retrieval", "run"):
+        subparser = subparsers.add_parser(name)
+        subparser.add_argument("-k", type=int, nargs="+", default=list(DEFAULT_KS))
+        subparser.add_argument(
+            "--shortlist",
+            type=int,
+            help="Documents shortlisted before the chunk search (0 for flat).",
+        )
+    subparsers.add_parser("answers")
+    subparsers.add_parser("record")
+    bootstrap_parser = subparsers.add_parser("bootstrap")
+    bootstrap_parser.add_argument("--limit", type=int, default=50)
+    subparsers.add_parser("candidates")
+    subparsers.add_parser("fixture")
+    run_parser = subparsers.choices["run"]
+    run_parser.add_argument("--baseline", type=Path, default=BASELINE_PATH)
+    run_parser.add_argument(
+        "--save-baseline", action="store_true", help="Store this run as the baseline."
+    )
+    args = parser.parse_args()
+
+    if args.command == "fixture":
+        report = evaluate_fixture()
+        print(json.dumps(report, indent=2))
+        failures = [
+            f"{name} recall@5 {result['recall@5']:.4f} < {FIXTURE_MIN_RECALL}"
+            for name, result in report.items()
+            if result["recall@5"] < FIXTURE_MIN_RECALL
+        ]
+        for failure in failures:
+            print(f"Fixture recall too low: {failure}")
+        sys.exit(1 if failures else 0)
+
+    pipeline = load_pipeline(args.offline)
+    gold_set = load_gold_set(args.gold)
+    fixtures = json.loads(args.fixtures.read_text()) if args.fixtures.exists() else {}
+    print(f"{len(gold_set)} questions, {len(labelled(gold_set))} with expected DOIs")
+    if args.command in ("retrieval", "run") and not labelled(gold_set):
+        sys.exit(
+            f"No question in {args.gold} has expected DOIs, so recall cannot be "
+            "measured. Label questions with `candidates` or add some with "
+            "`bootstrap`."
+        )
+
+    if args.command == "retrieval":
+        report = evaluate_retrieval(pipeline, gold_set, args.k, args.shortlist)
+        print(json.dumps(report))
+    elif args.command == "answers":
+        print(json.dumps(evaluate_answers(pipeline, gold_set, fixtures)))
+    elif args.command == "record":
+        record_answers(pipeline, gold_set, args.fixtures)
+    elif args.command == "bootstrap":
+        added = bootstrap_questions(pipeline, gold_set, args.limit)
+        save_json(args.gold, gold_set)
+        print(
+            f"Added {added} question(s) to {args.gold}, taken from body chunks "
+            "(source 'bootstrap-chunk')."
+        )
+    elif args.command == "candidates":
+        print_candidates(pipeline, gold_set)
+    elif args.command == "run":
+        report = {
+            "retrieval": evaluate_retrieval(pipeline, gold_set, args.k, args.shortlist),
+            "answers": evaluate_answers(pipeline, gold_set, fixtures),
+        }
+        print(json.dumps(report, indent=2))
+        if args.save_baseline:
+            save_json(args.baseline, report)
+            print(f"Saved baseline to {args.baseline}.")
+        elif args.baseline.exists():
+            regressions = compare_with_baseline(
+                report, json.loads(args.baseline.read_text())
+            )
+            for regression in regressions:
+                print(f"Recall regression: {regression}")
+            if regressions:
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,298 @@
+"""
+Blue/green index builds.
+
+Each full build is written to <root>/versions/<version>. The CURRENT file in
+the root names the version being served and is replaced atomically, so query
+workers never see a half-built index. Without a CURRENT file the root
+directory itself is served, which is the original layout.
+
+    python index_versions.py build      # build, validate, swap, garbage-collect
+    python index_versions.py status
+    python index_versions.py rollback VERSION
+
+A build holds the ingestion lock of the root until CURRENT has been swapped,
+so the watcher and /ingest, which write to the served version, wait for it and
+then ingest into the new version instead of one that is about to be retired.
+"""
+
+import argparse
+import itertools
+import os
+import random
+import shutil
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows.
+    fcntl = None
+
+from sharding import CHROMA_COLLECTION_NAME, ShardedIndex
+
+CURRENT_POINTER_NAME = "CURRENT"
+VERSIONS_DIRECTORY_NAME = "versions"
+INGESTION_LOCK_NAME = ".ingestion.lock"
+# Serving processes look at the pointer at most this often.
+RELOAD_CHECK_SECONDS = float(os.getenv("INDEX_RELOAD_CHECK_SECONDS", "2"))
+KEEP_VERSIONS = int(os.getenv("INDEX_KEEP_VERSIONS", "2"))
+MIN_COUNT_RATIO = float(os.getenv("INDEX_MIN_COUNT_RATIO", "0.9"))
+MIN_SAMPLE_RECALL = float(os.getenv("INDEX_MIN_SAMPLE_RECALL", "0.95"))
+VALIDATION_SAMPLES = int(os.getenv("INDEX_VALIDATION_SAMPLES", "50"))
+# A replaced index is closed this long after a swap, once the queries that
+# were already using it have finished.
+RETIRE_GRACE_SECONDS = float(os.getenv("INDEX_RETIRE_GRACE_SECONDS", "60"))
+
+
+def read_current_version(root: Path):
+    try:
+        return (root / CURRENT_POINTER_NAME).read_text().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def serving_directory(root: Path) -> Path:
+    version = read_current_version(root)
+    if version is None:
+        return root
+    return root / VERSIONS_DIRECTORY_NAME / version
+
+
+def new_version_directory(root: Path) -> Path:
+    """
+    Creates the directory of a new version named after the current time. A
+    build started in the same second gets a numbered suffix instead.
+    """
+    versions_directory = root / VERSIONS_DIRECTORY_NAME
+    versions_directory.mkdir(parents=True, exist_ok=True)
+    timestamp = time.strftime("%Y%m%dT%H%M%S")
+    for attempt in itertools.count():
+        version = timestamp if attempt == 0 else f"{timestamp}-{attempt:03d}"
+        try:
+            (versions_directory / version).mkdir()
+        except FileExistsError:
+            continue
+        return versions_directory / version
+
+
+@contextmanager
+def ingestion_lock(root: Path):
+    """
+    Exclusive lock, shared between processes, for writing to the index under
+    root. Held for a whole build and for every ingestion into the served
+    version.
+    """
+    root.mkdir(parents=True, exist_ok=True)
+    with open(root / INGESTION_LOCK_NAME, "a") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def swap_current(root: Path, version: str):
+    """Points CURRENT at version with an atomic rename."""
+    tmp_path = root / f".{CURRENT_POINTER_NAME}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(version)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, root / CURRENT_POINTER_NAME)
+
+
+def garbage_collect(root: Path, keep: int = KEEP_VERSIONS):
+    """
+    Removes old versions, keeping the served one and the `keep` most recent
+    others so that workers which have not reloaded yet can finish their queries.
+    """
+    versions_directory = root / VERSIONS_DIRECTORY_NAME
+    if not versions_directory.exists():
+        return []
+    current = read_current_version(root)
+    others = sorted(
+        (p for p in versions_directory.iterdir() if p.is_dir() and p.name != current),
+        key=lambda p: p.name,
+        reverse=True,
+    )
+    removed = []
+    for directory in others[keep:]:
+        shutil.rmtree(directory, ignore_errors=True)
+        removed.append(directory.name)
+    return removed
+
+
+class ServingIndex:
+    """
+    Resolves the served index version and reloads it when CURRENT changes,
+    so running workers pick up a swapped index without a restart. Attribute
+    access is delegated to the ShardedIndex of the current version.
+    """
+
+    def __init__(self, root: Path, collection_name: str = CHROMA_COLLECTION_NAME):
+        self.root = root
+        self.collection_name = collection_name
+        self._lock = threading.Lock()
+        self._version = read_current_version(root)
+        self._index = ShardedIndex(serving_directory(root), collection_name)
+        self._retired = []
+        self._last_check = time.monotonic()
+
+    def current(self, refresh: bool = False) -> ShardedIndex:
+        """With refresh, CURRENT is re-read even if it was checked just now."""
+        now = time.monotonic()
+        if not refresh and now - self._last_check < RELOAD_CHECK_SECONDS:
+            return self._index
+        with self._lock:
+            self._last_check = now
+            version = read_current_version(self.root)
+            if version != self._version:
+                print(f"Index version changed to {version}, reloading.")
+                self._retired.append((self._index, now))
+                self._index = ShardedIndex(
+                    serving_directory(self.root), self.collection_name
+                )
+                self._version = version
+            self._close_retired(now - RETIRE_GRACE_SECONDS)
+            return self._index
+
+    def _close_retired(self, retired_before: float):
+        while self._retired and self._retired[0][1] <= retired_before:
+            index, _ = self._retired.pop(0)
+            index.close()
+
+    def close(self):
+        with self._lock:
+            self._close_retired(float("inf"))
+            self._index.close()
+
+    @property
+    def version(self):
+        self.current()
+        return self._version
+
+    def __getattr__(self, name):
+        return getattr(self.current(), name)
+
+
+def sample_recall(index: ShardedIndex, samples: int, k: int = 10) -> float:
+    """
+    Share of sampled chunks that come back in the top-k when the index is
+    queried with their own embeddings. A hit with the same text counts too,
+    since identical chunks have identical embeddings and may fill the top-k.
+    """
+    hits = 0
+    total = 0
+    for shard_key in index.shard_keys():
+        collection = index.collection(shard_key)
+        count = collection.count()
+        if not count:
+            continue
+        per_shard = max(1, samples // len(index.shard_keys()))
+        offset = random.randint(0, max(0, count - per_shard))
+        result = collection.get(
+            limit=per_shard, offset=offset, include=["embeddings", "documents"]
+        )
+        for chunk_id, embedding, document in zip(
+            result["ids"], result["embeddings"], result["documents"]
+        ):
+            top = index.search(list(embedding), k)
+            hits += any(
+                hit["id"] == chunk_id or hit["document"] == document for hit in top
+            )
+            total += 1
+    return hits / total if total else 0.0
+
+
+def validate(new_index: ShardedIndex, serving_index: ShardedIndex):
+    """Returns a list of problems; an empty list means the build can be served."""
+    problems = []
+    new_count = new_index.count()
+    if new_count == 0:
+        return ["new index is empty"]
+
+    old_count = serving_index.count()
+    if old_count and new_count < MIN_COUNT_RATIO * old_count:
+        problems.append(
+            f"chunk count {new_count} is below {MIN_COUNT_RATIO:.0%} of the "
+            f"served index ({old_count})"
+        )
+
+    recall = sample_recall(new_index, VALIDATION_SAMPLES)
+    print(f"Sample-query recall@10 of new index: {recall:.3f}")
+    if recall < MIN_SAMPLE_RECALL:
+        problems.append(f"sample recall {recall:.3f} is below {MIN_SAMPLE_RECALL}")
+    return problems
+
+
+def build(root: Path, keep: int = KEEP_VERSIONS) -> bool:
+    with ingestion_lock(root):
+        return _build(root, keep)
+
+
+def _build(root: Path, keep: int) -> bool:
+    # Imported here so that status/rollback work without embedding credentials.
+    from ingestion import ingest_pdfs
+
+    version_directory = new_version_directory(root)
+    print(f"Building index version {version_directory.name}...")
+    new_index = ShardedIndex(version_directory)
+    ingest_pdfs(target_index=new_index)
+
+    serving_index = ShardedIndex(serving_directory(root))
+    try:
+        problems = validate(new_index, serving_index)
+    finally:
+        new_index.close()
+        serving_index.close()
+    if problems:
+        print("Validation failed, keeping the served index:")
+        for problem in problems:
+            print(f"  - {problem}")
+        return False
+
+    swap_current(root, version_directory.name)
+    print(f"Now serving index version {version_directory.name}.")
+    removed = garbage_collect(root, keep)
+    if removed:
+        print(f"Removed old index versions: {', '.join(removed)}")
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Blue/green index builds.")
+    parser.add_argument("--root", type=Path, default=Path("chroma_db"))
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build")
+    build_parser.add_argument("--keep", type=int, default=KEEP_VERSIONS)
+    subparsers.add_parser("status")
+    rollback_parser = subparsers.add_parser("rollback")
+    rollback_parser.add_argument("version")
+    args = parser.parse_args()
+
+    args.root.mkdir(exist_ok=True)
+    if args.command == "build":
+        sys.exit(0 if build(args.root, args.keep) else 1)
+    elif args.command == "status":
+        versions_directory = args.root / VERSIONS_DIRECTORY_NAME
+        versions = (
+            sorted(p.name for p in versions_directory.iterdir() if p.is_dir())
+            if versions_directory.exists()
+            else []
+        )
+        print(f"Serving: {read_current_version(args.root) or '(root directory)'}")
+        print(f"Available versions: {', '.join(versions) or 'none'}")
+    elif args.command == "rollback":
+        if not (args.root / VERSIONS_DIRECTORY_NAME / args.version).is_dir():
+            sys.exit(f"Unknown index version {args.version}")
+        swap_current(args.root, args.version)
+        print(f"Now serving index version {args.version}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,48 +1,82 @@
+import argparse
+import gc
 import json
 import os
+import sys
+from contextlib import nullcontext
 from pathlib import Path
 
-import chromadb
+try:
+    import resource
+except ImportError:  # Not available on Windows.
+    resource = None
+
+from chunking import REFERENCES_MODE, ScientificTextSplitter
+from dedup import NearDuplicateIndex, compute_minhash_signature
+from document_summaries import SummaryCollector, backfill
 from dotenv import load_dotenv
+from embedding_providers import create_embeddings
+from index_versions import ServingIndex, ingestion_lock
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_community.document_loaders import PyPDFLoader
-from langchain_google_genai import GoogleGenerativeAIEmbeddings
-from pydantic import SecretStr
+from prescan import PRESCAN_ENABLED, prescan_pdfs
+from profiling import NULL_TIMINGS, PROFILE_DIRECTORY, ProfileSession
+from text_store import TextStore, content_hash
+from text_store import available as text_store_available
 from utils import extract_metadata_from_pdf
 
 load_dotenv()
 
-GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-if not GOOGLE_API_KEY:
-    raise ValueError("GOOGLE_API_KEY not found in environment variables.")
-
 PDF_DIRECTORY = Path("pdf_documents")
 CHROMA_PERSIST_DIRECTORY = Path("chroma_db")
 CHROMA_COLLECTION_NAME = "scientific_articles"
-PROCESSED_FILES_LOG = CHROMA_PERSIST_DIRECTORY / "processed_files.json"
-
-EMBEDDING_MODEL_NAME = "models/text-embedding-004"
-embeddings = GoogleGenerativeAIEmbeddings(
-    model=EMBEDDING_MODEL_NAME, google_api_key=SecretStr(GOOGLE_API_KEY)
-)
-
-client = chromadb.PersistentClient(path=str(CHROMA_PERSIST_DIRECTORY))
+# Bookkeeping files live next to the index version they describe.
+PROCESSED_FILES_LOG_NAME = "processed_files.json"
+MINHASH_INDEX_NAME = "minhash_index.json"
+DUPLICATES_LOG_NAME = "duplicates.json"
+
+# Chunks are embedded and upserted in batches of this size so that only one
+# batch of texts/embeddings is held in memory at a time.
+EMBED_BATCH_SIZE = int(os.getenv("INGEST_EMBED_BATCH_SIZE", "64"))
+# Soft RSS ceiling in MB. When exceeded, the current batch is flushed early and
+# the batch size is reduced for the rest of the document. 0 disables the check.
+MEMORY_LIMIT_MB = float(os.getenv("INGEST_MEMORY_LIMIT_MB", "1024"))
+
+# Provider and model are selected with EMBEDDING_PROVIDER (see embedding_providers).
+embeddings = create_embeddings()
+
+# The served index version (see index_versions); chunks are partitioned across
+# shards by CHROMA_SHARD_STRATEGY (see sharding).
+index = ServingIndex(CHROMA_PERSIST_DIRECTORY, CHROMA_COLLECTION_NAME)
+
+# "scientific" sizes chunks in tokens along section boundaries; "recursive" is
+# the original character-based splitter.
+CHUNKER = os.getenv("CHUNKER", "scientific").lower()
+if CHUNKER == "recursive":
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=1000,
+        chunk_overlap=200,
+        length_function=len,
+    )
+else:
+    text_splitter = ScientificTextSplitter()
 
-collection = client.get_or_create_collection(
-    name=CHROMA_COLLECTION_NAME,
-    embedding_function=None,
-)
+# Reference-list chunks are kept out of the retrieval collection.
+STORE_REFERENCES = CHUNKER != "recursive" and REFERENCES_MODE == "separate"
 
-text_splitter = RecursiveCharacterTextSplitter(
-    chunk_size=1000,
-    chunk_overlap=200,
-    length_function=len,
-)
+# Extracted text is kept in a columnar store (see text_store) so that PDFs
+# already parsed once are re-chunked and re-embedded without parsing them.
+if text_store_available():
+    text_store = TextStore()
+else:
+    print("Text store disabled (TEXT_STORE_ENABLED=false or pyarrow missing).")
+    text_store = None
 
 
-def load_processed_files_log():
-    if PROCESSED_FILES_LOG.exists():
-        with open(PROCESSED_FILES_LOG, "r") as f:
+def load_processed_files_log(index_directory):
+    log_path = index_directory / PROCESSED_FILES_LOG_NAME
+    if log_path.exists():
+        with open(log_path, "r") as f:
             try:
                 return set(json.load(f))
             except json.JSONDecodeError:
@@ -50,106 +84,430 @@ def load_processed_files_log():
     return set()
 
 
-def save_processed_files_log(processed_files_set):
-    with open(PROCESSED_FILES_LOG, "w") as f:
+def save_processed_files_log(index_directory, processed_files_set):
+    with open(index_directory / PROCESSED_FILES_LOG_NAME, "w") as f:
         json.dump(list(processed_files_set), f)
 
 
-def has_embeddings_in_collection(pdf_stem, collection):
-    """Check if embeddings for a PDF file already exist in the collection."""
+def load_duplicates_log(index_directory):
+    log_path = index_directory / DUPLICATES_LOG_NAME
+    if log_path.exists():
+        with open(log_path, "r") as f:
+            try:
+                return json.load(f)
+            except json.JSONDecodeError:
+                return {}
+    return {}
+
+
+def save_duplicates_log(index_directory, duplicates):
+    with open(index_directory / DUPLICATES_LOG_NAME, "w") as f:
+        json.dump(duplicates, f, indent=2)
+
+
+def current_rss_mb():
+    """Resident set size of this process in MB (falls back to peak RSS)."""
     try:
-        result = collection.get(
-            where={"source_file": {"$eq": f"{pdf_stem}.pdf"}},
-            limit=1,
-        )
-        return len(result["ids"]) > 0
+        with open("/proc/self/statm", "r") as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, IndexError, AttributeError):
+        return peak_rss_mb()
+
+
+def peak_rss_mb():
+    if resource is None:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes on Linux.
+    if sys.platform == "darwin":
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+
+def iter_pages(pdf_file, core_metadata):
+    """Lazily yield one page Document at a time, tagged with core metadata."""
+    loader = PyPDFLoader(str(pdf_file))
+    for page_doc in loader.lazy_load():
+        page_doc.metadata["source_file"] = core_metadata["source_file"]
+        page_doc.metadata["title"] = core_metadata["title"]
+        page_doc.metadata["doi"] = core_metadata["doi"]
+        if "year" in core_metadata:
+            page_doc.metadata["year"] = core_metadata["year"]
+        yield page_doc
+
+
+def iter_chunks(pages):
+    """Split pages as they arrive so that at most one page is ever buffered."""
+    if isinstance(text_splitter, ScientificTextSplitter):
+        yield from text_splitter.split_pages(pages)
+        return
+    for page_doc in pages:
+        yield from text_splitter.split_documents([page_doc])
+
+
+def iter_batches(chunks, batch_size=EMBED_BATCH_SIZE, memory_limit_mb=MEMORY_LIMIT_MB):
+    """
+    Group chunks into embedding batches.
+
+    The generator only pulls the next chunk once the previous batch has been
+    consumed (embedded and upserted), which bounds how much of a document is in
+    memory at any time. If RSS crosses memory_limit_mb the batch is flushed
+    early, and if it is still above the ceiling afterwards the batch size is
+    halved for the remaining chunks.
+    """
+    batch = []
+    for chunk in chunks:
+        batch.append(chunk)
+        over_limit = memory_limit_mb > 0 and current_rss_mb() >= memory_limit_mb
+        if len(batch) < batch_size and not over_limit:
+            continue
+
+        yield batch
+        batch = []
+
+        if over_limit:
+            gc.collect()
+            if current_rss_mb() >= memory_limit_mb and batch_size > 1:
+                batch_size = max(1, batch_size // 2)
+                print(
+                    f"RSS above {memory_limit_mb:.0f} MB, reducing embedding batch size to {batch_size}."
+                )
+    if batch:
+        yield batch
+
+
+def upsert_chunk_batch(
+    target_index, pdf_file, batch, first_chunk_index, shard_key, timings=NULL_TIMINGS
+):
+    chunk_texts_for_db = [doc.page_content for doc in batch]
+    chunk_metadatas_for_db = [doc.metadata for doc in batch]
+    chunk_ids = [
+        f"{pdf_file.stem}_page{doc.metadata.get('page', 'N')}_chunk{first_chunk_index + j}"
+        for j, doc in enumerate(batch)
+    ]
+
+    with timings.stage("embed"):
+        chunk_embeddings_list = embeddings.embed_documents(chunk_texts_for_db)
+
+    body_records = []
+    reference_records = []
+    for record in zip(
+        chunk_ids, chunk_embeddings_list, chunk_texts_for_db, chunk_metadatas_for_db
+    ):
+        if record[3].get("content_type") == "references":
+            reference_records.append(record)
+        else:
+            body_records.append(record)
+
+    for references, records in ((False, body_records), (True, reference_records)):
+        if not records:
+            continue
+        ids, batch_embeddings, documents, metadatas = zip(*records)
+        with timings.stage("upsert"):
+            target_index.collection(shard_key, references=references).upsert(
+                ids=list(ids),
+                embeddings=list(batch_embeddings),
+                documents=list(documents),
+                metadatas=list(metadatas),
+            )
+
+
+def upsert_document_summary(
+    target_index, core_metadata, shard_key, summary, timings=NULL_TIMINGS
+):
+    """Embeds a document's summary into the index used to shortlist documents."""
+    if not summary:
+        target_index.record_missing_summary(core_metadata["source_file"])
+        return
+    with timings.stage("summary"):
+        embedding = embeddings.embed_documents([summary])[0]
+        target_index.upsert_document(core_metadata, shard_key, embedding, summary)
+
+
+def remove_partial_embeddings(pdf_file, collection):
+    """Drop chunks already upserted for a file whose ingestion failed midway."""
+    try:
+        collection.delete(where={"source_file": {"$eq": pdf_file.name}})
+    except Exception as e:
+        print(f"Error removing partial embeddings for {pdf_file.name}: {e}")
+
+
+def has_embeddings_in_collection(pdf_stem, index):
+    """Check if embeddings for a PDF file already exist in any shard."""
+    try:
+        return index.has_source_file(f"{pdf_stem}.pdf")
     except Exception as e:
         print(f"Error checking for existing embeddings: {e}")
         return False
 
 
-def ingest_pdfs():
-    if not PDF_DIRECTORY.exists():
+def unlisted_source_files(target_index):
+    """
+    Processed files missing from the shard manifest, i.e. ingested before
+    it existed. Near-duplicates are left out since they have no chunks.
+    """
+    index_directory = target_index.base_directory
+    return (
+        load_processed_files_log(index_directory)
+        - set(target_index.load_manifest())
+        - set(load_duplicates_log(index_directory))
+    )
+
+
+def ensure_document_summaries(target_index):
+    """
+    Backfills document summaries when some indexed documents have none, so
+    that queries can use the two-stage search (see document_summaries).
+    """
+    unlisted = unlisted_source_files(target_index)
+    if unlisted or not target_index.summaries_complete():
+        try:
+            backfill(target_index, embeddings, unlisted)
+        except Exception as e:
+            print(f"Error backfilling document summaries: {e}")
+
+
+def ingest_pdfs(pdf_files=None, target_index=None, timings=NULL_TIMINGS):
+    """
+    Ingests pdf_files, or every PDF in PDF_DIRECTORY when not given, into
+    target_index, which defaults to the index version currently served.
+    Per-file stage times are recorded in timings when profiling.
+    """
+    if pdf_files is None and not PDF_DIRECTORY.exists():
         print(
             f"PDF directory {PDF_DIRECTORY} not found. Please create it and add PDFs."
         )
         return
 
-    processed_files_set = load_processed_files_log()
+    if target_index is None:
+        # Waits for a running blue/green build, then writes to the version it
+        # swapped in rather than the one it replaced.
+        with ingestion_lock(index.root):
+            return ingest_pdfs(pdf_files, index.current(refresh=True), timings)
+
+    index_directory = target_index.base_directory
+    index_directory.mkdir(parents=True, exist_ok=True)
+    with timings.stage("summary_backfill"):
+        ensure_document_summaries(target_index)
+
+    processed_files_set = load_processed_files_log(index_directory)
+    shard_manifest = target_index.load_manifest()
+    duplicates = load_duplicates_log(index_directory)
+    dedup_index = NearDuplicateIndex(index_directory / MINHASH_INDEX_NAME)
     new_files_processed_count = 0
     skipped_with_embeddings_count = 0
+    skipped_duplicates_count = 0
     total_chunks_added_this_run = 0
 
-    for pdf_file in PDF_DIRECTORY.glob("*.pdf"):
+    if pdf_files is None:
+        pdf_files = PDF_DIRECTORY.glob("*.pdf")
+    pdf_files = list(pdf_files)
+    if PRESCAN_ENABLED:
+        # Broken and scanned-image PDFs are moved aside before any parsing.
+        new_files = [p for p in pdf_files if p.name not in processed_files_set]
+        with timings.stage("prescan"):
+            rejected = set(new_files) - set(prescan_pdfs(new_files))
+        pdf_files = [p for p in pdf_files if p not in rejected]
+    store_writer = text_store.writer() if text_store is not None else None
+    summaries = SummaryCollector()
+    stored_text_count = 0
+
+    for pdf_file in pdf_files:
         if pdf_file.name in processed_files_set:
             print(f"Skipping already processed file: {pdf_file.name}")
             continue
 
-        if has_embeddings_in_collection(pdf_file.stem, collection):
+        if has_embeddings_in_collection(pdf_file.stem, target_index):
             print(f"Skipping {pdf_file.name}: Embeddings already exist in ChromaDB")
             processed_files_set.add(pdf_file.name)
             skipped_with_embeddings_count += 1
             continue
 
         print(f"Processing {pdf_file.name}...")
-        try:
-            core_metadata = extract_metadata_from_pdf(pdf_file)
-
-            loader = PyPDFLoader(str(pdf_file))
-            pages = loader.load()
-
-            if not pages:
-                print(f"Could not load pages from {pdf_file.name}. Skipping.")
-                continue
-
-            for page_doc in pages:
-                page_doc.metadata["source_file"] = core_metadata["source_file"]
-                page_doc.metadata["title"] = core_metadata["title"]
-                page_doc.metadata["doi"] = core_metadata["doi"]
-            chunks = text_splitter.split_documents(pages)
-
-            if not chunks:
-                print(f"No text chunks generated for {pdf_file.name}. Skipping.")
-                continue
-
-            chunk_texts_for_db = [doc.page_content for doc in chunks]
-            chunk_metadatas_for_db = [doc.metadata for doc in chunks]
-            chunk_ids = [
-                f"{pdf_file.stem}_page{doc.metadata.get('page', 'N')}_chunk{j}"
-                for j, doc in enumerate(chunks)
-            ]
-
-            chunk_embeddings_list = embeddings.embed_documents(chunk_texts_for_db)
-
-            collection.add(
-                ids=chunk_ids,
-                embeddings=chunk_embeddings_list,
-                documents=chunk_texts_for_db,
-                metadatas=chunk_metadatas_for_db,
-            )
-
-            processed_files_set.add(pdf_file.name)
-            new_files_processed_count += 1
-            total_chunks_added_this_run += len(chunks)
-            print(
-                f"Successfully processed and added {pdf_file.name} to ChromaDB ({len(chunks)} chunks)."
-            )
-
-        except Exception as e:
-            print(f"Error processing {pdf_file.name}: {e}")
-
-    save_processed_files_log(processed_files_set)
+        shard_key = None
+        with timings.stage(pdf_file.name):
+            try:
+                with timings.stage("hash"):
+                    file_hash = (
+                        content_hash(pdf_file) if text_store is not None else None
+                    )
+                from_store = file_hash is not None and file_hash in text_store
+                if from_store:
+                    core_metadata = text_store.core_metadata(file_hash, pdf_file.name)
+                    signature = text_store.minhash_signature(file_hash)
+                else:
+                    with timings.stage("metadata"):
+                        core_metadata = extract_metadata_from_pdf(pdf_file)
+                    with timings.stage("minhash"):
+                        signature = compute_minhash_signature(pdf_file)
+
+                # Near-duplicate check runs before any embedding call is made.
+                with timings.stage("dedup"):
+                    match = dedup_index.find_duplicate(core_metadata, signature)
+                if match:
+                    canonical_source_file, similarity = match
+                    duplicates[pdf_file.name] = {
+                        "canonical_source_file": canonical_source_file,
+                        "canonical_doi": dedup_index.canonical_doi(
+                            canonical_source_file
+                        ),
+                        "similarity": round(similarity, 3),
+                    }
+                    dedup_index.link_duplicate(canonical_source_file, pdf_file.name)
+                    processed_files_set.add(pdf_file.name)
+                    skipped_duplicates_count += 1
+                    print(
+                        f"Skipping {pdf_file.name}: near-duplicate of {canonical_source_file} "
+                        f"(similarity {similarity:.2f})"
+                    )
+                    continue
+
+                chunk_count = 0
+                shard_key = target_index.shard_for(core_metadata)
+                if from_store:
+                    pages = text_store.iter_pages(file_hash, core_metadata)
+                    stored_text_count += 1
+                else:
+                    pages = iter_pages(pdf_file, core_metadata)
+                    if store_writer is not None:
+                        pages = store_writer.recording(pages, file_hash)
+                pages = timings.timed_iter("parse", pages)
+                chunks = timings.timed_iter("chunk", iter_chunks(pages))
+                chunks = summaries.collecting(chunks)
+                batches = iter_batches(chunks)
+                for batch in batches:
+                    upsert_chunk_batch(
+                        target_index, pdf_file, batch, chunk_count, shard_key, timings
+                    )
+                    chunk_count += len(batch)
+
+                if not chunk_count:
+                    print(f"No text chunks generated for {pdf_file.name}. Skipping.")
+                    continue
+
+                upsert_document_summary(
+                    target_index,
+                    core_metadata,
+                    shard_key,
+                    summaries.summary(core_metadata),
+                    timings,
+                )
+                if store_writer is not None and not from_store:
+                    store_writer.commit(file_hash, core_metadata, signature)
+                dedup_index.add(core_metadata, signature)
+                shard_manifest[pdf_file.name] = shard_key
+                processed_files_set.add(pdf_file.name)
+                new_files_processed_count += 1
+                total_chunks_added_this_run += chunk_count
+                print(
+                    f"Successfully processed and added {pdf_file.name} to ChromaDB ({chunk_count} chunks)."
+                )
+
+            except Exception as e:
+                print(f"Error processing {pdf_file.name}: {e}")
+                if store_writer is not None:
+                    store_writer.discard()
+                if shard_key is not None:
+                    remove_partial_embeddings(
+                        pdf_file, target_index.collection(shard_key)
+                    )
+                    remove_partial_embeddings(
+                        pdf_file, target_index.documents_collection()
+                    )
+                    if STORE_REFERENCES:
+                        remove_partial_embeddings(
+                            pdf_file,
+                            target_index.collection(shard_key, references=True),
+                        )
+
+    if store_writer is not None:
+        store_writer.close()
+    save_processed_files_log(index_directory, processed_files_set)
+    target_index.save_manifest(shard_manifest)
+    save_duplicates_log(index_directory, duplicates)
+    dedup_index.save()
     print(
         f"\nIngestion complete. Newly processed files: {new_files_processed_count}. "
         f"Files skipped (embeddings exist): {skipped_with_embeddings_count}. "
+        f"Files skipped (near-duplicates): {skipped_duplicates_count}. "
+        f"Files read from the text store: {stored_text_count}. "
         f"Total new chunks added: {total_chunks_added_this_run}."
     )
     print(
-        f"Total documents in collection '{CHROMA_COLLECTION_NAME}': {collection.count()}"
+        f"Total documents in collection '{CHROMA_COLLECTION_NAME}' "
+        f"({len(target_index.shard_keys())} shard(s)): {target_index.count()}"
+    )
+    print(f"Peak RSS during ingestion: {peak_rss_mb():.1f} MB")
+
+
+def rebuild_shard(shard_key, timings=NULL_TIMINGS):
+    """Drops one shard and re-ingests only the files that were stored in it."""
+    with ingestion_lock(index.root):
+        _rebuild_shard(index.current(refresh=True), shard_key, timings)
+
+
+def _rebuild_shard(target_index, shard_key, timings):
+    shard_manifest = target_index.load_manifest()
+    shard_files = sorted(
+        name for name, key in shard_manifest.items() if key == shard_key
     )
+    print(f"Rebuilding shard '{shard_key}' from {len(shard_files)} files...")
+
+    target_index.drop_shard(shard_key)
+    index_directory = target_index.base_directory
+    processed_files_set = load_processed_files_log(index_directory) - set(shard_files)
+    save_processed_files_log(index_directory, processed_files_set)
+    for name in shard_files:
+        del shard_manifest[name]
+    target_index.save_manifest(shard_manifest)
+
+    ingest_pdfs([PDF_DIRECTORY / name for name in shard_files], target_index, timings)
+
+
+def print_profile_report(report, limit=10):
+    """Prints the slowest files and the time per stage of a profiled run."""
+    per_file = {}
+    per_stage = {}
+    for path, seconds in report["stages"].items():
+        file_name, *stages = path.split(";")
+        per_file[file_name] = per_file.get(file_name, 0.0) + seconds
+        stage = stages[0] if stages else "other"
+        per_stage[stage] = per_stage.get(stage, 0.0) + seconds
+
+    print(f"\nProfile {report['id']} ({report['total_seconds']:.1f}s total)")
+    print("Slowest files:")
+    for file_name, seconds in sorted(per_file.items(), key=lambda x: -x[1])[:limit]:
+        print(f"  {seconds:8.2f}s  {file_name}")
+    print("Time per stage:")
+    for stage, seconds in sorted(per_stage.items(), key=lambda x: -x[1]):
+        print(f"  {seconds:8.2f}s  {stage}")
+    print(f"Written to {PROFILE_DIRECTORY}: " + ", ".join(report["files"].values()))
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingest PDFs into ChromaDB.")
+    parser.add_argument(
+        "--rebuild-shard",
+        metavar="SHARD_KEY",
+        help="Drop one shard and re-ingest the files that belong to it.",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help=f"Record per-file stage timings and a cProfile capture in "
+        f"{PROFILE_DIRECTORY}.",
+    )
+    args = parser.parse_args()
+
     PDF_DIRECTORY.mkdir(exist_ok=True)
     CHROMA_PERSIST_DIRECTORY.mkdir(exist_ok=True)
-    ingest_pdfs()
+    session = ProfileSession("ingest") if args.profile else nullcontext()
+    with session:
+        timings = session.timings if args.profile else NULL_TIMINGS
+        if args.rebuild_shard:
+            rebuild_shard(args.rebuild_shard, timings)
+        else:
+            ingest_pdfs(timings=timings)
+    if args.profile:
+        print_profile_report(session.report)
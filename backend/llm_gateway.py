@@ -0,0 +1,393 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import deque
+
+import httpx
+
+# Fixed hedge delay in seconds. When unset, the delay tracks the
+# LLM_HEDGE_PERCENTILE of recent successful generation latencies.
+HEDGE_DELAY_SECONDS = os.getenv("LLM_HEDGE_DELAY_SECONDS")
+HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "0.95"))
+HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "true").lower() == "true"
+# Until this many latencies have been observed, DEFAULT_HEDGE_DELAY_SECONDS is used.
+HEDGE_MIN_SAMPLES = 20
+DEFAULT_HEDGE_DELAY_SECONDS = 8.0
+LATENCY_WINDOW_SIZE = 200
+
+REQUEST_TIMEOUT_SECONDS = float(os.getenv("LLM_REQUEST_TIMEOUT_SECONDS", "60"))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("LLM_BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_SECONDS = float(os.getenv("LLM_BREAKER_RESET_SECONDS", "30"))
+
+POOL_MAX_CONNECTIONS = int(os.getenv("LLM_POOL_MAX_CONNECTIONS", "32"))
+POOL_MAX_KEEPALIVE = int(os.getenv("LLM_POOL_MAX_KEEPALIVE", "16"))
+POOL_KEEPALIVE_EXPIRY_SECONDS = float(os.getenv("LLM_POOL_KEEPALIVE_EXPIRY", "120"))
+
+
+class ProviderUnavailableError(Exception):
+    """Raised without calling the provider while the circuit breaker is open."""
+
+    def __init__(self, retry_after: float):
+        super().__init__(
+            f"LLM provider is degraded. Retry after {retry_after:.0f} seconds."
+        )
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive failures and rejects calls for
+    reset_seconds. After that a single probe call is let through; its outcome
+    closes the breaker again or re-opens it.
+    """
+
+    def __init__(
+        self,
+        failure_threshold=BREAKER_FAILURE_THRESHOLD,
+        reset_seconds=BREAKER_RESET_SECONDS,
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.probe_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.reset_seconds:
+            return "open"
+        return "half_open"
+
+    def check(self):
+        """Raises while the breaker is open, without using up the half-open probe."""
+        with self._lock:
+            if self.state == "open":
+                raise ProviderUnavailableError(
+                    max(1.0, self.reset_seconds - (time.monotonic() - self.opened_at))
+                )
+
+    def before_call(self):
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return
+            if state == "half_open" and not self.probe_in_flight:
+                self.probe_in_flight = True
+                return
+            retry_after = max(
+                1.0, self.reset_seconds - (time.monotonic() - self.opened_at)
+            )
+            raise ProviderUnavailableError(retry_after)
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self.opened_at = None
+            self.probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if (
+                self.probe_in_flight
+                or self.consecutive_failures >= self.failure_threshold
+            ):
+                self.opened_at = time.monotonic()
+            self.probe_in_flight = False
+
+    def record_cancelled(self):
+        """A call abandoned by its caller neither closes nor opens the breaker."""
+        with self._lock:
+            self.probe_in_flight = False
+
+
+class LangChainChatBackend:
+    """Generation backend that calls a LangChain chat model."""
+
+    def __init__(self, llm):
+        self.llm = llm
+
+    async def agenerate(self, prompt: str) -> str:
+        response = await self.llm.ainvoke(prompt)
+        return response.content if hasattr(response, "content") else str(response)
+
+    async def astream(self, prompt: str):
+        async for chunk in self.llm.astream(prompt):
+            text = chunk.content if hasattr(chunk, "content") else str(chunk)
+            if text:
+                yield text
+
+
+class GeminiRestBackend:
+    """
+    Generation backend that calls the Gemini generateContent REST endpoint
+    over a pooled keep-alive HTTP client. Pointing base_url at a local server
+    that speaks the same API allows running the gateway against a fake LLM.
+    """
+
+    def __init__(self, model: str, api_key: str, base_url: str, temperature=0.3):
+        self.model = model
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+        self.temperature = temperature
+        self._client = None
+
+    def _get_client(self):
+        # Created lazily so the client is bound to the gateway's event loop.
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                headers={"x-goog-api-key": self.api_key},
+                timeout=httpx.Timeout(REQUEST_TIMEOUT_SECONDS, connect=5.0),
+                limits=httpx.Limits(
+                    max_connections=POOL_MAX_CONNECTIONS,
+                    max_keepalive_connections=POOL_MAX_KEEPALIVE,
+                    keepalive_expiry=POOL_KEEPALIVE_EXPIRY_SECONDS,
+                ),
+            )
+        return self._client
+
+    async def agenerate(self, prompt: str) -> str:
+        response = await self._get_client().post(
+            f"/v1beta/models/{self.model}:generateContent",
+            json=self._request_body(prompt),
+        )
+        response.raise_for_status()
+        parts = response.json()["candidates"][0]["content"]["parts"]
+        return "".join(part.get("text", "") for part in parts)
+
+    async def astream(self, prompt: str):
+        """Streams the answer from streamGenerateContent as server-sent events."""
+        async with self._get_client().stream(
+            "POST",
+            f"/v1beta/models/{self.model}:streamGenerateContent",
+            params={"alt": "sse"},
+            json=self._request_body(prompt),
+        ) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                candidates = json.loads(line[len("data:") :]).get("candidates") or []
+                if not candidates:
+                    continue
+                parts = candidates[0].get("content", {}).get("parts", [])
+                text = "".join(part.get("text", "") for part in parts)
+                if text:
+                    yield text
+
+    def _request_body(self, prompt: str) -> dict:
+        return {
+            "contents": [{"role": "user", "parts": [{"text": prompt}]}],
+            "generationConfig": {"temperature": self.temperature},
+        }
+
+
+class GenerationGateway:
+    """
+    Single entry point for LLM generations.
+
+    - Concurrent requests with the same prompt hash share one generation.
+    - If a generation is slower than the hedge delay, a duplicate request is
+      sent and whichever finishes first wins; the other one is cancelled.
+    - A circuit breaker fails fast with ProviderUnavailableError while the
+      provider is degraded.
+
+    Streamed generations (astream) go through the circuit breaker but are
+    neither coalesced nor hedged, since their output is consumed as it arrives.
+
+    All generations run on one background event loop owned by the gateway, so
+    sync and async callers share the in-flight map and the backend's
+    connection pool.
+    """
+
+    def __init__(self, backend, breaker=None, hedge_enabled=HEDGE_ENABLED):
+        self.backend = backend
+        self.breaker = breaker or CircuitBreaker()
+        self.hedge_enabled = hedge_enabled
+        self.latencies = deque(maxlen=LATENCY_WINDOW_SIZE)
+        self.stats = {
+            "requests": 0,
+            "streams": 0,
+            "coalesced": 0,
+            "hedges_sent": 0,
+            "hedge_wins": 0,
+            "failures": 0,
+            "breaker_rejections": 0,
+        }
+        self._inflight = {}
+        # Guards latencies, which are appended on the gateway loop and read
+        # from request threads.
+        self._latencies_lock = threading.Lock()
+        self._loop = None
+        self._loop_lock = threading.Lock()
+
+    def _get_loop(self):
+        with self._loop_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(
+                    target=self._loop.run_forever,
+                    name="generation-gateway",
+                    daemon=True,
+                ).start()
+            return self._loop
+
+    def generate(self, prompt: str) -> str:
+        return asyncio.run_coroutine_threadsafe(
+            self._generate(prompt), self._get_loop()
+        ).result()
+
+    async def agenerate(self, prompt: str) -> str:
+        return await asyncio.wrap_future(
+            asyncio.run_coroutine_threadsafe(self._generate(prompt), self._get_loop())
+        )
+
+    async def astream(self, prompt: str):
+        """Yields text chunks on the caller's event loop as the model produces them."""
+        queue = asyncio.Queue()
+        caller_loop = asyncio.get_running_loop()
+        end_of_stream = object()
+
+        def put(item):
+            caller_loop.call_soon_threadsafe(queue.put_nowait, item)
+
+        async def produce():
+            try:
+                async for text in self._stream_with_breaker(prompt):
+                    put(text)
+            except Exception as e:
+                put(e)
+            else:
+                put(end_of_stream)
+
+        future = asyncio.run_coroutine_threadsafe(produce(), self._get_loop())
+        try:
+            while True:
+                item = await queue.get()
+                if item is end_of_stream:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # Stops the generation when the client goes away mid-stream.
+            future.cancel()
+
+    def check_available(self):
+        """Raises ProviderUnavailableError while the circuit breaker is open."""
+        try:
+            self.breaker.check()
+        except ProviderUnavailableError:
+            self.stats["breaker_rejections"] += 1
+            raise
+
+    def hedge_delay(self):
+        if HEDGE_DELAY_SECONDS:
+            return float(HEDGE_DELAY_SECONDS)
+        with self._latencies_lock:
+            latencies = list(self.latencies)
+        if len(latencies) < HEDGE_MIN_SAMPLES:
+            return DEFAULT_HEDGE_DELAY_SECONDS
+        ordered = sorted(latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * HEDGE_PERCENTILE))
+        return ordered[index]
+
+    def metrics(self):
+        return {
+            **self.stats,
+            "inflight": len(self._inflight),
+            "hedge_delay_seconds": round(self.hedge_delay(), 3),
+            "breaker_state": self.breaker.state,
+        }
+
+    async def _generate(self, prompt: str) -> str:
+        self.stats["requests"] += 1
+        key = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._generate_with_breaker(prompt))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.stats["coalesced"] += 1
+        # Shielded so that one caller going away does not cancel the
+        # generation other callers are waiting on.
+        return await asyncio.shield(task)
+
+    async def _generate_with_breaker(self, prompt: str) -> str:
+        try:
+            self.breaker.before_call()
+        except ProviderUnavailableError:
+            self.stats["breaker_rejections"] += 1
+            raise
+
+        try:
+            result = await asyncio.wait_for(
+                self._generate_hedged(prompt), REQUEST_TIMEOUT_SECONDS
+            )
+        except Exception:
+            self.stats["failures"] += 1
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        return result
+
+    async def _stream_with_breaker(self, prompt: str):
+        self.stats["streams"] += 1
+        try:
+            self.breaker.before_call()
+        except ProviderUnavailableError:
+            self.stats["breaker_rejections"] += 1
+            raise
+
+        try:
+            async for text in self.backend.astream(prompt):
+                yield text
+        except asyncio.CancelledError:
+            self.breaker.record_cancelled()
+            raise
+        except Exception:
+            self.stats["failures"] += 1
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+
+    async def _timed_call(self, prompt: str) -> str:
+        start = time.monotonic()
+        result = await self.backend.agenerate(prompt)
+        with self._latencies_lock:
+            self.latencies.append(time.monotonic() - start)
+        return result
+
+    async def _generate_hedged(self, prompt: str) -> str:
+        primary = asyncio.ensure_future(self._timed_call(prompt))
+        pending = {primary}
+        try:
+            if self.hedge_enabled:
+                done, _ = await asyncio.wait(pending, timeout=self.hedge_delay())
+                if not done:
+                    self.stats["hedges_sent"] += 1
+                    pending.add(asyncio.ensure_future(self._timed_call(prompt)))
+
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            self.stats["hedge_wins"] += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
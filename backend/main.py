@@ -1,19 +1,66 @@
+import asyncio
+import json
 import os
+import secrets
+import threading
 from contextlib import asynccontextmanager
 
 import uvicorn
+from admission import (
+    BATCH,
+    INGEST_BURST,
+    INGEST_RATE_PER_SECOND,
+    INTERACTIVE,
+    AdmissionController,
+    AdmissionRejected,
+    CachedReadiness,
+    RateLimiter,
+    client_id,
+)
 from dotenv import load_dotenv
-from fastapi import BackgroundTasks, FastAPI, HTTPException
+from fastapi import BackgroundTasks, FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from ingestion import CHROMA_PERSIST_DIRECTORY, PDF_DIRECTORY, ingest_pdfs
+from fastapi.responses import FileResponse, StreamingResponse
+from ingestion import (
+    CHROMA_COLLECTION_NAME,
+    CHROMA_PERSIST_DIRECTORY,
+    PDF_DIRECTORY,
+    ingest_pdfs,
+)
 from ingestion import (
-    collection as chroma_collection,
+    index as chroma_index,
 )
+from llm_gateway import ProviderUnavailableError
+from profiling import PROFILE_DIRECTORY, profile_call
 from pydantic import BaseModel
-from rag_pipeline import final_rag_chain
+from query_cache import load_warmup_queries
+from rag_pipeline import (
+    aanswer_query,
+    answer_query,
+    astream_answer,
+    embeddings,
+    generation_gateway,
+    sessions,
+)
+from starlette.background import BackgroundTask
+from watcher import PdfWatcher
 
 load_dotenv()
 
+chat_rate_limiter = RateLimiter()
+ingest_rate_limiter = RateLimiter(rate=INGEST_RATE_PER_SECOND, burst=INGEST_BURST)
+admission = AdmissionController()
+# Chat requests read this instead of counting the index on every request.
+index_readiness = CachedReadiness(lambda: chroma_index.count() > 0)
+ingestion_lock = threading.Lock()
+# Ingest PDFs as soon as the downloader finishes them (see watcher.py).
+INGEST_WATCH = os.getenv("INGEST_WATCH", "true").lower() == "true"
+# Requests carrying this token in an X-Profile header or a ?profile= parameter
+# are profiled. Without a token, profiling is only offered in development and
+# to clients on this machine.
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN")
+LOOPBACK_ADDRESSES = {"127.0.0.1", "::1"}
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -27,14 +74,15 @@ async def lifespan(app: FastAPI):
         print(f"Created CHROMA_PERSIST_DIRECTORY at {CHROMA_PERSIST_DIRECTORY}")
 
     try:
-        if not CHROMA_PERSIST_DIRECTORY.exists() or chroma_collection.count() == 0:
+        if not CHROMA_PERSIST_DIRECTORY.exists() or chroma_index.count() == 0:
             print(
                 "WARNING: ChromaDB might be empty or not initialized. "
                 "Consider running ingestion or using the /ingest endpoint."
             )
         else:
             print(
-                f"ChromaDB collection '{chroma_collection.name}' loaded with {chroma_collection.count()} documents."
+                f"ChromaDB collection '{CHROMA_COLLECTION_NAME}' loaded with {chroma_index.count()} documents "
+                f"across {len(chroma_index.shard_keys())} shard(s)."
             )
     except Exception as e:
         print(
@@ -44,12 +92,40 @@ async def lifespan(app: FastAPI):
             "Consider running ingestion.py script first or using the /ingest endpoint."
         )
 
+    await asyncio.to_thread(index_readiness.refresh)
+    warmup_task = asyncio.create_task(warm_up_query_cache())
+    readiness_task = asyncio.create_task(index_readiness.run())
+    watch_stop_event = threading.Event()
+    if INGEST_WATCH:
+        threading.Thread(
+            target=PdfWatcher(PDF_DIRECTORY, ingest_watched_files).run,
+            args=(watch_stop_event,),
+            name="pdf-watcher",
+            daemon=True,
+        ).start()
+
     print("FastAPI application started successfully.")
     yield
+    warmup_task.cancel()
+    readiness_task.cancel()
+    watch_stop_event.set()
     print("FastAPI application lifespan: shutdown sequence.")
     print("FastAPI application shutdown complete.")
 
 
+async def warm_up_query_cache():
+    queries = load_warmup_queries()
+    if not queries:
+        return
+    try:
+        embedded = await asyncio.to_thread(embeddings.warm_up, queries)
+        print(
+            f"Query embedding cache warmed up: {embedded} new of {len(queries)} queries."
+        )
+    except Exception as e:
+        print(f"Error warming up query embedding cache: {e}")
+
+
 app = FastAPI(
     title="Scientific PDF RAG Chat API",
     description="Chat with your scientific PDF documents using Gemini, Langchain, and ChromaDB.",
@@ -86,10 +162,37 @@ app.add_middleware(
 
 class QueryRequest(BaseModel):
     query: str
+    # Returned by a previous /chat call; follow-ups reuse its retrieved chunks.
+    session_id: str | None = None
+
+
+class CitedChunk(BaseModel):
+    id: str
+    page: int | str
+    section: str | None = None
+    distance: float | None = None
+
+
+class Citation(BaseModel):
+    number: int
+    title: str
+    doi: str
+    url: str
+    source_file: str
+    pages: list[int | str]
+    chunks: list[CitedChunk] = []
 
 
 class QueryResponse(BaseModel):
     answer: str
+    citations: list[Citation] = []
+    session_id: str | None = None
+    # "search", "reuse" (no index search) or "extend" for follow-ups.
+    retrieval: str | None = None
+    # Shards that could not be searched; the answer is based on partial results.
+    failed_shards: list[str] = []
+    # Stage timings and top functions when the request asked for profiling.
+    profile: dict | None = None
 
 
 class IngestResponse(BaseModel):
@@ -102,18 +205,29 @@ class IngestResponse(BaseModel):
     response_model=IngestResponse,
     summary="Ingest PDFs from the pdf_documents folder",
 )
-async def ingest_documents_endpoint(background_tasks: BackgroundTasks):
+async def ingest_documents_endpoint(
+    background_tasks: BackgroundTasks, http_request: Request
+):
     print("Received request to start PDF ingestion...")
+    try:
+        ingest_rate_limiter.check(client_id_for(http_request))
+    except AdmissionRejected as e:
+        raise admission_rejected(e)
+
     if not PDF_DIRECTORY.exists() or not any(PDF_DIRECTORY.glob("*.pdf")):
         return IngestResponse(
             message=f"No PDFs found in {PDF_DIRECTORY} or directory does not exist. Ingestion skipped."
         )
+    if ingestion_lock.locked():
+        return IngestResponse(
+            message="An ingestion run is already in progress. Check server logs for progress."
+        )
 
-    background_tasks.add_task(ingest_pdfs)
+    background_tasks.add_task(run_ingestion)
 
     current_count = 0
     try:
-        current_count = chroma_collection.count()
+        current_count = chroma_index.count()
     except Exception as e:
         print(f"Could not get collection count during ingest request: {e}")
 
@@ -123,35 +237,126 @@ async def ingest_documents_endpoint(background_tasks: BackgroundTasks):
     )
 
 
+def run_ingestion():
+    # One run at a time; the readiness state is refreshed once it finishes.
+    if not ingestion_lock.acquire(blocking=False):
+        print("An ingestion run is already in progress, skipping.")
+        return
+    try:
+        ingest_pdfs()
+    finally:
+        ingestion_lock.release()
+        index_readiness.refresh()
+
+
+def ingest_watched_files(pdf_files):
+    # Waits for a running /ingest run instead of skipping the new files.
+    with ingestion_lock:
+        ingest_pdfs(pdf_files)
+    index_readiness.refresh()
+
+
+def check_index_ready():
+    if index_readiness.ready:
+        return
+    if index_readiness.error is not None:
+        raise HTTPException(
+            status_code=503,
+            detail="Service temporarily unavailable. Database may not be ready. Please try again shortly or ingest documents.",
+            headers={"Retry-After": str(int(index_readiness.refresh_seconds))},
+        )
+    raise HTTPException(
+        status_code=503,
+        detail="Vector database is empty. Please ingest documents first using the /ingest endpoint.",
+    )
+
+
+def client_id_for(http_request: Request) -> str:
+    # The Flask frontend forwards the browser's address in X-Client-Id.
+    return client_id(
+        http_request.client.host if http_request.client else None,
+        http_request.headers.get("x-client-id"),
+        http_request.headers.get("x-proxy-secret"),
+    )
+
+
+def priority_for(http_request: Request) -> str:
+    if http_request.headers.get("x-request-priority", "").lower() == BATCH:
+        return BATCH
+    return INTERACTIVE
+
+
+async def admit_chat(http_request: Request):
+    """Rate-limits the client and waits for a serving slot; returns the ticket."""
+    try:
+        chat_rate_limiter.check(client_id_for(http_request))
+        return await admission.acquire(priority_for(http_request))
+    except AdmissionRejected as e:
+        raise admission_rejected(e)
+
+
+def wants_profile(http_request: Request) -> bool:
+    value = http_request.headers.get("x-profile") or http_request.query_params.get(
+        "profile"
+    )
+    if not value:
+        return False
+    if PROFILE_TOKEN:
+        return secrets.compare_digest(value, PROFILE_TOKEN)
+    client_host = http_request.client.host if http_request.client else None
+    return IS_DEVELOPMENT and client_host in LOOPBACK_ADDRESSES
+
+
+def admission_rejected(e: AdmissionRejected) -> HTTPException:
+    if e.status_code == 429:
+        detail = "Too many requests. Please slow down and try again shortly."
+    else:
+        detail = "The server is busy. Please try again shortly."
+    return HTTPException(
+        status_code=e.status_code,
+        detail=detail,
+        headers={"Retry-After": str(int(e.retry_after))},
+    )
+
+
+def provider_unavailable(e: ProviderUnavailableError) -> HTTPException:
+    return HTTPException(
+        status_code=503,
+        detail="The language model provider is temporarily unavailable. Please try again shortly.",
+        headers={"Retry-After": str(int(e.retry_after))},
+    )
+
+
 @app.post(
     "/chat",
     response_model=QueryResponse,
     summary="Ask a question about the indexed PDFs",
 )
-async def chat_with_pdfs(request: QueryRequest):
+async def chat_with_pdfs(request: QueryRequest, http_request: Request):
     if not request.query or not request.query.strip():
         raise HTTPException(status_code=400, detail="Query cannot be empty.")
 
-    try:
-        if chroma_collection.count() == 0:
-            raise HTTPException(
-                status_code=503,
-                detail="Vector database is empty. Please ingest documents first using the /ingest endpoint.",
-            )
-    except Exception as e:
-        print(f"Error checking ChromaDB collection count: {e}")
-        raise HTTPException(
-            status_code=503,
-            detail="Service temporarily unavailable. Database may not be ready. Please try again shortly or ingest documents.",
-        )
+    check_index_ready()
+    ticket = await admit_chat(http_request)
 
     try:
         print(f"Received query: '{request.query}'")
-        answer = final_rag_chain.invoke(request.query)
-        print(f"Generated answer snippet: {answer[:200]}...")
-        return QueryResponse(answer=answer)
+        if wants_profile(http_request):
+            # Runs the whole pipeline on one worker thread so that the profile
+            # covers this request only.
+            result, profile = await asyncio.to_thread(
+                profile_call, "chat", answer_query, request.query, request.session_id
+            )
+            result["profile"] = profile
+            print(f"Profiled query: {profile['id']} ({profile['total_seconds']}s)")
+        else:
+            result = await aanswer_query(request.query, request.session_id)
+        print(f"Generated answer snippet: {result['answer'][:200]}...")
+        return QueryResponse(**result)
     except HTTPException:
         raise
+    except ProviderUnavailableError as e:
+        raise provider_unavailable(e)
     except Exception as e:
         print(f"Error during RAG chain invocation: {e}")
         import traceback
@@ -161,6 +366,89 @@ async def chat_with_pdfs(request: QueryRequest):
             status_code=500,
             detail="Error processing your query: An internal server error occurred.",
         )
+    finally:
+        admission.release(ticket)
+
+
+@app.post(
+    "/chat/stream",
+    summary="Ask a question and stream the answer as newline-delimited JSON",
+)
+async def chat_with_pdfs_stream(request: QueryRequest, http_request: Request):
+    """
+    Streams a {"type": "session", ...} line with the session ID, then
+    {"type": "token", "text": ...} lines while the answer is generated,
+    followed by one {"type": "references", ...} line with the references
+    markdown and structured citations, so clients can render the references
+    as soon as generation ends.
+    """
+    if not request.query or not request.query.strip():
+        raise HTTPException(status_code=400, detail="Query cannot be empty.")
+    check_index_ready()
+    try:
+        generation_gateway.check_available()
+    except ProviderUnavailableError as e:
+        raise provider_unavailable(e)
+    ticket = await admit_chat(http_request)
+    released = False
+
+    def release():
+        # Called when the stream ends and again by the response's background
+        # task, which also covers clients that disconnect before streaming.
+        nonlocal released
+        if not released:
+            released = True
+            admission.release(ticket)
+
+    async def release_after_response():
+        release()
+
+    async def events():
+        try:
+            async for event in astream_answer(request.query, request.session_id):
+                yield json.dumps(event) + "\n"
+        except ProviderUnavailableError as e:
+            yield json.dumps(
+                {"type": "error", "status": 503, "retry_after": int(e.retry_after)}
+            ) + "\n"
+        except Exception as e:
+            print(f"Error during streamed RAG chain invocation: {e}")
+            yield json.dumps(
+                {
+                    "type": "error",
+                    "status": 500,
+                    "detail": "An internal server error occurred.",
+                }
+            ) + "\n"
+        finally:
+            release()
+
+    return StreamingResponse(
+        events(),
+        media_type="application/x-ndjson",
+        background=BackgroundTask(release_after_response),
+    )
+
+
+@app.get("/profiles/{file_name}", summary="Download a file written by a profiled run")
+async def download_profile(file_name: str, http_request: Request):
+    if not wants_profile(http_request):
+        raise HTTPException(status_code=404, detail="Not found.")
+    path = PROFILE_DIRECTORY / file_name
+    if file_name != path.name or not path.is_file():
+        raise HTTPException(status_code=404, detail="Not found.")
+    return FileResponse(path)
+
+
+@app.get("/metrics", summary="Cache, session, admission and generation gateway metrics")
+async def metrics():
+    return {
+        "query_embedding_cache": embeddings.metrics(),
+        "generation_gateway": generation_gateway.metrics(),
+        "sessions": sessions.metrics(),
+        "admission": admission.metrics(),
+        "index_ready": index_readiness.ready,
+    }
 
 
 @app.get("/", summary="Root endpoint to check if API is running")
@@ -0,0 +1,5 @@
+"""Markers of downloaded PDFs, shared by the watcher and the pre-scan."""
+
+# aria2c keeps a <file>.aria2 control file next to a download until it is done.
+ARIA2_CONTROL_SUFFIX = ".aria2"
+PDF_MAGIC = b"%PDF-"
@@ -0,0 +1,220 @@
+"""
+Integrity pre-scan of downloaded PDFs.
+
+Before ingestion, every new PDF is checked in a worker process of its own,
+each check bounded by PRESCAN_TIMEOUT_SECONDS:
+
+- a "%PDF-" header and a "%%EOF" trailer (aria2c leaves truncated files
+  behind when a download fails);
+- PyMuPDF opens it, it needs no password and it has pages;
+- its first pages have a text layer.
+
+Broken files are moved to PDF_QUARANTINE_DIRECTORY and scanned-image PDFs to
+PDF_OCR_DIRECTORY, each with a line in that directory's reasons.jsonl, so
+ingestion only sees files it can parse and never retries the others. A check
+that times out or whose worker crashes gives no verdict: the file stays where
+it is, is skipped by this ingestion run and is checked again by the next one.
+
+    python prescan.py             # scan pdf_documents and move bad files
+    python prescan.py --dry-run   # only report
+
+Workers run this file with --check rather than multiprocessing: forking the
+multithreaded API server is unsafe, and spawned multiprocessing workers
+would import its main module again.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import fitz
+from pdf_files import ARIA2_CONTROL_SUFFIX, PDF_MAGIC
+
+PRESCAN_ENABLED = os.getenv("PRESCAN_ENABLED", "true").lower() == "true"
+PRESCAN_WORKERS = int(os.getenv("PRESCAN_WORKERS", str(min(8, os.cpu_count() or 1))))
+PRESCAN_TIMEOUT_SECONDS = float(os.getenv("PRESCAN_TIMEOUT_SECONDS", "20"))
+QUARANTINE_DIRECTORY = Path(os.getenv("PDF_QUARANTINE_DIRECTORY", "pdf_quarantine"))
+OCR_DIRECTORY = Path(os.getenv("PDF_OCR_DIRECTORY", "pdf_ocr_queue"))
+# PDFs with fewer characters of text than this on their first TEXT_CHECK_PAGES
+# pages are treated as scanned images.
+MIN_TEXT_CHARS = int(os.getenv("PRESCAN_MIN_TEXT_CHARS", "200"))
+TEXT_CHECK_PAGES = 3
+# The header may follow up to 1 KB of junk; the trailer sits at the very end.
+HEADER_SEARCH_BYTES = 1024
+TRAILER_SEARCH_BYTES = 2048
+PDF_TRAILER = b"%%EOF"
+REASONS_LOG_NAME = "reasons.jsonl"
+
+OK = "ok"
+QUARANTINE = "quarantine"
+OCR = "ocr"
+# No verdict: the check timed out or its worker failed.
+RETRY = "retry"
+
+
+def check_pdf(path: Path):
+    """Returns (verdict, reason) for one PDF."""
+    try:
+        size = path.stat().st_size
+        with open(path, "rb") as f:
+            head = f.read(HEADER_SEARCH_BYTES)
+            f.seek(max(0, size - TRAILER_SEARCH_BYTES))
+            tail = f.read()
+    except OSError as e:
+        return QUARANTINE, f"unreadable: {e}"
+    if size == 0:
+        return QUARANTINE, "empty file"
+    if PDF_MAGIC not in head:
+        return QUARANTINE, "no PDF header"
+    if PDF_TRAILER not in tail:
+        return QUARANTINE, "no %%EOF trailer, probably a truncated download"
+
+    try:
+        with fitz.open(path) as doc:
+            if doc.needs_pass:
+                return QUARANTINE, "encrypted"
+            if doc.page_count == 0:
+                return QUARANTINE, "no pages"
+            text_chars = sum(
+                len(doc.load_page(i).get_text("text").strip())
+                for i in range(min(TEXT_CHECK_PAGES, doc.page_count))
+            )
+    except Exception as e:
+        return QUARANTINE, f"cannot be opened: {e}"
+    if text_chars < MIN_TEXT_CHARS:
+        return OCR, f"no text layer ({text_chars} characters on the first pages)"
+    return OK, ""
+
+
+def _check_in_worker(path: Path, timeout: float):
+    """check_pdf(path) in a new process, which is killed at the timeout."""
+    command = [sys.executable, str(Path(__file__).resolve()), "--check", str(path)]
+    try:
+        completed = subprocess.run(
+            command, capture_output=True, text=True, timeout=timeout
+        )
+    except subprocess.TimeoutExpired:
+        # Possibly a slow disk or an overloaded host rather than the file.
+        return RETRY, f"check timed out after {timeout:g}s"
+    lines = completed.stdout.strip().splitlines()
+    if completed.returncode != 0 or not lines:
+        # A crash inside MuPDF takes only the worker down.
+        return RETRY, f"check failed with exit code {completed.returncode}"
+    # The verdict is the last line; MuPDF may print warnings before it.
+    try:
+        verdict, reason = json.loads(lines[-1])
+    except (ValueError, TypeError):
+        return RETRY, f"check printed no verdict: {lines[-1][:200]!r}"
+    if verdict not in (OK, QUARANTINE, OCR):
+        return RETRY, f"check printed an unknown verdict {verdict!r}"
+    return verdict, reason
+
+
+def scan(pdf_files, workers=PRESCAN_WORKERS, timeout=PRESCAN_TIMEOUT_SECONDS):
+    """
+    Checks pdf_files in up to `workers` processes at a time and returns
+    {path: (verdict, reason)}. A check still running after `timeout` seconds
+    is killed and reported with the RETRY verdict.
+    """
+    if not pdf_files:
+        return {}
+    with ThreadPoolExecutor(
+        max_workers=min(workers, len(pdf_files)), thread_name_prefix="prescan"
+    ) as executor:
+        verdicts = executor.map(lambda path: _check_in_worker(path, timeout), pdf_files)
+        return dict(zip(pdf_files, verdicts))
+
+
+def set_aside(path: Path, directory: Path, reason: str):
+    """Moves path into directory and logs why."""
+    directory.mkdir(parents=True, exist_ok=True)
+    size = path.stat().st_size
+    target = directory / path.name
+    if target.exists():
+        target = directory / f"{path.stem}-{time.strftime('%Y%m%dT%H%M%S')}.pdf"
+    shutil.move(str(path), str(target))
+    with open(directory / REASONS_LOG_NAME, "a") as f:
+        entry = {
+            "file": path.name,
+            "moved_to": target.name,
+            "reason": reason,
+            "size": size,
+            "scanned_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+        f.write(json.dumps(entry) + "\n")
+
+
+def prescan_pdfs(pdf_files, move: bool = True):
+    """
+    Returns the PDFs that passed the checks. The others are moved to the
+    quarantine or OCR directory unless move is False. Files that aria2c is
+    still downloading and files without a verdict are left alone and not
+    returned, so that they are checked again next time.
+    """
+    candidates = []
+    for path in pdf_files:
+        if Path(f"{path}{ARIA2_CONTROL_SUFFIX}").exists():
+            print(f"Skipping {path.name}: download in progress.")
+            continue
+        candidates.append(path)
+    if not candidates:
+        return []
+
+    start = time.monotonic()
+    results = scan(candidates)
+    counts = Counter()
+    passed = []
+    for path in candidates:
+        verdict, reason = results[path]
+        counts[verdict] += 1
+        if verdict == OK:
+            passed.append(path)
+            continue
+        if verdict == RETRY:
+            print(f"Checking {path.name} again later: {reason}")
+            continue
+        if verdict == OCR:
+            print(f"Queueing {path.name} for OCR: {reason}")
+            directory = OCR_DIRECTORY
+        else:
+            print(f"Quarantining {path.name}: {reason}")
+            directory = QUARANTINE_DIRECTORY
+        if move:
+            try:
+                set_aside(path, directory, reason)
+            except OSError as e:
+                print(f"Error moving {path.name} to {directory}: {e}")
+    print(
+        f"Pre-scanned {len(candidates)} PDF(s) in {time.monotonic() - start:.1f}s: "
+        f"{counts[OK]} ok, {counts[QUARANTINE]} quarantined, "
+        f"{counts[OCR]} queued for OCR, {counts[RETRY]} left for a later run."
+    )
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Integrity pre-scan of PDFs.")
+    parser.add_argument("--directory", type=Path, default=Path("pdf_documents"))
+    parser.add_argument(
+        "--check", type=Path, help="Check one PDF and print the verdict as JSON."
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="Report without moving files."
+    )
+    args = parser.parse_args()
+
+    if args.check:
+        print(json.dumps(check_pdf(args.check)))
+        return
+    prescan_pdfs(sorted(args.directory.glob("*.pdf")), move=not args.dry_run)
+
+
+if __name__ == "__main__":
+    main()
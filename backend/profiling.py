@@ -0,0 +1,230 @@
+"""
+Opt-in profiling for chat requests and ingestion runs.
+
+A profiled run records:
+
+- stage timings: exclusive wall-clock time per nested stage (for example
+  "paper.pdf;chunk;parse"), also written as folded stacks;
+- a cProfile capture of the profiled thread, written in pstats format;
+- sampled Python stacks of the profiled thread, written as folded stacks.
+
+Folded files can be fed to flamegraph.pl or loaded into speedscope. Nothing
+here runs unless profiling was requested: callers use NULL_TIMINGS otherwise.
+"""
+
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+
+PROFILE_DIRECTORY = Path(os.getenv("PROFILE_DIRECTORY", "profiles"))
+SAMPLE_INTERVAL_SECONDS = float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.005"))
+# Older profiles are deleted when a new one is written: only the newest
+# PROFILE_KEEP are kept, and none older than PROFILE_MAX_AGE_DAYS (0 = no limit).
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "100"))
+PROFILE_MAX_AGE_DAYS = float(os.getenv("PROFILE_MAX_AGE_DAYS", "14"))
+TOP_FUNCTIONS = 20
+
+
+class StageTimings:
+    """
+    Exclusive wall-clock time per stage path. Time spent in a nested stage is
+    not counted towards its parent, so the times of all paths add up to the
+    total and map directly to a flame graph.
+    """
+
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self._stack = []
+        self._resumed_at = None
+
+    def _credit(self, now):
+        if self._stack:
+            self.seconds[tuple(self._stack)] += now - self._resumed_at
+        self._resumed_at = now
+
+    @contextmanager
+    def stage(self, name: str):
+        self._credit(time.perf_counter())
+        self._stack.append(name)
+        try:
+            yield
+        finally:
+            self._credit(time.perf_counter())
+            self._stack.pop()
+
+    def timed_iter(self, name: str, iterable):
+        """Counts the time spent producing each item of iterable as stage name."""
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def by_path(self):
+        return {";".join(path): round(s, 6) for path, s in self.seconds.items()}
+
+    def folded(self) -> str:
+        """Folded stacks with microsecond weights."""
+        return "".join(
+            f"{';'.join(path)} {int(s * 1e6)}\n"
+            for path, s in sorted(self.seconds.items())
+            if s > 0
+        )
+
+
+class _NullTimings:
+    """Stand-in for StageTimings when profiling is off."""
+
+    def stage(self, name: str):
+        return nullcontext()
+
+    def timed_iter(self, name: str, iterable):
+        return iterable
+
+
+NULL_TIMINGS = _NullTimings()
+
+
+class StackSampler:
+    """Samples the Python stack of one thread at a fixed interval."""
+
+    def __init__(self, thread_id: int, interval: float = SAMPLE_INTERVAL_SECONDS):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="stack-sampler", daemon=True
+        )
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                location = f"{Path(code.co_filename).name}:{code.co_firstlineno}"
+                names.append(f"{code.co_name} ({location})")
+                frame = frame.f_back
+            if names:
+                self.stacks[";".join(reversed(names))] += 1
+
+    def folded(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.items())
+
+
+def top_functions(profile: cProfile.Profile, limit: int = TOP_FUNCTIONS):
+    stats = pstats.Stats(profile, stream=io.StringIO())
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)
+    return [
+        {
+            "function": f"{name} ({Path(filename).name}:{line})",
+            "calls": calls,
+            "own_seconds": round(own, 6),
+            "cumulative_seconds": round(cumulative, 6),
+        }
+        for (filename, line, name), (_, calls, own, cumulative, _) in rows[:limit]
+    ]
+
+
+def prune_profiles(directory: Path, keep=None, max_age_days=None):
+    """
+    Deletes all files of profiles beyond the newest `keep` or older than
+    max_age_days. Returns the IDs of the deleted profiles.
+    """
+    keep = PROFILE_KEEP if keep is None else keep
+    max_age_days = PROFILE_MAX_AGE_DAYS if max_age_days is None else max_age_days
+    reports = []
+    for report_path in directory.glob("*.json"):
+        try:
+            reports.append((report_path.stat().st_mtime, report_path.stem))
+        except FileNotFoundError:
+            continue
+    reports.sort(reverse=True)
+
+    oldest_kept = time.time() - max_age_days * 86400 if max_age_days > 0 else None
+    removed = []
+    for position, (modified, profile_id) in enumerate(reports):
+        if position < keep and (oldest_kept is None or modified >= oldest_kept):
+            continue
+        for path in directory.glob(f"{profile_id}.*"):
+            path.unlink(missing_ok=True)
+        removed.append(profile_id)
+    return removed
+
+
+class ProfileSession:
+    """
+    Profiles the current thread while active and writes the results to
+    <directory>/<name>-<id>.{prof,stacks.folded,stages.folded,json}.
+    """
+
+    def __init__(self, name: str, directory: Path = PROFILE_DIRECTORY):
+        timestamp = time.strftime("%Y%m%dT%H%M%S")
+        self.profile_id = f"{name}-{timestamp}-{uuid.uuid4().hex[:8]}"
+        self.directory = directory
+        self.timings = StageTimings()
+        self.profile = cProfile.Profile()
+        self.sampler = StackSampler(threading.get_ident())
+        self.report = None
+
+    def __enter__(self):
+        self._started_at = time.perf_counter()
+        self.sampler.start()
+        self.profile.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profile.disable()
+        self.sampler.stop()
+        total_seconds = time.perf_counter() - self._started_at
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        files = {
+            "pstats": f"{self.profile_id}.prof",
+            "stacks_folded": f"{self.profile_id}.stacks.folded",
+            "stages_folded": f"{self.profile_id}.stages.folded",
+        }
+        self.profile.dump_stats(self.directory / files["pstats"])
+        (self.directory / files["stacks_folded"]).write_text(self.sampler.folded())
+        (self.directory / files["stages_folded"]).write_text(self.timings.folded())
+        self.report = {
+            "id": self.profile_id,
+            "total_seconds": round(total_seconds, 6),
+            "stages": self.timings.by_path(),
+            "top_functions": top_functions(self.profile),
+            "files": files,
+        }
+        report_path = self.directory / f"{self.profile_id}.json"
+        report_path.write_text(json.dumps(self.report, indent=2))
+        prune_profiles(self.directory)
+        return False
+
+
+def profile_call(name: str, fn, *args, **kwargs):
+    """
+    Runs fn(*args, timings=..., **kwargs) under a ProfileSession on the calling
+    thread. Returns (result, report).
+    """
+    with ProfileSession(name) as session:
+        result = fn(*args, timings=session.timings, **kwargs)
+    return result, session.report
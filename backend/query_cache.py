@@ -0,0 +1,150 @@
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from langchain_core.embeddings import Embeddings
+
+MEMORY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_MEMORY_ENTRIES", "2048"))
+WARMUP_QUERIES_FILE = Path(os.getenv("QUERY_WARMUP_FILE", "warmup_queries.txt"))
+WARMUP_CONCURRENCY = 4
+
+_WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+def normalize_query(text: str) -> str:
+    text = unicodedata.normalize("NFKC", text).lower()
+    return _WHITESPACE_PATTERN.sub(" ", text).strip().rstrip("?!. ")
+
+
+class CachedQueryEmbeddings(Embeddings):
+    """
+    Wraps an Embeddings instance with an in-process LRU and an on-disk SQLite
+    cache for query embeddings, keyed by normalized query text. Entries are
+    namespaced so that vectors from different embedding models never mix.
+    Document embeddings are passed through uncached.
+    """
+
+    def __init__(self, embeddings: Embeddings, cache_path: Path, namespace: str):
+        self.embeddings = embeddings
+        self.namespace = namespace
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(cache_path), check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS query_embeddings ("
+            "namespace TEXT NOT NULL, query TEXT NOT NULL, embedding BLOB NOT NULL, "
+            "PRIMARY KEY (namespace, query))"
+        )
+        self._db.commit()
+
+    def embed_documents(self, texts):
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text):
+        key = normalize_query(text)
+        cached = self._lookup(key)
+        if cached is not None:
+            return cached
+
+        with self._lock:
+            self.stats["misses"] += 1
+        embedding = self.embeddings.embed_query(text)
+        self._store(key, embedding)
+        return embedding
+
+    def _lookup(self, key):
+        with self._lock:
+            embedding = self._memory.get(key)
+            if embedding is not None:
+                self._memory.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return embedding
+
+            row = self._db.execute(
+                "SELECT embedding FROM query_embeddings WHERE namespace = ? AND query = ?",
+                (self.namespace, key),
+            ).fetchone()
+            if row is None:
+                return None
+            embedding = array("f", row[0]).tolist()
+            self.stats["disk_hits"] += 1
+            self._remember(key, embedding)
+            return embedding
+
+    def _contains(self, key):
+        """Like _lookup, but leaves the hit/miss stats and the LRU order alone."""
+        with self._lock:
+            if key in self._memory:
+                return True
+            return (
+                self._db.execute(
+                    "SELECT 1 FROM query_embeddings WHERE namespace = ? AND query = ?",
+                    (self.namespace, key),
+                ).fetchone()
+                is not None
+            )
+
+    def _store(self, key, embedding):
+        with self._lock:
+            self._remember(key, embedding)
+            self._db.execute(
+                "INSERT OR REPLACE INTO query_embeddings VALUES (?, ?, ?)",
+                (self.namespace, key, array("f", embedding).tobytes()),
+            )
+            self._db.commit()
+
+    def _remember(self, key, embedding):
+        self._memory[key] = embedding
+        self._memory.move_to_end(key)
+        while len(self._memory) > MEMORY_CACHE_SIZE:
+            self._memory.popitem(last=False)
+
+    def warm_up(self, queries):
+        """Embeds every query not cached yet. Returns the number embedded."""
+        missing = []
+        seen = set()
+        for query in queries:
+            key = normalize_query(query)
+            if key and key not in seen and not self._contains(key):
+                seen.add(key)
+                missing.append(query)
+
+        with ThreadPoolExecutor(max_workers=WARMUP_CONCURRENCY) as executor:
+            for query, embedding in zip(
+                missing, executor.map(self.embeddings.embed_query, missing)
+            ):
+                self._store(normalize_query(query), embedding)
+        return len(missing)
+
+    def metrics(self):
+        with self._lock:
+            lookups = sum(self.stats.values())
+            hits = self.stats["memory_hits"] + self.stats["disk_hits"]
+            disk_entries = self._db.execute(
+                "SELECT COUNT(*) FROM query_embeddings WHERE namespace = ?",
+                (self.namespace,),
+            ).fetchone()[0]
+            return {
+                **self.stats,
+                "hit_rate": round(hits / lookups, 3) if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "disk_entries": disk_entries,
+            }
+
+
+def load_warmup_queries(path: Path = WARMUP_QUERIES_FILE):
+    if not path.exists():
+        return []
+    with open(path, "r", encoding="utf-8") as f:
+        return [
+            line.strip() for line in f if line.strip() and not line.startswith("#")
+        ]
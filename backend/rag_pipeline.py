@@ -1,15 +1,20 @@
+import asyncio
 import os
-import re
 from pathlib import Path
 
-import chromadb
 from dotenv import load_dotenv
+from embedding_providers import create_embeddings, embedding_model_id
+from index_versions import ServingIndex
 from langchain.prompts import PromptTemplate
-from langchain_chroma import Chroma
-from langchain_core.output_parsers import StrOutputParser
 from langchain_core.runnables import RunnableLambda, RunnablePassthrough
-from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
+from langchain_google_genai import ChatGoogleGenerativeAI
+from llm_gateway import GeminiRestBackend, GenerationGateway, LangChainChatBackend
+from profiling import NULL_TIMINGS
 from pydantic import SecretStr
+from query_cache import CachedQueryEmbeddings
+from response_formatting import IncrementalAnswerFormatter, format_answer
+from sessions import SessionStore
+from sharding import ShardedRetriever, hit_to_document
 from utils import construct_nature_url_from_doi
 
 load_dotenv()
@@ -22,26 +27,48 @@ if not GOOGLE_API_KEY:
 CHROMA_PERSIST_DIRECTORY = Path("chroma_db")
 CHROMA_COLLECTION_NAME = "scientific_articles"
 
-EMBEDDING_MODEL_NAME = "models/text-embedding-004"
-embeddings = GoogleGenerativeAIEmbeddings(
-    model=EMBEDDING_MODEL_NAME, google_api_key=SecretStr(GOOGLE_API_KEY)
-)
+QUERY_CACHE_PATH = CHROMA_PERSIST_DIRECTORY / "query_embeddings.sqlite"
 
 LLM_MODEL_NAME = "gemini-2.5-flash-preview-05-20"
+# "rest" calls the Gemini REST API directly over a pooled keep-alive HTTP client
+# at LLM_API_BASE_URL; "langchain" calls the model through ChatGoogleGenerativeAI.
+LLM_TRANSPORT = os.getenv("LLM_TRANSPORT", "rest").lower()
+LLM_API_BASE_URL = os.getenv(
+    "LLM_API_BASE_URL", "https://generativelanguage.googleapis.com"
+)
 
-embeddings = GoogleGenerativeAIEmbeddings(
-    model=EMBEDDING_MODEL_NAME, google_api_key=SecretStr(GOOGLE_API_KEY)
+# Query embeddings are served from cache when possible, so repeated queries
+# reach Chroma without a round trip to the embedding API.
+embeddings = CachedQueryEmbeddings(
+    create_embeddings(),
+    cache_path=QUERY_CACHE_PATH,
+    namespace=embedding_model_id(),
 )
 llm = ChatGoogleGenerativeAI(
-    model=LLM_MODEL_NAME, google_api_key=SecretStr(GOOGLE_API_KEY), temperature=0.3
+    model=LLM_MODEL_NAME,
+    google_api_key=SecretStr(GOOGLE_API_KEY),
+    temperature=0.3,
+    # Retries are left to the gateway's hedging and circuit breaker.
+    max_retries=1,
 )
 
+if LLM_TRANSPORT == "langchain":
+    generation_backend = LangChainChatBackend(llm)
+else:
+    generation_backend = GeminiRestBackend(
+        model=LLM_MODEL_NAME,
+        api_key=GOOGLE_API_KEY,
+        base_url=LLM_API_BASE_URL,
+        temperature=0.3,
+    )
+generation_gateway = GenerationGateway(generation_backend)
+
 
-client = chromadb.PersistentClient(path=str(CHROMA_PERSIST_DIRECTORY))
-vectorstore = Chroma(
-    client=client, collection_name=CHROMA_COLLECTION_NAME, embedding_function=embeddings
-)
-retriever = vectorstore.as_retriever(search_kwargs={"k": 10})
+# Follows the served index version, so blue/green swaps apply without a restart.
+index = ServingIndex(CHROMA_PERSIST_DIRECTORY, CHROMA_COLLECTION_NAME)
+retriever = ShardedRetriever(index=index, embeddings=embeddings, k=10)
+# Follow-up questions in a session reuse the chunks retrieved for earlier turns.
+sessions = SessionStore()
 
 new_template = """
 You are a helpful AI assistant specializing in scientific literature and Material Science.
@@ -75,32 +102,42 @@ def process_retrieved_docs(docs):
     unique_sources_map = {}
     numbered_context_parts = []
     source_objects_for_references = []
-    current_source_number = 1
 
     for doc in docs:
         doi = doc.metadata.get("doi", "N/A")
         title = doc.metadata.get("title", "N/A")
         source_file = doc.metadata.get("source_file", "N/A")
         page = doc.metadata.get("page", "N/A")
-        url = construct_nature_url_from_doi(doi)
 
         source_key = doi if doi != "N/A" else f"{title}_{source_file}"
 
-        if source_key not in unique_sources_map:
-            unique_sources_map[source_key] = current_source_number
-            source_objects_for_references.append(
-                {
-                    "number": current_source_number,
-                    "doi": doi,
-                    "title": title,
-                    "url": url,
-                    "page_info": f"Page: {page} (from {source_file})",
-                }
-            )
-            current_source_number += 1
+        source = unique_sources_map.get(source_key)
+        if source is None:
+            # The URL is built once per source rather than once per chunk.
+            source = {
+                "number": len(source_objects_for_references) + 1,
+                "doi": doi,
+                "title": title,
+                "url": construct_nature_url_from_doi(doi),
+                "page_info": f"Page: {page} (from {source_file})",
+                "source_file": source_file,
+                "pages": [],
+                "chunks": [],
+            }
+            unique_sources_map[source_key] = source
+            source_objects_for_references.append(source)
+        if page not in source["pages"]:
+            source["pages"].append(page)
+        source["chunks"].append(
+            {
+                "id": doc.id,
+                "page": page,
+                "section": doc.metadata.get("section"),
+                "distance": doc.metadata.get("distance"),
+            }
+        )
 
-        citation_number_for_this_chunk = unique_sources_map[source_key]
-        context_header = f"Source [{citation_number_for_this_chunk}] (Page: {page}):"
+        context_header = f"Source [{source['number']}] (Page: {page}):"
         numbered_context_parts.append(f"{context_header}\n{doc.page_content}")
 
     context_with_numbers_str = "\n---\n".join(numbered_context_parts)
@@ -111,51 +148,16 @@ def process_retrieved_docs(docs):
     }
 
 
-def extract_reference_flag_and_clean_answer(raw_answer):
-    has_references_match = re.search(
-        r"has_references:\s*(true|false)\s*$", raw_answer, re.IGNORECASE
-    )
-
-    if has_references_match:
-        has_references = has_references_match.group(1).lower() == "true"
-        cleaned_answer = re.sub(
-            r"has_references:\s*(true|false)\s*$", "", raw_answer, flags=re.IGNORECASE
-        ).strip()
-        return cleaned_answer, has_references
-
-    citation_pattern = r"\[\d+\]"
-    contains_citations = bool(re.search(citation_pattern, raw_answer))
-
-    if contains_citations:
-        return raw_answer, True
-
-    answer_lower = raw_answer.lower()
-    has_references = not (
-        "not enough information found" in answer_lower
-        or "i am a material science assistant" in answer_lower
+def format_llm_output_with_references(llm_output_and_sources_dict):
+    """Returns {"answer": markdown, "citations": [...]}."""
+    return format_answer(
+        llm_output_and_sources_dict["llm_answer"],
+        llm_output_and_sources_dict["sources_for_references"],
     )
 
-    return raw_answer, has_references
-
 
 def combine_llm_output_with_references(llm_output_and_sources_dict):
-    llm_answer = llm_output_and_sources_dict["llm_answer"]
-    sources = llm_output_and_sources_dict["sources_for_references"]
-
-    if not sources:
-        return llm_answer
-
-    cleaned_answer, has_references = extract_reference_flag_and_clean_answer(llm_answer)
-
-    if not has_references:
-        return cleaned_answer
-
-    references_section = "\n\n---\n**References:**\n"
-    for src in sorted(sources, key=lambda x: x["number"]):
-        ref_line = f"{src['number']}. **Title:** {src['title']}\n   **DOI:** {src['doi']}\n   **URL:** {src['url']}\n   **Source Info:** {src['page_info']}\n"
-        references_section += ref_line
-
-    return cleaned_answer + references_section
+    return format_llm_output_with_references(llm_output_and_sources_dict)["answer"]
 
 
 def get_initial_query_dict(query_string: str) -> dict:
@@ -174,7 +176,7 @@ def generate_answer_from_context(input_dict: dict) -> dict:
             "context_with_numbers"
         ],
     }
-    llm_answer_str = (new_prompt | llm | StrOutputParser()).invoke(llm_input)
+    llm_answer_str = generation_gateway.generate(new_prompt.format(**llm_input))
     return {"llm_answer_raw": llm_answer_str}
 
 
@@ -216,7 +218,13 @@ def create_rag_chain():
             "context_with_numbers": x["processed_data_for_llm"]["context_with_numbers"],
         }
     )
-    _llm_generation_chain = _llm_input_mapper | new_prompt | llm | StrOutputParser()
+    _llm_generation_chain = (
+        _llm_input_mapper
+        | new_prompt
+        | RunnableLambda(
+            lambda prompt_value: generation_gateway.generate(prompt_value.to_string())
+        )
+    )
 
     _answer_generation_chain = RunnablePassthrough.assign(
         llm_answer_raw=_llm_generation_chain
@@ -246,48 +254,127 @@ def create_rag_chain():
 final_rag_chain = create_rag_chain()
 
 
-async def afinal_rag_chain_invoke(query: str):
-    initial_dict = {"original_query": query}
-
-    retrieved_docs = await retriever.aget_relevant_documents(
-        initial_dict["original_query"]
+def retrieve_for_session(query: str, session, timings=NULL_TIMINGS):
+    """
+    Returns (documents, mode, failed_shards) for a turn; see Session.retrieve.
+    failed_shards lists shards that could not be searched, so the documents
+    may be missing some of the closest chunks.
+    """
+    failed_shards = []
+
+    def search(query_embedding, k):
+        with timings.stage("search"):
+            # Chunks of the documents shortlisted by their summaries.
+            hits = index.search_two_stage(query_embedding, k, retriever.shortlist_size)
+        failed_shards.extend(hits.failed_shards)
+        return hits
+
+    with timings.stage("embed_query"):
+        query_embedding = embeddings.embed_query(query)
+    hits, mode = session.retrieve(
+        query, query_embedding, retriever.k, search, index.get_embeddings
     )
-    dict_after_retrieval = {**initial_dict, "retrieved_docs": retrieved_docs}
+    sessions.record_mode(mode)
+    return [hit_to_document(hit) for hit in hits], mode, failed_shards
 
-    processed_data = process_retrieved_docs(dict_after_retrieval["retrieved_docs"])
-    dict_after_processing = {
-        **dict_after_retrieval,
-        "processed_data_for_llm": processed_data,
-    }
 
-    llm_input = {
-        "question": dict_after_processing["original_query"],
-        "context_with_numbers": dict_after_processing["processed_data_for_llm"][
-            "context_with_numbers"
-        ],
+def prepare_prompt(query: str, session_id: str | None, timings=NULL_TIMINGS):
+    """Returns (prompt, sources, session_info) for a query."""
+    session = sessions.get_or_create(session_id)
+    with timings.stage("retrieve"):
+        retrieved_docs, mode, failed_shards = retrieve_for_session(
+            query, session, timings
+        )
+    with timings.stage("build_prompt"):
+        processed_data = process_retrieved_docs(retrieved_docs)
+        formatted_prompt_str = new_prompt.format(
+            question=query,
+            context_with_numbers=processed_data["context_with_numbers"],
+        )
+    session_info = {
+        "session_id": session.session_id,
+        "retrieval": mode,
+        "failed_shards": failed_shards,
     }
-    formatted_prompt_str = new_prompt.format(**llm_input)
-    llm_response_obj = await llm.ainvoke(formatted_prompt_str)
-    llm_answer_str = (
-        llm_response_obj.content
-        if hasattr(llm_response_obj, "content")
-        else str(llm_response_obj)
+    if failed_shards:
+        print(f"Answering from partial results, shards failed: {failed_shards}")
+    sources = processed_data["sources_for_references"]
+    return formatted_prompt_str, sources, session_info
+
+
+async def _aprepare_prompt(query: str, session_id: str | None):
+    return await asyncio.to_thread(prepare_prompt, query, session_id)
+
+
+def answer_query(query: str, session_id: str | None = None, timings=NULL_TIMINGS):
+    """Synchronous aanswer_query, timed stage by stage for profiling."""
+    formatted_prompt_str, sources, session_info = prepare_prompt(
+        query, session_id, timings
     )
-    dict_after_llm = {**dict_after_processing, "llm_answer_raw": llm_answer_str}
+    with timings.stage("generate"):
+        llm_answer_str = generation_gateway.generate(formatted_prompt_str)
+    with timings.stage("format"):
+        result = format_llm_output_with_references(
+            {"llm_answer": llm_answer_str, "sources_for_references": sources}
+        )
+    return {**result, **session_info}
+
+
+async def aanswer_query(query: str, session_id: str | None = None) -> dict:
+    """
+    Returns {"answer": markdown, "citations": [...], "session_id": ...,
+    "retrieval": mode, "failed_shards": [...]}. Passing the returned
+    session_id with a follow-up question lets it reuse the chunks retrieved
+    for earlier turns.
+    """
+    formatted_prompt_str, sources, session_info = await _aprepare_prompt(
+        query, session_id
+    )
+    llm_answer_str = await generation_gateway.agenerate(formatted_prompt_str)
+    return {
+        **format_llm_output_with_references(
+            {"llm_answer": llm_answer_str, "sources_for_references": sources}
+        ),
+        **session_info,
+    }
 
-    return combine_llm_output_with_references(
-        {
-            "llm_answer": dict_after_llm["llm_answer_raw"],
-            "sources_for_references": dict_after_llm["processed_data_for_llm"][
-                "sources_for_references"
-            ],
-        }
+
+async def afinal_rag_chain_invoke(query: str):
+    return (await aanswer_query(query))["answer"]
+
+
+async def astream_answer(query: str, session_id: str | None = None):
+    """
+    Yields a {"type": "session", ...} event, then {"type": "token", "text": ...}
+    events while the answer is generated, then a single
+    {"type": "references", ...} event with the references markdown and
+    structured citations.
+    """
+    formatted_prompt_str, sources, session_info = await _aprepare_prompt(
+        query, session_id
     )
+    yield {"type": "session", **session_info}
+
+    formatter = IncrementalAnswerFormatter(sources)
+    async for chunk in generation_gateway.astream(formatted_prompt_str):
+        text = formatter.feed(chunk)
+        if text:
+            yield {"type": "token", "text": text}
+
+    result = formatter.finish()
+    if result["tail"]:
+        yield {"type": "token", "text": result["tail"]}
+    yield {
+        "type": "references",
+        "has_references": result["has_references"],
+        "markdown": result["references_markdown"],
+        "citations": result["citations"],
+    }
 
 
 if __name__ == "__main__":
     try:
-        doc_count = vectorstore._collection.count()
+        doc_count = index.count()
         if doc_count == 0:
             print("ChromaDB collection is empty. Run ingestion.py first.")
         else:
@@ -0,0 +1,174 @@
+import re
+
+REFERENCE_FLAG_NAME = "has_references:"
+
+# The prompt shows the flag in backticks, which some answers reproduce.
+_REFERENCE_FLAG_PATTERN = re.compile(
+    r"`?has_references:\s*(true|false)`?\s*$", re.IGNORECASE
+)
+_REFERENCE_FLAG_NAME_PATTERN = re.compile(r"`?has_references:", re.IGNORECASE)
+_CITATION_PATTERN = re.compile(r"\[\d+\]")
+_NO_ANSWER_MARKERS = (
+    "not enough information found",
+    "i am a material science assistant",
+)
+
+
+def extract_reference_flag_and_clean_answer(raw_answer):
+    has_references_match = _REFERENCE_FLAG_PATTERN.search(raw_answer)
+
+    if has_references_match:
+        has_references = has_references_match.group(1).lower() == "true"
+        cleaned_answer = raw_answer[: has_references_match.start()].strip()
+        return cleaned_answer, has_references
+
+    if _CITATION_PATTERN.search(raw_answer):
+        return raw_answer, True
+
+    answer_lower = raw_answer.lower()
+    has_references = not any(marker in answer_lower for marker in _NO_ANSWER_MARKERS)
+    return raw_answer, has_references
+
+
+def build_references_section(sources):
+    lines = ["\n\n---\n**References:**\n"]
+    for src in sorted(sources, key=lambda x: x["number"]):
+        lines.append(
+            f"{src['number']}. **Title:** {src['title']}\n"
+            f"   **DOI:** {src['doi']}\n"
+            f"   **URL:** {src['url']}\n"
+            f"   **Source Info:** {src['page_info']}\n"
+        )
+    return "".join(lines)
+
+
+def build_citations(sources):
+    """Machine-readable counterpart of the references section."""
+    return [
+        {
+            "number": src["number"],
+            "title": src["title"],
+            "doi": src["doi"],
+            "url": src["url"],
+            "source_file": src["source_file"],
+            "pages": src["pages"],
+            "chunks": src["chunks"],
+        }
+        for src in sorted(sources, key=lambda x: x["number"])
+    ]
+
+
+def format_answer(llm_answer, sources):
+    """
+    Returns {"answer": markdown, "citations": [...]} for a complete LLM
+    answer. The markdown keeps the original layout: the cleaned answer
+    followed by the references section when the answer cites sources.
+    """
+    if not sources:
+        return {"answer": llm_answer, "citations": []}
+
+    cleaned_answer, has_references = extract_reference_flag_and_clean_answer(llm_answer)
+    if not has_references:
+        return {"answer": cleaned_answer, "citations": []}
+    return {
+        "answer": cleaned_answer + build_references_section(sources),
+        "citations": build_citations(sources),
+    }
+
+
+def _could_be_reference_flag(line: str) -> bool:
+    stripped = line.strip()
+    if not stripped:
+        return False
+    normalized = stripped.strip("`").lower()
+    if not normalized:
+        # A lone backtick may open the flag.
+        return True
+    return REFERENCE_FLAG_NAME.startswith(normalized) or normalized.startswith(
+        REFERENCE_FLAG_NAME
+    )
+
+
+def _reference_flag_start(line: str):
+    """
+    Index in line at which the has_references flag may begin, or None. The
+    flag can follow answer text on the same line, and only part of it may
+    have been generated yet.
+    """
+    match = _REFERENCE_FLAG_NAME_PATTERN.search(line)
+    if match:
+        return match.start()
+    for start in range(max(0, len(line) - len(REFERENCE_FLAG_NAME) - 1), len(line)):
+        if _could_be_reference_flag(line[start:]):
+            return start
+    return None
+
+
+class IncrementalAnswerFormatter:
+    """
+    Formats an answer while it is generated.
+
+    feed() returns the text that can be shown right away. Whatever part of
+    the last line with content may be the has_references flag, which can
+    also follow answer text on the same line, is held back until more
+    content follows it or the stream ends, so the flag never reaches the
+    client. finish() then returns the references section and citations
+    without re-scanning the answer.
+    """
+
+    def __init__(self, sources):
+        self.sources = sources
+        self._emitted = []
+        self._pending = ""
+
+    def feed(self, text: str) -> str:
+        pending = self._pending + text
+        # The flag may already be followed by its newline, so the last line
+        # with content is checked, together with the whitespace after it.
+        line_start = pending.rstrip().rfind("\n") + 1
+        flag_start = _reference_flag_start(pending[line_start:].rstrip())
+        if flag_start is None:
+            emit, self._pending = pending, ""
+        else:
+            split = line_start + flag_start
+            emit, self._pending = pending[:split], pending[split:]
+        if emit:
+            self._emitted.append(emit)
+        return emit
+
+    def finish(self):
+        """
+        Returns the remaining text to show (a held-back line that was not the
+        flag), whether the answer cites sources, the references markdown and
+        the structured citations.
+        """
+        tail = ""
+        flag_match = _REFERENCE_FLAG_PATTERN.search(self._pending)
+        if flag_match:
+            has_references = flag_match.group(1).lower() == "true"
+        else:
+            tail = self._pending
+            self._emitted.append(tail)
+            # No flag from the model: fall back to inspecting the full answer.
+            _, has_references = extract_reference_flag_and_clean_answer(
+                "".join(self._emitted)
+            )
+        self._pending = ""
+
+        if not self.sources or not has_references:
+            return {
+                "tail": tail,
+                "has_references": False,
+                "references_markdown": "",
+                "citations": [],
+            }
+        return {
+            "tail": tail,
+            "has_references": True,
+            "references_markdown": build_references_section(self.sources),
+            "citations": build_citations(self.sources),
+        }
+
+    def answer(self) -> str:
+        """The cleaned answer text emitted so far."""
+        return "".join(self._emitted).strip()
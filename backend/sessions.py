@@ -0,0 +1,213 @@
+import heapq
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+
+SESSION_TTL_SECONDS = float(os.getenv("SESSION_TTL_SECONDS", "1800"))
+MAX_SESSIONS = int(os.getenv("SESSION_MAX_SESSIONS", "1000"))
+MAX_CHUNKS_PER_SESSION = int(os.getenv("SESSION_MAX_CHUNKS", "60"))
+MAX_TURNS_PER_SESSION = 20
+# A follow-up whose embedding has at least this cosine similarity to the
+# query of the session's last index search reuses that search's chunks.
+REUSE_MIN_SIMILARITY = float(os.getenv("SESSION_REUSE_MIN_SIMILARITY", "0.9"))
+# Approximate memory of all sessions together (chunk text and metadata).
+MAX_SESSION_MEMORY_BYTES = int(os.getenv("SESSION_MAX_MEMORY_MB", "64")) * 1024 * 1024
+
+
+def _hit_bytes(hit) -> int:
+    return len(hit["document"]) + sum(
+        len(str(key)) + len(str(value)) for key, value in hit["metadata"].items()
+    )
+
+
+class Session:
+    """
+    Chunks retrieved during one conversation and the chunk IDs and distances
+    of each turn. Chunk embeddings are not kept; they are read back from the
+    index when they are needed.
+
+    A follow-up close to the query of the last index search reuses that
+    search's chunks without searching. Any other follow-up searches the
+    index and merges the results with the remembered chunks, rescored
+    against the new query.
+    """
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.chunks = OrderedDict()
+        self.turns = []
+        self.search_embedding = None
+        self.search_chunk_ids = []
+        self.size_bytes = 0
+        self.last_used = time.monotonic()
+        self.lock = threading.Lock()
+
+    def similarity(self, query_embedding) -> float:
+        """Cosine similarity of query_embedding to the last searched query."""
+        if self.search_embedding is None:
+            return 0.0
+        query = np.asarray(query_embedding, dtype=np.float32)
+        norms = np.linalg.norm(query) * np.linalg.norm(self.search_embedding)
+        return float(query @ self.search_embedding / norms) if norms else 0.0
+
+    def rescore(self, query_embedding, hits, embeddings):
+        """
+        hits with distances to query_embedding, closest first. embeddings maps
+        chunk IDs to their embeddings; hits without one are left out.
+        """
+        hits = [hit for hit in hits if hit["id"] in embeddings]
+        if not hits:
+            return []
+        matrix = np.asarray([embeddings[hit["id"]] for hit in hits], dtype=np.float32)
+        query = np.asarray(query_embedding, dtype=np.float32)
+        # Squared L2, the distance Chroma reports for the default "l2" space.
+        distances = ((matrix - query) ** 2).sum(axis=1)
+        order = np.argsort(distances)
+        return [{**hits[i], "distance": float(distances[i])} for i in order]
+
+    def retrieve(self, query: str, query_embedding, k: int, search, get_embeddings):
+        """
+        Returns (hits, mode) for a turn, where mode is "search" (no history),
+        "reuse" (the chunks of the last search, with their distances from it)
+        or "extend" (history merged with a fresh search). search(query_embedding,
+        k) returns hits; get_embeddings(hits) returns {chunk ID: embedding}.
+        """
+        with self.lock:
+            if not self.chunks:
+                mode = "search"
+                hits = list(search(query_embedding, k))
+            elif (
+                self.similarity(query_embedding) >= REUSE_MIN_SIMILARITY
+                and self.search_chunk_ids
+            ):
+                mode = "reuse"
+                hits = [
+                    self.chunks[chunk_id]
+                    for chunk_id in self.search_chunk_ids
+                    if chunk_id in self.chunks
+                ]
+            else:
+                mode = "extend"
+                merged = {hit["id"]: hit for hit in search(query_embedding, k)}
+                remembered = [
+                    hit for hit in self.chunks.values() if hit["id"] not in merged
+                ]
+                for hit in self.rescore(
+                    query_embedding, remembered, get_embeddings(remembered)
+                ):
+                    merged[hit["id"]] = hit
+                hits = heapq.nsmallest(k, merged.values(), key=lambda h: h["distance"])
+
+            if mode != "reuse":
+                self.search_embedding = np.asarray(query_embedding, dtype=np.float32)
+                self.search_chunk_ids = [hit["id"] for hit in hits]
+            self._record_turn(query, hits, mode)
+            return hits, mode
+
+    def _record_turn(self, query, hits, mode):
+        for hit in hits:
+            self.chunks[hit["id"]] = hit
+            self.chunks.move_to_end(hit["id"])
+        while len(self.chunks) > MAX_CHUNKS_PER_SESSION:
+            self.chunks.popitem(last=False)
+        self.size_bytes = sum(_hit_bytes(hit) for hit in self.chunks.values())
+
+        self.turns.append(
+            {
+                "query": query,
+                "mode": mode,
+                "chunks": [(hit["id"], hit["distance"]) for hit in hits],
+            }
+        )
+        del self.turns[:-MAX_TURNS_PER_SESSION]
+
+
+class SessionStore:
+    """
+    In-memory sessions, expired SESSION_TTL_SECONDS after their last use.
+    The least recently used are evicted beyond max_sessions or when the
+    chunks of all sessions exceed max_bytes.
+    """
+
+    def __init__(
+        self,
+        ttl_seconds: float = SESSION_TTL_SECONDS,
+        max_sessions: int = MAX_SESSIONS,
+        max_bytes: int = MAX_SESSION_MEMORY_BYTES,
+    ):
+        self.ttl_seconds = ttl_seconds
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {
+            "created": 0,
+            "expired": 0,
+            "evicted": 0,
+            "search_turns": 0,
+            "reuse_turns": 0,
+            "extend_turns": 0,
+        }
+
+    def get_or_create(self, session_id: str | None = None) -> Session:
+        """
+        Returns the live session with this ID, or a new session with a fresh
+        ID when it is missing or has expired.
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            session = self._sessions.get(session_id) if session_id else None
+            if session is None:
+                session = Session(uuid.uuid4().hex)
+                self._sessions[session.session_id] = session
+                self.stats["created"] += 1
+                self._evict()
+            else:
+                self._sessions.move_to_end(session_id)
+            session.last_used = now
+            return session
+
+    def record_mode(self, mode: str):
+        """Counts a finished turn, after which its session may have grown."""
+        with self._lock:
+            self.stats[f"{mode}_turns"] += 1
+            self._evict()
+
+    def _evict(self):
+        # The most recently used session is kept even if it alone is too big.
+        total_bytes = sum(session.size_bytes for session in self._sessions.values())
+        while len(self._sessions) > 1 and (
+            len(self._sessions) > self.max_sessions or total_bytes > self.max_bytes
+        ):
+            _, session = self._sessions.popitem(last=False)
+            total_bytes -= session.size_bytes
+            self.stats["evicted"] += 1
+
+    def _expire(self, now):
+        # Sessions are kept in order of last use, so expired ones come first.
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if now - session.last_used < self.ttl_seconds:
+                break
+            self._sessions.popitem(last=False)
+            self.stats["expired"] += 1
+
+    def metrics(self):
+        with self._lock:
+            turns = (
+                self.stats["search_turns"]
+                + self.stats["reuse_turns"]
+                + self.stats["extend_turns"]
+            )
+            return {
+                **self.stats,
+                "active_sessions": len(self._sessions),
+                "reuse_rate": round(self.stats["reuse_turns"] / turns, 3)
+                if turns
+                else 0.0,
+            }
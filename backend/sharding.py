@@ -0,0 +1,488 @@
+import hashlib
+import heapq
+import json
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any
+
+import chromadb
+from chromadb.api.shared_system_client import SharedSystemClient
+from embedding_providers import collection_name_for, get_tagged_collection
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+
+CHROMA_COLLECTION_NAME = "scientific_articles"
+
+# "none" keeps the single collection directly under the index directory,
+# "year" partitions by publication year and "doi_hash" by a hash of the DOI.
+SHARD_STRATEGY = os.getenv("CHROMA_SHARD_STRATEGY", "none").lower()
+NUM_SHARDS = int(os.getenv("CHROMA_NUM_SHARDS", "8"))
+SEARCH_WORKERS = int(os.getenv("CHROMA_SEARCH_WORKERS", "8"))
+# Documents shortlisted by their summaries before chunks are searched; 0
+# searches the chunks of the whole corpus directly.
+DOC_SHORTLIST_SIZE = int(os.getenv("DOC_SHORTLIST_SIZE", "20"))
+# How long the check that every document has a summary is cached.
+SUMMARY_COVERAGE_CHECK_SECONDS = 30
+
+UNSHARDED_KEY = "main"
+REFERENCES_SUFFIX = "_references"
+DOCUMENTS_SUFFIX = "_documents"
+
+# Chroma shares one client system per directory across the process, so it is
+# only stopped once no open ShardedIndex uses the directory.
+_directory_users = Counter()
+_directory_users_lock = threading.Lock()
+
+
+def _release_directory(directory: Path):
+    with _directory_users_lock:
+        _directory_users[directory] -= 1
+        if _directory_users[directory] > 0:
+            return
+        del _directory_users[directory]
+        system = SharedSystemClient._identifier_to_system.pop(str(directory), None)
+    if system is not None:
+        try:
+            system.stop()
+        except Exception as e:
+            print(f"Error closing Chroma client for {directory}: {e}")
+
+
+class SearchResults(list):
+    """
+    Hits of a search, ordered by ascending distance. failed_shards lists the
+    shards that could not be searched, in which case the hits are partial.
+    """
+
+    def __init__(self, hits=(), failed_shards=()):
+        super().__init__(hits)
+        self.failed_shards = sorted(set(failed_shards))
+
+    @property
+    def partial(self) -> bool:
+        return bool(self.failed_shards)
+
+
+class ShardedIndex:
+    """
+    Partitions chunks across Chroma collections that each live in their own
+    directory under <base_directory>/shards/<shard_key>. A document is always
+    stored in a single shard. Searches fan out to all shards concurrently and
+    the per-shard top-k lists are merged with a heap.
+
+    With the "none" strategy there is one shard, stored directly in
+    base_directory, which is the original single-collection layout.
+
+    Next to the chunks, a much smaller collection in base_directory holds one
+    summary embedding (title and abstract or first page) per document, used
+    to shortlist documents before their chunks are searched. Documents whose
+    summary came out empty are listed in documents_without_summary.json.
+    """
+
+    def __init__(
+        self,
+        base_directory: Path,
+        collection_name: str = CHROMA_COLLECTION_NAME,
+        strategy: str = SHARD_STRATEGY,
+        num_shards: int = NUM_SHARDS,
+    ):
+        if strategy not in ("none", "year", "doi_hash"):
+            raise ValueError(f"Unknown CHROMA_SHARD_STRATEGY '{strategy}'.")
+        self.base_directory = base_directory
+        self.collection_name = collection_name
+        self.strategy = strategy
+        self.num_shards = num_shards
+        self.manifest_path = base_directory / "shard_manifest.json"
+        self.no_summary_path = base_directory / "documents_without_summary.json"
+        self._collections = {}
+        self._directories = set()
+        self._summary_coverage = None
+        self._closed = False
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=SEARCH_WORKERS, thread_name_prefix="shard-search"
+        )
+
+    def shard_for(self, core_metadata: dict) -> str:
+        if self.strategy == "none":
+            return UNSHARDED_KEY
+        if self.strategy == "year":
+            return str(core_metadata.get("year") or "unknown")
+        doi = core_metadata.get("doi", "Unknown DOI")
+        key = doi.lower() if doi != "Unknown DOI" else core_metadata["source_file"]
+        digest = int(hashlib.sha1(key.encode("utf-8")).hexdigest(), 16)
+        return f"{digest % self.num_shards:02d}"
+
+    def shard_directory(self, shard_key: str) -> Path:
+        if self.strategy == "none":
+            return self.base_directory
+        return self.base_directory / "shards" / shard_key
+
+    def shard_keys(self):
+        """Shards that exist on disk, re-read on every call to see new shards."""
+        if self.strategy == "none":
+            return [UNSHARDED_KEY]
+        shards_directory = self.base_directory / "shards"
+        if not shards_directory.exists():
+            return []
+        return sorted(p.name for p in shards_directory.iterdir() if p.is_dir())
+
+    def collection(self, shard_key: str, references: bool = False):
+        name = self.collection_name + (REFERENCES_SUFFIX if references else "")
+        cache_key = (shard_key, name)
+        with self._lock:
+            if cache_key not in self._collections:
+                directory = self.shard_directory(shard_key)
+                directory.mkdir(parents=True, exist_ok=True)
+                client = self._client(directory)
+                self._collections[cache_key] = get_tagged_collection(client, name)
+            return self._collections[cache_key]
+
+    def _client(self, directory: Path):
+        """Opens a Chroma client for directory; called with self._lock held."""
+        if self._closed:
+            raise RuntimeError(f"Index at {self.base_directory} is closed")
+        if directory not in self._directories:
+            self._directories.add(directory)
+            with _directory_users_lock:
+                _directory_users[directory] += 1
+        return chromadb.PersistentClient(path=str(directory))
+
+    def close(self):
+        """
+        Shuts down the search threads and releases the Chroma clients of
+        this index. Searches still running may fail; later ones raise.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._collections.clear()
+            directories, self._directories = self._directories, set()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        for directory in directories:
+            _release_directory(directory)
+
+    def documents_collection(self):
+        """Document summaries of all shards, kept in base_directory."""
+        name = self.collection_name + DOCUMENTS_SUFFIX
+        cache_key = (None, name)
+        with self._lock:
+            if cache_key not in self._collections:
+                self.base_directory.mkdir(parents=True, exist_ok=True)
+                client = self._client(self.base_directory)
+                self._collections[cache_key] = get_tagged_collection(client, name)
+            return self._collections[cache_key]
+
+    def upsert_document(self, core_metadata: dict, shard_key: str, embedding, summary):
+        metadata = {
+            "source_file": core_metadata["source_file"],
+            "title": core_metadata["title"],
+            "doi": core_metadata["doi"],
+            "shard": shard_key,
+        }
+        if "year" in core_metadata:
+            metadata["year"] = core_metadata["year"]
+        self.documents_collection().upsert(
+            ids=[core_metadata["source_file"]],
+            embeddings=[embedding],
+            documents=[summary],
+            metadatas=[metadata],
+        )
+        self._summary_coverage = None
+
+    def record_missing_summary(self, source_file: str):
+        """
+        Records that a document has no summary to embed (no title and no
+        text), so that it does not count as waiting for one.
+        """
+        without_summary = self.load_documents_without_summary()
+        if source_file not in without_summary:
+            self.save_documents_without_summary(without_summary | {source_file})
+
+    def remove_summaries(self, source_files):
+        """Deletes the summaries, or the records of having none, of source_files."""
+        source_files = set(source_files)
+        if not source_files:
+            return
+        self.documents_collection().delete(ids=sorted(source_files))
+        without_summary = self.load_documents_without_summary()
+        if without_summary & source_files:
+            self.save_documents_without_summary(without_summary - source_files)
+        self._summary_coverage = None
+
+    def unsummarised_documents(self, source_files=()) -> set:
+        """
+        Documents in the shard manifest, or in source_files, that have neither
+        a summary nor a record of having none.
+        """
+        summarised = set(self.documents_collection().get(include=[])["ids"])
+        return (
+            (set(self.load_manifest()) | set(source_files))
+            - summarised
+            - self.load_documents_without_summary()
+        )
+
+    def summaries_complete(self) -> bool:
+        """
+        Whether every document in the shard manifest has a summary, or is
+        recorded as having none, so that a shortlist of summaries can stand in
+        for the whole corpus.
+        """
+        now = time.monotonic()
+        if (
+            self._summary_coverage is None
+            or now - self._summary_coverage[0] >= SUMMARY_COVERAGE_CHECK_SECONDS
+        ):
+            try:
+                complete = not self.unsummarised_documents()
+            except Exception as e:
+                print(f"Error counting document summaries: {e}")
+                complete = False
+            self._summary_coverage = (now, complete)
+        return self._summary_coverage[1]
+
+    def count(self) -> int:
+        return sum(self.collection(key).count() for key in self.shard_keys())
+
+    def find_shard(self, source_file: str):
+        """The shard holding chunks of source_file, or None."""
+        for shard_key in self.shard_keys():
+            result = self.collection(shard_key).get(
+                where={"source_file": {"$eq": source_file}}, limit=1
+            )
+            if result["ids"]:
+                return shard_key
+        return None
+
+    def has_source_file(self, source_file: str) -> bool:
+        return self.find_shard(source_file) is not None
+
+    def _search_shard(self, shard_key, query_embedding, k, where):
+        try:
+            collection = self.collection(shard_key)
+            result = collection.query(
+                query_embeddings=[query_embedding],
+                n_results=k,
+                where=where,
+                include=["documents", "metadatas", "distances"],
+            )
+        except Exception as e:
+            # A shard may have been rebuilt since its collection was cached;
+            # the next search reopens it.
+            print(f"Error searching shard '{shard_key}', results are partial: {e}")
+            self.forget_shard(shard_key)
+            return None
+        return [
+            {
+                "id": chunk_id,
+                "document": document,
+                "metadata": metadata,
+                "distance": distance,
+                "shard": shard_key,
+            }
+            for chunk_id, document, metadata, distance in zip(
+                result["ids"][0],
+                result["documents"][0],
+                result["metadatas"][0],
+                result["distances"][0],
+            )
+        ]
+
+    def _search_shards(self, where_by_shard, query_embedding, k):
+        """Returns SearchResults; a shard returns None from _search_shard on error."""
+        if len(where_by_shard) == 1:
+            ((shard_key, where),) = where_by_shard.items()
+            per_shard = [self._search_shard(shard_key, query_embedding, k, where)]
+        else:
+            per_shard = self._executor.map(
+                lambda item: self._search_shard(item[0], query_embedding, k, item[1]),
+                where_by_shard.items(),
+            )
+        per_shard = dict(zip(where_by_shard, per_shard))
+        hits = heapq.nsmallest(
+            k,
+            (hit for hits in per_shard.values() if hits for hit in hits),
+            key=lambda h: h["distance"],
+        )
+        failed = [key for key, hits in per_shard.items() if hits is None]
+        return SearchResults(hits, failed)
+
+    def search(self, query_embedding, k: int, where=None):
+        """
+        Top-k hits across all shards as SearchResults, ordered by ascending
+        distance. Shards that fail are listed in failed_shards.
+        """
+        where_by_shard = {key: where for key in self.shard_keys()}
+        if not where_by_shard:
+            return SearchResults()
+        return self._search_shards(where_by_shard, query_embedding, k)
+
+    def search_documents(self, query_embedding, k: int):
+        """The k documents whose summaries are closest to the query."""
+        try:
+            result = self.documents_collection().query(
+                query_embeddings=[query_embedding],
+                n_results=k,
+                include=["metadatas", "distances"],
+            )
+        except Exception as e:
+            print(f"Error searching document summaries: {e}")
+            return []
+        return [
+            {**metadata, "distance": distance}
+            for metadata, distance in zip(
+                result["metadatas"][0], result["distances"][0]
+            )
+        ]
+
+    def search_two_stage(
+        self,
+        query_embedding,
+        k: int,
+        shortlist_size: int = DOC_SHORTLIST_SIZE,
+    ):
+        """
+        Top-k chunks of the shortlist_size documents whose summaries are
+        closest to the query, searching only the shards that hold them. Falls
+        back to search() while some documents have no summary (an index built
+        before they existed and not backfilled yet) or when the shortlisted
+        documents yield no chunks.
+        """
+        shortlist = (
+            self.search_documents(query_embedding, shortlist_size)
+            if shortlist_size > 0 and self.summaries_complete()
+            else []
+        )
+        files_by_shard = defaultdict(list)
+        shard_keys = set(self.shard_keys())
+        for document in shortlist:
+            shard_key = document.get("shard")
+            if shard_key not in shard_keys:
+                # Stored before a change of shard strategy; search every shard.
+                files_by_shard.clear()
+                break
+            files_by_shard[shard_key].append(document["source_file"])
+
+        hits = SearchResults()
+        if files_by_shard:
+            where_by_shard = {
+                key: {"source_file": {"$in": files}}
+                for key, files in files_by_shard.items()
+            }
+            hits = self._search_shards(where_by_shard, query_embedding, k)
+        if not hits:
+            flat = self.search(query_embedding, k)
+            return SearchResults(flat, hits.failed_shards + flat.failed_shards)
+        return hits
+
+    def get_embeddings(self, hits):
+        """{chunk ID: embedding} for hits from search(), read from their shards."""
+        ids_by_shard = defaultdict(list)
+        for hit in hits:
+            ids_by_shard[hit["shard"]].append(hit["id"])
+        embeddings = {}
+        for shard_key, ids in ids_by_shard.items():
+            try:
+                result = self.collection(shard_key).get(ids=ids, include=["embeddings"])
+            except Exception as e:
+                print(f"Error reading embeddings from shard '{shard_key}': {e}")
+                self.forget_shard(shard_key)
+                continue
+            embeddings.update(zip(result["ids"], result["embeddings"]))
+        return embeddings
+
+    def forget_shard(self, shard_key: str):
+        with self._lock:
+            for cache_key in [key for key in self._collections if key[0] == shard_key]:
+                del self._collections[cache_key]
+
+    def drop_shard(self, shard_key: str):
+        """
+        Deletes a shard's data, including the summaries of its documents, so
+        it can be rebuilt from its source files.
+        """
+        self.remove_summaries(
+            name for name, key in self.load_manifest().items() if key == shard_key
+        )
+        self.forget_shard(shard_key)
+        directory = self.shard_directory(shard_key)
+        if not directory.exists():
+            return
+        # Collections are deleted through the client rather than removing the
+        # directory, since Chroma caches one client system per path.
+        with self._lock:
+            client = self._client(directory)
+        names = {
+            collection_name_for(self.collection_name),
+            collection_name_for(self.collection_name + REFERENCES_SUFFIX),
+        }
+        for collection in client.list_collections():
+            name = getattr(collection, "name", collection)
+            if name in names:
+                client.delete_collection(name)
+
+    def load_manifest(self) -> dict:
+        if self.manifest_path.exists():
+            with open(self.manifest_path, "r") as f:
+                try:
+                    return json.load(f)
+                except json.JSONDecodeError:
+                    return {}
+        return {}
+
+    def save_manifest(self, manifest: dict):
+        self.base_directory.mkdir(parents=True, exist_ok=True)
+        with open(self.manifest_path, "w") as f:
+            json.dump(manifest, f, indent=2)
+        self._summary_coverage = None
+
+    def load_documents_without_summary(self) -> set:
+        if self.no_summary_path.exists():
+            with open(self.no_summary_path, "r") as f:
+                try:
+                    return set(json.load(f))
+                except json.JSONDecodeError:
+                    return set()
+        return set()
+
+    def save_documents_without_summary(self, source_files):
+        self.base_directory.mkdir(parents=True, exist_ok=True)
+        with open(self.no_summary_path, "w") as f:
+            json.dump(sorted(source_files), f, indent=2)
+        self._summary_coverage = None
+
+
+class ShardedRetriever(BaseRetriever):
+    """LangChain retriever over a ShardedIndex."""
+
+    # A ShardedIndex, or a ServingIndex that follows the served index version.
+    index: Any
+    embeddings: Embeddings
+    k: int = 10
+    # Documents shortlisted before searching chunks; 0 searches all chunks.
+    shortlist_size: int = DOC_SHORTLIST_SIZE
+
+    model_config = {"arbitrary_types_allowed": True}
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ):
+        hits = self.index.search_two_stage(
+            self.embeddings.embed_query(query), self.k, self.shortlist_size
+        )
+        return [hit_to_document(hit) for hit in hits]
+
+
+def hit_to_document(hit: dict) -> Document:
+    return Document(
+        id=hit["id"],
+        page_content=hit["document"],
+        metadata={**(hit["metadata"] or {}), "distance": hit["distance"]},
+    )
@@ -0,0 +1,127 @@
+import asyncio
+
+import admission
+import pytest
+from admission import (
+    BATCH,
+    INTERACTIVE,
+    AdmissionController,
+    AdmissionRejected,
+    RateLimiter,
+    TokenBucket,
+    client_id,
+)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(admission.time, "monotonic", clock)
+    return clock
+
+
+def test_token_bucket_refills_at_rate(clock):
+    bucket = TokenBucket(rate=0.5, burst=2)
+    assert bucket.take() == 0 and bucket.take() == 0
+    assert bucket.take() == pytest.approx(2.0)
+    clock.now += 2
+    assert bucket.take() == 0
+
+
+def test_rate_limiter_limits_each_client_separately(clock):
+    limiter = RateLimiter(rate=1, burst=1)
+    limiter.check("a")
+    limiter.check("b")
+    with pytest.raises(AdmissionRejected) as rejected:
+        limiter.check("a")
+    assert rejected.value.status_code == 429
+    clock.now += 1
+    limiter.check("a")
+
+
+def test_forwarded_client_id_is_only_trusted_from_the_proxy(monkeypatch):
+    monkeypatch.setattr(admission, "TRUSTED_PROXY_ADDRESSES", {"127.0.0.1"})
+    monkeypatch.setattr(admission, "PROXY_SHARED_SECRET", "s3cret")
+    assert client_id("127.0.0.1", "203.0.113.7") == "203.0.113.7"
+    assert client_id("198.51.100.1", "203.0.113.7") == "198.51.100.1"
+    assert client_id("198.51.100.1", "203.0.113.7", "wrong") == "198.51.100.1"
+    assert client_id("198.51.100.1", "203.0.113.7", "s3cret") == "203.0.113.7"
+    assert client_id(None) == "unknown"
+
+
+def test_forwarded_client_id_needs_a_configured_secret(monkeypatch):
+    monkeypatch.setattr(admission, "TRUSTED_PROXY_ADDRESSES", set())
+    monkeypatch.setattr(admission, "PROXY_SHARED_SECRET", None)
+    assert client_id("198.51.100.1", "203.0.113.7", "") == "198.51.100.1"
+
+
+def test_interactive_requests_go_ahead_of_batch():
+    async def scenario():
+        controller = AdmissionController(max_concurrent=1, max_queue=4)
+        ticket = await controller.acquire(INTERACTIVE)
+        batch = asyncio.create_task(controller.acquire(BATCH))
+        interactive = asyncio.create_task(controller.acquire(INTERACTIVE))
+        await asyncio.sleep(0)
+        controller.release(ticket)
+        second = await interactive
+        assert not batch.done()
+        controller.release(second)
+        controller.release(await batch)
+        return controller.metrics()
+
+    metrics = asyncio.run(scenario())
+    assert metrics["admitted"] == 3 and metrics["queue_length"] == 0
+
+
+def test_batch_requests_leave_slots_for_interactive():
+    async def scenario():
+        controller = AdmissionController(max_concurrent=2, max_batch_concurrent=1)
+        await controller.acquire(BATCH)
+        waiting_batch = asyncio.create_task(controller.acquire(BATCH))
+        await asyncio.sleep(0)
+        assert not waiting_batch.done()
+        await controller.acquire(INTERACTIVE)
+        waiting_batch.cancel()
+
+    asyncio.run(scenario())
+
+
+def test_full_queue_sheds_or_displaces_batch():
+    async def scenario():
+        controller = AdmissionController(max_concurrent=1, max_queue=1)
+        await controller.acquire(INTERACTIVE)
+        batch = asyncio.create_task(controller.acquire(BATCH))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected) as shed:
+            await controller.acquire(BATCH)
+        assert shed.value.status_code == 503 and shed.value.reason == "overloaded"
+
+        interactive = asyncio.create_task(controller.acquire(INTERACTIVE))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected) as displaced:
+            await batch
+        assert displaced.value.reason == "displaced"
+        interactive.cancel()
+
+    asyncio.run(scenario())
+
+
+def test_queue_timeout_sheds_request():
+    async def scenario():
+        controller = AdmissionController(max_concurrent=1, queue_timeout=0.01)
+        await controller.acquire(INTERACTIVE)
+        with pytest.raises(AdmissionRejected) as timed_out:
+            await controller.acquire(INTERACTIVE)
+        assert timed_out.value.reason == "queue_timeout"
+        return controller.metrics()
+
+    metrics = asyncio.run(scenario())
+    assert metrics["queue_timeouts"] == 1 and metrics["queue_length"] == 0
@@ -0,0 +1,99 @@
+from chunking import ScientificTextSplitter, classify_line, estimate_tokens
+from langchain_core.documents import Document
+
+
+def split(*pages, **kwargs):
+    splitter = ScientificTextSplitter(**kwargs)
+    return splitter.split_documents(
+        [
+            Document(page_content=text, metadata={"page": i})
+            for i, text in enumerate(pages)
+        ]
+    )
+
+
+def sentences(count, start=0):
+    return " ".join(
+        f"Sample {i} was annealed for one hour before testing."
+        for i in range(start, start + count)
+    )
+
+
+def test_numbered_headings_need_a_title_after_a_blank_line():
+    assert classify_line("2.1 Sample preparation") == "heading"
+    assert classify_line("2.2 XRD analysis") == "heading"
+    assert classify_line("Results and Discussion") == "heading"
+    assert classify_line("2.1 Sample preparation", after_blank=False) == "text"
+    # Wrapped body lines that start with a quantity.
+    assert classify_line("300 K and the films were then annealed") == "text"
+    assert classify_line("5 GPa was reached") == "text"
+    assert classify_line("4 Samples were heated to") == "text"
+
+
+def test_captions_and_dense_lines_are_classified():
+    assert classify_line("Figure 3: Stress-strain curves.") == "caption"
+    assert classify_line("Extended Data Fig. 2 | Phase maps.") == "caption"
+    assert classify_line("0.12  0.45  1.33  2.01") == "dense"
+    assert classify_line("The yield strength increased.") == "text"
+
+
+def test_heading_starts_a_chunk_and_keeps_its_text():
+    chunks = split(
+        "Some front matter text.\n\n2.1 Sample preparation\nFilms were grown at\n"
+        "300 K and the films were then annealed.\n5 GPa was reached."
+    )
+    assert [c.metadata["section"] for c in chunks] == [
+        "Front matter",
+        "2.1 Sample preparation",
+    ]
+    body = chunks[1].page_content
+    assert body.startswith("2.1 Sample preparation\n")
+    assert "300 K and the films were then annealed." in body
+    assert "5 GPa was reached." in body
+
+
+def test_caption_after_reference_list_is_kept():
+    chunks = split(
+        "Results\nThe alloy is strong.\n\nReferences\n1. Smith, J. Nature 1 (2020).\n\n"
+        "Figure 1: Microstructure of the printed alloy.\n\n"
+        "2. Doe, A. Science 2 (2021).",
+        references_mode="drop",
+    )
+    contents = [c.page_content for c in chunks]
+    assert contents == [
+        "Results\nThe alloy is strong.",
+        "Figure 1: Microstructure of the printed alloy.",
+    ]
+    assert chunks[1].metadata["content_type"] == "caption"
+
+
+def test_separate_references_mode_emits_references_chunks():
+    chunks = split(
+        "References\n1. Smith, J. Nature 1 (2020).", references_mode="separate"
+    )
+    assert [c.metadata["content_type"] for c in chunks] == ["references"]
+    assert chunks[0].page_content.startswith("References\n")
+
+
+def test_dense_block_is_kept_together():
+    table = "\n".join(f"{i}.0  {i * 2}.5  {i * 3}.1" for i in range(6))
+    chunks = split(f"The measured values are listed below.\n{table}\nThey agree.")
+    assert any(table in c.page_content for c in chunks)
+
+
+def test_chunks_respect_token_limit_and_overlap():
+    chunks = split(sentences(60), chunk_tokens=60, overlap_tokens=15)
+    assert len(chunks) > 1
+    assert all(c.metadata["token_count"] <= 60 for c in chunks)
+    assert all(
+        estimate_tokens(c.page_content) <= c.metadata["token_count"] for c in chunks
+    )
+    for previous, chunk in zip(chunks, chunks[1:]):
+        last_sentence = previous.page_content.split("\n")[-1].split(". ")[-1]
+        assert chunk.page_content.startswith(last_sentence.rstrip("."))
+
+
+def test_chunks_record_their_first_page():
+    chunks = split(sentences(30), sentences(30, start=30), chunk_tokens=100)
+    pages = [c.metadata["page"] for c in chunks]
+    assert pages == sorted(pages) and pages[0] == 0 and pages[-1] == 1
@@ -0,0 +1,80 @@
+import random
+
+from dedup import (
+    NearDuplicateIndex,
+    empty_signature,
+    estimate_similarity,
+    update_signature,
+)
+
+UNKNOWN = "Unknown DOI"
+
+
+def words(seed, count=600):
+    rng = random.Random(seed)
+    vocabulary = [f"term{i}" for i in range(5000)]
+    return [rng.choice(vocabulary) for _ in range(count)]
+
+
+def signature_of(tokens):
+    return update_signature(empty_signature(), " ".join(tokens))
+
+
+def metadata(source_file, doi=UNKNOWN):
+    return {"source_file": source_file, "doi": doi}
+
+
+def test_similarity_tracks_shared_text():
+    text = words(1)
+    edited = text[:570] + words(2, 30)
+    assert estimate_similarity(signature_of(text), signature_of(text)) == 1.0
+    assert estimate_similarity(signature_of(text), signature_of(edited)) > 0.8
+    assert estimate_similarity(signature_of(text), signature_of(words(3))) < 0.1
+
+
+def test_near_duplicate_is_found_and_unrelated_document_is_not(tmp_path):
+    index = NearDuplicateIndex(tmp_path / "minhash.json")
+    text = words(1)
+    index.add(metadata("a.pdf"), signature_of(text))
+
+    match = index.find_duplicate(
+        metadata("a-copy.pdf"), signature_of(text[:590] + words(2, 10))
+    )
+    assert match is not None and match[0] == "a.pdf"
+    assert index.find_duplicate(metadata("b.pdf"), signature_of(words(3))) is None
+    # A document is never a duplicate of itself.
+    assert index.find_duplicate(metadata("a.pdf"), signature_of(text)) is None
+
+
+def test_same_doi_is_a_duplicate_only_with_similar_text(tmp_path):
+    index = NearDuplicateIndex(tmp_path / "minhash.json")
+    text = words(1)
+    index.add(metadata("a.pdf", "10.1/x"), signature_of(text))
+
+    match = index.find_duplicate(
+        metadata("a-copy.pdf", "10.1/x"), signature_of(text[:590] + words(2, 10))
+    )
+    assert match is not None and match[0] == "a.pdf"
+    # A shared DOI alone, e.g. one scraped from a citation, is not enough.
+    assert (
+        index.find_duplicate(metadata("b.pdf", "10.1/x"), signature_of(words(3)))
+        is None
+    )
+    assert index.find_duplicate(metadata("scan.pdf", "10.1/x"), None) is None
+
+
+def test_index_round_trips_through_json(tmp_path):
+    path = tmp_path / "minhash.json"
+    index = NearDuplicateIndex(path)
+    text = words(1)
+    index.add(metadata("a.pdf", "10.1/x"), signature_of(text))
+    index.add(metadata("scan.pdf"), None)
+    index.link_duplicate("a.pdf", "a-copy.pdf")
+    index.save()
+
+    reloaded = NearDuplicateIndex(path)
+    assert reloaded.documents["a.pdf"]["aliases"] == ["a-copy.pdf"]
+    assert reloaded.canonical_doi("a.pdf") == "10.1/x"
+    assert reloaded.find_duplicate(metadata("new.pdf"), signature_of(text))[0] == (
+        "a.pdf"
+    )
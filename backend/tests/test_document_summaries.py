@@ -0,0 +1,63 @@
+from document_summaries import SummaryCollector, backfill
+from sharding import ShardedIndex
+
+
+class FakeEmbeddings:
+    def __init__(self):
+        self.calls = 0
+
+    def embed_documents(self, texts):
+        self.calls += 1
+        return [[float(len(text)), 1.0] for text in texts]
+
+
+def add_chunks(index, source_file, shard_key="main", title="A paper", first_page=None):
+    metadata = {"source_file": source_file, "title": title, "doi": "10.1/x"}
+    index.collection(shard_key).upsert(
+        ids=[f"{source_file[:-4]}_page{p}_chunk{p}" for p in (0, 1)],
+        embeddings=[[1.0, 0.0], [0.0, 1.0]],
+        documents=[first_page or "first page text", "later text"],
+        metadatas=[{**metadata, "page": 0}, {**metadata, "page": 1}],
+    )
+
+
+def test_summary_prefers_abstract_and_skips_references():
+    collector = SummaryCollector(max_chars=100)
+    collector.keep("cited work", {"content_type": "references", "page": 0})
+    collector.keep("first page", {"page": 0})
+    collector.keep("the abstract", {"section": "Abstract", "page": 0})
+    assert collector.summary({"title": "Title"}) == "Title\n\nthe abstract"
+
+
+def test_backfill_lists_documents_missing_from_the_manifest(tmp_path):
+    index = ShardedIndex(tmp_path / "index")
+    add_chunks(index, "old.pdf")
+    add_chunks(index, "new.pdf")
+    index.save_manifest({"new.pdf": "main"})
+    assert not index.summaries_complete()
+
+    backfill(index, FakeEmbeddings(), {"old.pdf", "gone.pdf"})
+    assert index.load_manifest() == {"new.pdf": "main", "old.pdf": "main"}
+    summaries = index.documents_collection().get(include=["documents"])
+    assert sorted(summaries["ids"]) == ["new.pdf", "old.pdf"]
+    assert summaries["documents"][0] == "A paper\n\nfirst page text"
+    assert index.summaries_complete()
+
+
+def test_document_without_summary_text_counts_as_covered(tmp_path):
+    index = ShardedIndex(tmp_path / "index")
+    add_chunks(index, "paper.pdf")
+    # No title and only whitespace on the first page: the summary is empty.
+    add_chunks(index, "scan.pdf", title="Unknown Title", first_page=" ")
+    index.save_manifest({"paper.pdf": "main", "scan.pdf": "main"})
+
+    embeddings = FakeEmbeddings()
+    backfill(index, embeddings)
+    assert index.documents_collection().get()["ids"] == ["paper.pdf"]
+    assert index.load_documents_without_summary() == {"scan.pdf"}
+    assert index.summaries_complete()
+
+    # Nothing is left to backfill on the next run.
+    assert index.unsummarised_documents() == set()
+    backfill(index, embeddings)
+    assert embeddings.calls == 1
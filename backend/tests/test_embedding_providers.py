@@ -0,0 +1,120 @@
+from pathlib import Path
+
+import embedding_providers
+import numpy as np
+import onnxruntime
+import pytest
+from embedding_providers import (
+    LocalOnnxEmbeddings,
+    collection_name_for,
+    get_tagged_collection,
+)
+from sharding import ShardedIndex
+from tokenizers import Tokenizer, models, pre_tokenizers
+
+WORDS = ["[PAD]", "[UNK]", "nitinol", "stress", "laser", "powder", "alloy"]
+
+
+class FakeSession:
+    """Stands in for an ONNX encoder: token i is embedded as [i, 1, 0]."""
+
+    def __init__(self, path, sess_options=None, providers=None):
+        self.runs = []
+
+    def get_inputs(self):
+        return [
+            type("Input", (), {"name": name})
+            for name in ("input_ids", "attention_mask")
+        ]
+
+    def run(self, output_names, feeds):
+        input_ids = feeds["input_ids"]
+        self.runs.append(input_ids.shape)
+        tokens = np.stack(
+            [input_ids, np.ones_like(input_ids), np.zeros_like(input_ids)], axis=-1
+        )
+        return [tokens.astype(np.float32)]
+
+
+@pytest.fixture
+def local_model(tmp_path, monkeypatch):
+    tokenizer = Tokenizer(
+        models.WordLevel({w: i for i, w in enumerate(WORDS)}, unk_token="[UNK]")
+    )
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    model_dir = tmp_path / "tiny-model"
+    model_dir.mkdir()
+    tokenizer.save(str(model_dir / "tokenizer.json"))
+    monkeypatch.setattr(onnxruntime, "InferenceSession", FakeSession)
+    return model_dir
+
+
+def use_provider(monkeypatch, provider, model_dir=Path("models/all-MiniLM-L6-v2")):
+    monkeypatch.setattr(embedding_providers, "EMBEDDING_PROVIDER", provider)
+    monkeypatch.setattr(embedding_providers, "LOCAL_EMBEDDING_MODEL_DIR", model_dir)
+
+
+def test_local_embeddings_are_mean_pooled_normalised_and_keep_input_order(local_model):
+    model = LocalOnnxEmbeddings(model_dir=local_model, batch_size=2, workers=2)
+    texts = ["nitinol stress laser powder", "alloy", "stress", "laser powder alloy"]
+    vectors = model.embed_documents(texts)
+
+    queries = [model.embed_query(text) for text in texts]
+    assert np.allclose(queries, vectors)
+    assert np.allclose(np.linalg.norm(vectors, axis=1), 1.0)
+    # Padded to four tokens next to a longer text, the mean is still over 4, 5, 6.
+    assert np.allclose(vectors[3], np.array([5, 1, 0]) / np.sqrt(26))
+    # Sorted by length, so short texts are batched together.
+    assert model.session.runs[:2] == [(2, 1), (2, 4)]
+    assert model.embed_documents([]) == []
+
+
+def test_collection_names_are_per_embedding_model(monkeypatch):
+    use_provider(monkeypatch, "google")
+    assert collection_name_for("scientific_articles") == "scientific_articles"
+    use_provider(monkeypatch, "local")
+    assert (
+        collection_name_for("scientific_articles")
+        == "scientific_articles__local-all-MiniLM-L6-v2"
+    )
+    use_provider(monkeypatch, "local", Path("models/bge-small-en"))
+    assert (
+        collection_name_for("scientific_articles")
+        == "scientific_articles__local-bge-small-en"
+    )
+
+
+def test_switching_provider_opens_a_separate_tagged_collection(tmp_path, monkeypatch):
+    use_provider(monkeypatch, "google")
+    google_index = ShardedIndex(tmp_path / "index")
+    google_index.collection("s").upsert(
+        ids=["a"], embeddings=[[1.0] * 768], documents=["google vector"]
+    )
+    google_index.close()
+
+    use_provider(monkeypatch, "local")
+    local_index = ShardedIndex(tmp_path / "index")
+    local = local_index.collection("s")
+    assert local.count() == 0
+    assert local.metadata["embedding_model"] == "local/all-MiniLM-L6-v2"
+    local.upsert(ids=["a"], embeddings=[[1.0] * 384], documents=["local vector"])
+    local_index.close()
+
+    use_provider(monkeypatch, "google")
+    google_index = ShardedIndex(tmp_path / "index")
+    google = google_index.collection("s")
+    assert google.metadata["embedding_model"] == "google/models/text-embedding-004"
+    assert google.get()["documents"] == ["google vector"]
+    google_index.close()
+
+
+def test_collection_tagged_with_another_model_is_refused(tmp_path, monkeypatch):
+    import chromadb
+
+    client = chromadb.PersistentClient(path=str(tmp_path / "db"))
+    client.create_collection(
+        "scientific_articles", metadata={"embedding_model": "local/old-model"}
+    )
+    use_provider(monkeypatch, "google")
+    with pytest.raises(ValueError, match="local/old-model"):
+        get_tagged_collection(client, "scientific_articles")
@@ -0,0 +1,139 @@
+import asyncio
+import json
+
+import pytest
+from evaluation import (
+    FIXTURE_CORPUS_PATH,
+    FIXTURE_MIN_RECALL,
+    FixturePipeline,
+    HashingEmbeddings,
+    ReplayBackend,
+    bootstrap_questions,
+    build_fixture_index,
+    evaluate_answers,
+    evaluate_fixture,
+    evaluate_retrieval,
+    prompt_hash,
+)
+from llm_gateway import GenerationGateway
+from response_formatting import format_answer
+
+SOURCES = [
+    {
+        "number": number,
+        "title": f"Paper {number}",
+        "doi": f"10.5555/fixture.00{number}",
+        "url": f"https://doi.org/10.5555/fixture.00{number}",
+        "page_info": "Page 1",
+        "source_file": f"paper{number}.pdf",
+        "pages": [1],
+        "chunks": [],
+    }
+    for number in (1, 2)
+]
+
+
+class AnswerPipeline:
+    """The parts of rag_pipeline that evaluate_answers uses."""
+
+    GenerationGateway = GenerationGateway
+
+    def __init__(self, prompt_prefix="Context: two papers."):
+        self.prompt_prefix = prompt_prefix
+        self.generation_gateway = None
+
+    def prompt(self, question):
+        return f"{self.prompt_prefix}\nQuestion: {question}"
+
+    def answer_query(self, question):
+        answer = self.generation_gateway.generate(self.prompt(question))
+        return format_answer(answer, SOURCES)
+
+
+@pytest.fixture
+def pipeline(tmp_path):
+    embeddings = HashingEmbeddings()
+    index = build_fixture_index(tmp_path / "index", embeddings)
+    yield FixturePipeline(index, embeddings)
+    index.close()
+
+
+def test_fixture_corpus_recall():
+    report = evaluate_fixture()
+    for result in report.values():
+        assert result["questions"] >= 6
+        assert result["recall@5"] >= FIXTURE_MIN_RECALL
+    assert report["flat"]["shortlist_size"] == 0
+
+
+def test_retrieval_needs_labelled_questions(pipeline):
+    unlabelled = [{"id": "q", "question": "porosity?", "expected_dois": []}]
+    with pytest.raises(ValueError):
+        evaluate_retrieval(pipeline, unlabelled)
+
+
+def test_bootstrap_takes_questions_from_body_chunks(pipeline):
+    corpus = {
+        paper["doi"]: paper for paper in json.loads(FIXTURE_CORPUS_PATH.read_text())
+    }
+    gold_set = []
+    assert bootstrap_questions(pipeline, gold_set, limit=3) == 3
+    for entry in gold_set:
+        assert entry["source"] == "bootstrap-chunk"
+        chunks = corpus[entry["expected_dois"][0]]["chunks"]
+        body = " ".join(chunk["text"] for chunk in chunks if chunk["page"] != 0)
+        assert set(entry["question"].split()) <= set(body.split())
+
+
+def test_replay_backend_matches_prompts_and_falls_back_to_the_question():
+    fixtures = {
+        "q1": {"prompt_sha256": prompt_hash("exact prompt"), "response": "A [1]."}
+    }
+    backend = ReplayBackend(fixtures)
+    assert asyncio.run(backend.agenerate("exact prompt")) == "A [1]."
+    assert not backend.stale
+
+    backend.question_id = "q1"
+    assert asyncio.run(backend.agenerate("prompt after a retrieval change")) == (
+        "A [1]."
+    )
+    assert backend.stale
+
+    backend.question_id = "q2"
+    with pytest.raises(KeyError):
+        asyncio.run(backend.agenerate("unknown prompt"))
+
+
+def test_answer_scoring_counts_citations_and_stale_fixtures():
+    pipeline = AnswerPipeline()
+    gold_set = [
+        {"id": "q1", "question": "Porosity?", "expected_dois": ["10.5555/FIXTURE.001"]},
+        {"id": "q2", "question": "Hardness?", "expected_dois": ["10.5555/fixture.001"]},
+        {"id": "q3", "question": "Grain size?", "expected_dois": []},
+        {"id": "q4", "question": "Not recorded?", "expected_dois": []},
+    ]
+    fixtures = {
+        "q1": {
+            "prompt_sha256": prompt_hash(pipeline.prompt("Porosity?")),
+            "response": "Porosity drops [1].\nhas_references: true",
+        },
+        "q2": {
+            # Recorded against a different context, so it is replayed as stale.
+            "prompt_sha256": prompt_hash("an older prompt"),
+            "response": "Hardness rises [2][3].\nhas_references: true",
+        },
+        "q3": {
+            "prompt_sha256": prompt_hash(pipeline.prompt("Grain size?")),
+            "response": "Not enough information found.\nhas_references: false",
+        },
+    }
+
+    results = evaluate_answers(pipeline, gold_set, fixtures)
+    assert results == {
+        "answers": 3,
+        "stale_fixtures": 1,
+        "with_references": 2,
+        "invalid_citations": 1,
+        "cited_expected_paper": 1,
+        "labelled_answers": 2,
+    }
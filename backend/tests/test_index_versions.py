@@ -0,0 +1,83 @@
+import threading
+import time
+
+import index_versions
+import pytest
+from index_versions import (
+    ServingIndex,
+    ingestion_lock,
+    new_version_directory,
+    sample_recall,
+    swap_current,
+)
+from sharding import ShardedIndex
+
+
+def add_chunks(index, chunk_ids, embedding, text):
+    index.collection("main").upsert(
+        ids=chunk_ids,
+        embeddings=[embedding] * len(chunk_ids),
+        documents=[text] * len(chunk_ids),
+        metadatas=[{"source_file": f"{chunk_id}.pdf"} for chunk_id in chunk_ids],
+    )
+
+
+def test_sample_recall_accepts_identical_chunks(tmp_path):
+    index = ShardedIndex(tmp_path / "index")
+    # More identical chunks than k, so some are not returned by their own id.
+    add_chunks(index, [f"copy{i}" for i in range(5)], [1.0, 0.0, 0.0], "same text")
+    add_chunks(index, ["other"], [0.0, 1.0, 0.0], "other text")
+    assert sample_recall(index, samples=6, k=2) == 1.0
+    index.close()
+
+
+def test_swap_closes_retired_index_after_grace(tmp_path, monkeypatch):
+    monkeypatch.setattr(index_versions, "RELOAD_CHECK_SECONDS", 0)
+    monkeypatch.setattr(index_versions, "RETIRE_GRACE_SECONDS", 0)
+    root = tmp_path / "root"
+    for version in ("v1", "v2"):
+        add_chunks(
+            ShardedIndex(root / "versions" / version), [version], [1.0, 0.0], version
+        )
+    swap_current(root, "v1")
+    serving = ServingIndex(root)
+    old = serving.current()
+    assert old.count() == 1
+
+    swap_current(root, "v2")
+    new = serving.current()
+    assert new is not old
+    with pytest.raises(RuntimeError):
+        old.collection("main")
+    assert new.search([1.0, 0.0], 1)[0]["id"] == "v2"
+    serving.close()
+
+
+def test_version_directories_do_not_collide_within_a_second(tmp_path):
+    directories = [new_version_directory(tmp_path) for _ in range(3)]
+    assert len({d.name for d in directories}) == 3
+    assert all(d.is_dir() for d in directories)
+    assert sorted(d.name for d in directories) == [d.name for d in directories]
+
+
+def test_ingestion_waits_for_a_build_and_sees_its_swap(tmp_path, monkeypatch):
+    monkeypatch.setattr(index_versions, "RELOAD_CHECK_SECONDS", 60)
+    root = tmp_path / "root"
+    add_chunks(ShardedIndex(root / "versions" / "v1"), ["v1"], [1.0, 0.0], "v1")
+    swap_current(root, "v1")
+    serving = ServingIndex(root)
+    ingested_into = []
+
+    def ingest():
+        with ingestion_lock(root):
+            ingested_into.append(serving.current(refresh=True).base_directory.name)
+
+    with ingestion_lock(root):
+        writer = threading.Thread(target=ingest)
+        writer.start()
+        time.sleep(0.1)
+        assert not ingested_into
+        swap_current(root, "v2")
+    writer.join(timeout=5)
+    assert ingested_into == ["v2"]
+    serving.close()
@@ -0,0 +1,96 @@
+import os
+
+import fitz
+import pytest
+
+# ingestion creates its embedding client at import; no request is made with it.
+os.environ.setdefault("GOOGLE_API_KEY", "test")
+
+import ingestion  # noqa: E402
+from evaluation import HashingEmbeddings  # noqa: E402
+from ingestion import (  # noqa: E402
+    ingest_pdfs,
+    iter_batches,
+    load_processed_files_log,
+)
+from sharding import ShardedIndex  # noqa: E402
+
+TEXT = "Nitinol parts printed by laser powder bed fusion keep residual stress. " * 40
+
+
+class FailingEmbeddings(HashingEmbeddings):
+    """Fails the embedding call numbered fail_on, counting from 1."""
+
+    def __init__(self, fail_on):
+        super().__init__()
+        self.fail_on = fail_on
+        self.calls = 0
+
+    def embed_documents(self, texts):
+        self.calls += 1
+        if self.calls == self.fail_on:
+            raise RuntimeError("embedding API unavailable")
+        return super().embed_documents(texts)
+
+
+def write_pdf(path, pages=2):
+    with fitz.open() as doc:
+        for _ in range(pages):
+            doc.new_page().insert_textbox(fitz.Rect(36, 36, 560, 800), TEXT)
+        doc.save(path)
+    return path
+
+
+@pytest.fixture
+def setup(tmp_path, monkeypatch):
+    monkeypatch.setattr(ingestion, "PRESCAN_ENABLED", False)
+    monkeypatch.setattr(ingestion, "text_store", None)
+    pdf = write_pdf(tmp_path / "paper.pdf")
+    return pdf, ShardedIndex(tmp_path / "index")
+
+
+def test_batches_hold_at_most_batch_size_chunks():
+    pulled = []
+
+    def chunks():
+        for i in range(10):
+            pulled.append(i)
+            yield i
+
+    batches = iter_batches(chunks(), batch_size=4, memory_limit_mb=0)
+    assert next(batches) == [0, 1, 2, 3]
+    # Nothing past the first batch is read until it has been consumed.
+    assert pulled == [0, 1, 2, 3]
+    assert list(batches) == [[4, 5, 6, 7], [8, 9]]
+
+
+def test_batches_flush_early_and_shrink_above_rss_ceiling(monkeypatch):
+    readings = iter([2000, 2000] + [100] * 20)
+    monkeypatch.setattr(ingestion, "current_rss_mb", lambda: next(readings))
+    batches = list(iter_batches(range(10), batch_size=8, memory_limit_mb=1000))
+    # The first chunk is flushed alone, after which the batch size is halved.
+    assert [len(batch) for batch in batches] == [1, 4, 4, 1]
+    assert [chunk for batch in batches for chunk in batch] == list(range(10))
+
+
+def test_ingests_chunks_summary_and_manifest(setup, monkeypatch):
+    pdf, index = setup
+    monkeypatch.setattr(ingestion, "embeddings", HashingEmbeddings())
+    ingest_pdfs([pdf], target_index=index)
+
+    shard_key = index.load_manifest()["paper.pdf"]
+    assert index.collection(shard_key).count() > 0
+    assert index.documents_collection().get()["ids"] == ["paper.pdf"]
+    assert "paper.pdf" in load_processed_files_log(index.base_directory)
+
+
+def test_failed_file_leaves_no_partial_embeddings(setup, monkeypatch):
+    pdf, index = setup
+    # The chunks are embedded and upserted; embedding the summary then fails.
+    monkeypatch.setattr(ingestion, "embeddings", FailingEmbeddings(fail_on=2))
+    ingest_pdfs([pdf], target_index=index)
+
+    assert index.count() == 0
+    assert index.documents_collection().count() == 0
+    assert "paper.pdf" not in load_processed_files_log(index.base_directory)
+    assert "paper.pdf" not in index.load_manifest()
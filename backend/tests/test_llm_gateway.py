@@ -0,0 +1,219 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import llm_gateway
+import pytest
+from llm_gateway import (
+    CircuitBreaker,
+    GeminiRestBackend,
+    GenerationGateway,
+    ProviderUnavailableError,
+)
+
+
+class FakeBackend:
+    """In-process backend whose calls take `delays` seconds in turn."""
+
+    def __init__(self, delays=(0.0,), fail=False):
+        self.delays = list(delays)
+        self.fail = fail
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    async def agenerate(self, prompt: str) -> str:
+        with self._lock:
+            call = self.calls
+            self.calls += 1
+        await asyncio.sleep(self.delays[min(call, len(self.delays) - 1)])
+        if self.fail:
+            raise RuntimeError("provider error")
+        return f"answer {call} to {prompt}"
+
+    async def astream(self, prompt: str):
+        for word in (await self.agenerate(prompt)).split():
+            yield word
+
+
+class FakeGeminiHandler(BaseHTTPRequestHandler):
+    """Answers generateContent; the server's `delays` apply to calls in turn."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        server = self.server
+        with server.lock:
+            call = server.calls
+            server.calls += 1
+            server.client_ports.add(self.client_address[1])
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        time.sleep(server.delays[min(call, len(server.delays) - 1)])
+        prompt = body["contents"][0]["parts"][0]["text"]
+        payload = json.dumps(
+            {"candidates": [{"content": {"parts": [{"text": f"{call}:{prompt}"}]}}]}
+        ).encode()
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client cancelled this request after a hedge won.
+            self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def gemini_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeGeminiHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.calls = 0
+    server.client_ports = set()
+    server.delays = [0.0]
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def rest_backend(server):
+    host, port = server.server_address
+    return GeminiRestBackend("fake-model", "key", f"http://{host}:{port}")
+
+
+def test_breaker_opens_after_threshold_and_half_opens_after_reset():
+    breaker = CircuitBreaker(failure_threshold=2, reset_seconds=0.05)
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    with pytest.raises(ProviderUnavailableError):
+        breaker.before_call()
+
+    time.sleep(0.06)
+    assert breaker.state == "half_open"
+    breaker.before_call()
+    # Only one probe is let through while half-open.
+    with pytest.raises(ProviderUnavailableError):
+        breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == "closed"
+
+
+def test_failed_probe_reopens_breaker():
+    breaker = CircuitBreaker(failure_threshold=1, reset_seconds=0.05)
+    breaker.before_call()
+    breaker.record_failure()
+    time.sleep(0.06)
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == "open"
+
+
+def test_cancelled_probe_frees_the_probe_slot():
+    breaker = CircuitBreaker(failure_threshold=1, reset_seconds=0.0)
+    breaker.before_call()
+    breaker.record_failure()
+    breaker.before_call()
+    breaker.record_cancelled()
+    breaker.before_call()
+    assert breaker.state == "half_open"
+
+
+def test_gateway_fails_fast_while_breaker_is_open():
+    backend = FakeBackend(fail=True)
+    gateway = GenerationGateway(
+        backend, CircuitBreaker(failure_threshold=2, reset_seconds=60), False
+    )
+    for prompt in ("a", "b"):
+        with pytest.raises(RuntimeError):
+            gateway.generate(prompt)
+    with pytest.raises(ProviderUnavailableError):
+        gateway.generate("c")
+    assert backend.calls == 2
+    assert gateway.stats["breaker_rejections"] == 1
+    with pytest.raises(ProviderUnavailableError):
+        gateway.check_available()
+
+
+def test_concurrent_identical_prompts_are_coalesced():
+    backend = FakeBackend(delays=(0.1,))
+    gateway = GenerationGateway(backend, hedge_enabled=False)
+
+    async def ask_three_times():
+        return await asyncio.gather(*(gateway.agenerate("same") for _ in range(3)))
+
+    answers = asyncio.run(ask_three_times())
+    assert answers == ["answer 0 to same"] * 3
+    assert backend.calls == 1
+    assert gateway.stats["coalesced"] == 2
+
+
+def test_slow_call_is_hedged_and_the_faster_hedge_wins(monkeypatch):
+    monkeypatch.setattr(llm_gateway, "HEDGE_DELAY_SECONDS", "0.05")
+    backend = FakeBackend(delays=(1.0, 0.0))
+    gateway = GenerationGateway(backend, hedge_enabled=True)
+
+    start = time.monotonic()
+    assert gateway.generate("slow") == "answer 1 to slow"
+    assert time.monotonic() - start < 0.5
+    assert gateway.stats["hedges_sent"] == 1
+    assert gateway.stats["hedge_wins"] == 1
+
+
+def test_fast_call_is_not_hedged(monkeypatch):
+    monkeypatch.setattr(llm_gateway, "HEDGE_DELAY_SECONDS", "0.5")
+    backend = FakeBackend(delays=(0.0,))
+    gateway = GenerationGateway(backend, hedge_enabled=True)
+    assert gateway.generate("fast") == "answer 0 to fast"
+    assert backend.calls == 1
+    assert gateway.stats["hedges_sent"] == 0
+
+
+def test_hedge_delay_tracks_latency_percentile(monkeypatch):
+    monkeypatch.setattr(llm_gateway, "HEDGE_DELAY_SECONDS", None)
+    gateway = GenerationGateway(FakeBackend())
+    assert gateway.hedge_delay() == llm_gateway.DEFAULT_HEDGE_DELAY_SECONDS
+    gateway.latencies.extend(i / 100 for i in range(1, 101))
+    assert gateway.hedge_delay() == pytest.approx(0.96)
+
+
+def test_astream_yields_chunks_on_the_callers_loop():
+    gateway = GenerationGateway(FakeBackend())
+
+    async def collect():
+        return [chunk async for chunk in gateway.astream("hi")]
+
+    assert asyncio.run(collect()) == ["answer", "0", "to", "hi"]
+    assert gateway.stats["streams"] == 1
+
+
+def test_rest_backend_reuses_pooled_connections(gemini_server):
+    gateway = GenerationGateway(rest_backend(gemini_server), hedge_enabled=False)
+    answers = [gateway.generate(f"q{i}") for i in range(5)]
+    assert answers == [f"{i}:q{i}" for i in range(5)]
+    assert gemini_server.calls == 5
+    assert len(gemini_server.client_ports) == 1
+
+
+def test_rest_backend_hedges_a_slow_request(gemini_server, monkeypatch):
+    monkeypatch.setattr(llm_gateway, "HEDGE_DELAY_SECONDS", "0.05")
+    gemini_server.delays = [1.0, 0.0]
+    gateway = GenerationGateway(rest_backend(gemini_server), hedge_enabled=True)
+
+    start = time.monotonic()
+    assert gateway.generate("slow") == "1:slow"
+    assert time.monotonic() - start < 0.5
+    assert gateway.stats["hedges_sent"] == 1
+    assert gateway.stats["hedge_wins"] == 1
+    # The hedge needed a second connection; later calls reuse a pooled one.
+    gateway.generate("next")
+    assert len(gemini_server.client_ports) == 2
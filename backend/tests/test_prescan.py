@@ -0,0 +1,81 @@
+import json
+import subprocess
+
+import fitz
+import prescan
+from prescan import OCR, OK, QUARANTINE, RETRY, prescan_pdfs, scan
+
+TEXT = "Residual stress in additively manufactured nitinol. " * 10
+
+
+def write_pdf(path, text=TEXT):
+    with fitz.open() as doc:
+        page = doc.new_page()
+        if text:
+            page.insert_textbox(fitz.Rect(36, 36, 560, 800), text)
+        doc.save(path)
+    return path
+
+
+def test_scan_checks_files_in_worker_processes(tmp_path):
+    good = write_pdf(tmp_path / "good.pdf")
+    scanned = write_pdf(tmp_path / "scanned.pdf", text="")
+    truncated = tmp_path / "truncated.pdf"
+    truncated.write_bytes(good.read_bytes()[:200])
+    empty = tmp_path / "empty.pdf"
+    empty.touch()
+
+    results = scan([good, scanned, truncated, empty], workers=2)
+    assert results[good] == (OK, "")
+    assert results[scanned][0] == OCR
+    assert results[truncated][0] == QUARANTINE and "truncated" in results[truncated][1]
+    assert results[empty] == (QUARANTINE, "empty file")
+
+
+def test_scan_reports_timeouts_as_retry(tmp_path):
+    good = write_pdf(tmp_path / "good.pdf")
+    assert scan([good], timeout=0.001)[good][0] == RETRY
+
+
+def test_failed_or_garbled_checks_are_retried(tmp_path, monkeypatch):
+    good = write_pdf(tmp_path / "good.pdf")
+    outputs = iter(
+        [
+            subprocess.CompletedProcess([], -11, stdout="", stderr="segfault"),
+            subprocess.CompletedProcess([], 0, stdout="warning: bad xref\n"),
+            subprocess.CompletedProcess([], 0, stdout='["maybe", ""]\n'),
+        ]
+    )
+    monkeypatch.setattr(prescan.subprocess, "run", lambda *a, **k: next(outputs))
+    for _ in range(3):
+        assert scan([good], workers=1)[good][0] == RETRY
+
+
+def test_prescan_leaves_files_without_a_verdict_in_place(tmp_path, monkeypatch):
+    monkeypatch.setattr(prescan, "QUARANTINE_DIRECTORY", tmp_path / "quarantine")
+    good = write_pdf(tmp_path / "good.pdf")
+    monkeypatch.setattr(
+        prescan, "scan", lambda paths: {path: (RETRY, "timed out") for path in paths}
+    )
+    assert prescan_pdfs([good]) == []
+    assert good.exists() and not (tmp_path / "quarantine").exists()
+
+
+def test_prescan_moves_rejected_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(prescan, "QUARANTINE_DIRECTORY", tmp_path / "quarantine")
+    monkeypatch.setattr(prescan, "OCR_DIRECTORY", tmp_path / "ocr")
+    downloads = tmp_path / "downloads"
+    downloads.mkdir()
+    good = write_pdf(downloads / "good.pdf")
+    broken = downloads / "broken.pdf"
+    broken.write_bytes(b"<html>not a pdf</html>")
+    downloading = write_pdf(downloads / "downloading.pdf")
+    (downloads / "downloading.pdf.aria2").touch()
+
+    assert prescan_pdfs([good, broken, downloading]) == [good]
+    assert downloading.exists() and not broken.exists()
+    (entry,) = [
+        json.loads(line)
+        for line in (tmp_path / "quarantine" / "reasons.jsonl").read_text().splitlines()
+    ]
+    assert entry["file"] == "broken.pdf" and entry["reason"] == "no PDF header"
@@ -0,0 +1,46 @@
+import os
+import time
+
+import profiling
+from profiling import ProfileSession, prune_profiles
+
+
+def write_profile(directory, profile_id, age_days=0.0):
+    modified = time.time() - age_days * 86400
+    for suffix in (".json", ".prof", ".stacks.folded", ".stages.folded"):
+        path = directory / f"{profile_id}{suffix}"
+        path.write_text("{}")
+        os.utime(path, (modified, modified))
+
+
+def test_prune_keeps_the_newest_profiles(tmp_path):
+    for i in range(5):
+        write_profile(tmp_path, f"chat-{i}", age_days=5 - i)
+    assert sorted(prune_profiles(tmp_path, keep=2, max_age_days=0)) == [
+        "chat-0",
+        "chat-1",
+        "chat-2",
+    ]
+    assert sorted(p.name for p in tmp_path.iterdir()) == sorted(
+        f"chat-{i}{suffix}"
+        for i in (3, 4)
+        for suffix in (".json", ".prof", ".stacks.folded", ".stages.folded")
+    )
+
+
+def test_prune_removes_profiles_past_the_age_limit(tmp_path):
+    write_profile(tmp_path, "old", age_days=10)
+    write_profile(tmp_path, "new", age_days=1)
+    assert prune_profiles(tmp_path, keep=100, max_age_days=7) == ["old"]
+    assert {p.stem.split(".")[0] for p in tmp_path.iterdir()} == {"new"}
+
+
+def test_profile_session_applies_retention(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiling, "PROFILE_KEEP", 1)
+    write_profile(tmp_path, "chat-old", age_days=1)
+    with ProfileSession("chat", tmp_path) as session:
+        with session.timings.stage("retrieve"):
+            pass
+    remaining = {p.name.split(".")[0] for p in tmp_path.iterdir()}
+    assert remaining == {session.profile_id}
+    assert session.report["stages"].keys() == {"retrieve"}
@@ -0,0 +1,83 @@
+import query_cache
+from langchain_core.embeddings import Embeddings
+from query_cache import CachedQueryEmbeddings, load_warmup_queries, normalize_query
+
+
+class CountingEmbeddings(Embeddings):
+    def __init__(self):
+        self.queries = []
+
+    def embed_documents(self, texts):
+        return [[float(len(text)), 0.5] for text in texts]
+
+    def embed_query(self, text):
+        self.queries.append(text)
+        return [float(len(text)), 0.25]
+
+
+def test_normalize_query_ignores_case_whitespace_and_trailing_punctuation():
+    assert (
+        normalize_query("  Nitinol   residual\tStress? ") == "nitinol residual stress"
+    )
+
+
+def test_repeated_query_is_served_from_memory(tmp_path):
+    base = CountingEmbeddings()
+    cache = CachedQueryEmbeddings(base, tmp_path / "cache.sqlite", "model-a")
+    first = cache.embed_query("Shape memory alloys")
+    assert cache.embed_query("shape memory alloys?") == first
+    assert base.queries == ["Shape memory alloys"]
+    assert cache.stats == {"memory_hits": 1, "disk_hits": 0, "misses": 1}
+
+
+def test_disk_cache_survives_a_restart_and_is_namespaced(tmp_path):
+    path = tmp_path / "cache.sqlite"
+    CachedQueryEmbeddings(CountingEmbeddings(), path, "model-a").embed_query("x")
+
+    base = CountingEmbeddings()
+    restarted = CachedQueryEmbeddings(base, path, "model-a")
+    assert restarted.embed_query("x") == [1.0, 0.25]
+    assert restarted.stats["disk_hits"] == 1 and not base.queries
+
+    other_model = CountingEmbeddings()
+    CachedQueryEmbeddings(other_model, path, "model-b").embed_query("x")
+    assert other_model.queries == ["x"]
+
+
+def test_memory_cache_is_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(query_cache, "MEMORY_CACHE_SIZE", 2)
+    cache = CachedQueryEmbeddings(CountingEmbeddings(), tmp_path / "c.sqlite", "m")
+    for query in ("a", "b", "c"):
+        cache.embed_query(query)
+    assert cache.metrics()["memory_entries"] == 2
+    assert cache.metrics()["disk_entries"] == 3
+
+
+def test_warm_up_embeds_only_missing_queries(tmp_path):
+    base = CountingEmbeddings()
+    cache = CachedQueryEmbeddings(base, tmp_path / "cache.sqlite", "m")
+    cache.embed_query("nitinol")
+    assert cache.warm_up(["Nitinol", "perovskite", "perovskite "]) == 1
+    assert sorted(base.queries) == ["nitinol", "perovskite"]
+
+
+def test_warm_up_leaves_hit_rate_stats_alone(tmp_path):
+    cache = CachedQueryEmbeddings(CountingEmbeddings(), tmp_path / "cache.sqlite", "m")
+    cache.embed_query("nitinol")
+    cache.warm_up(["nitinol", "perovskite"])
+    assert cache.stats == {"memory_hits": 0, "disk_hits": 0, "misses": 1}
+    cache.embed_query("perovskite")
+    assert cache.stats["memory_hits"] == 1
+
+
+def test_document_embeddings_are_not_cached(tmp_path):
+    cache = CachedQueryEmbeddings(CountingEmbeddings(), tmp_path / "c.sqlite", "m")
+    assert cache.embed_documents(["ab"]) == [[2.0, 0.5]]
+    assert cache.metrics()["disk_entries"] == 0
+
+
+def test_load_warmup_queries_skips_comments_and_blank_lines(tmp_path):
+    path = tmp_path / "warmup.txt"
+    path.write_text("# comment\nnitinol\n\nperovskite\n")
+    assert load_warmup_queries(path) == ["nitinol", "perovskite"]
+    assert load_warmup_queries(tmp_path / "missing.txt") == []
@@ -0,0 +1,75 @@
+from response_formatting import IncrementalAnswerFormatter, format_answer
+
+SOURCES = [
+    {
+        "number": 1,
+        "title": "Paper",
+        "doi": "10.1/1",
+        "url": "https://doi.org/10.1/1",
+        "page_info": "Page 1",
+        "source_file": "paper.pdf",
+        "pages": [1],
+        "chunks": ["paper_page0_chunk0"],
+    }
+]
+
+
+def stream(chunks, sources=SOURCES):
+    formatter = IncrementalAnswerFormatter(sources)
+    shown = "".join(formatter.feed(chunk) for chunk in chunks)
+    result = formatter.finish()
+    return shown + result["tail"], result, formatter
+
+
+def test_flag_at_end_of_stream_is_hidden():
+    shown, result, formatter = stream(["Answer [1].\n", "has_refer", "ences: true"])
+    assert shown == "Answer [1].\n"
+    assert result["has_references"] and result["citations"]
+    assert formatter.answer() == "Answer [1]."
+
+
+def test_flag_followed_by_newline_is_hidden():
+    shown, result, _ = stream(["Answer [1].\nhas_references: true\n"])
+    assert "has_references" not in shown
+    assert result["has_references"]
+
+
+def test_flag_in_backticks_split_across_chunks():
+    shown, result, _ = stream(["Answer.\n`", "has_references: false`", "\n\n"])
+    assert shown == "Answer.\n"
+    assert not result["has_references"] and result["citations"] == []
+
+
+def test_line_resembling_flag_is_released_when_text_follows():
+    shown, result, _ = stream(["has_ref", "\nMore text [1]."])
+    assert shown == "has_ref\nMore text [1]."
+    assert result["has_references"]
+
+
+def test_stream_matches_batch_formatting():
+    raw = "The band gap is 1.1 eV [1].\nhas_references: true"
+    formatted = format_answer(raw, SOURCES)
+    shown, result, _ = stream([raw[i : i + 5] for i in range(0, len(raw), 5)])
+    assert shown.strip() + result["references_markdown"] == formatted["answer"]
+    assert result["citations"] == formatted["citations"]
+
+
+def test_flag_on_the_same_line_as_answer_text_is_hidden():
+    raw = "The band gap is 1.1 eV [1]. has_references: true"
+    formatted = format_answer(raw, SOURCES)
+    for size in range(1, 8):
+        formatter = IncrementalAnswerFormatter(SOURCES)
+        pieces = []
+        for i in range(0, len(raw), size):
+            pieces.append(formatter.feed(raw[i : i + size]))
+            assert "has_ref" not in "".join(pieces)
+        result = formatter.finish()
+        shown = "".join(pieces) + result["tail"]
+        assert shown.strip() + result["references_markdown"] == formatted["answer"]
+        assert result["citations"] == formatted["citations"]
+
+
+def test_text_ending_in_a_flag_prefix_is_released_when_more_follows():
+    formatter = IncrementalAnswerFormatter(SOURCES)
+    assert formatter.feed("It was measured in a bath") == "It was measured in a bat"
+    assert formatter.feed(" of water.") == "h of water."
@@ -0,0 +1,89 @@
+from sessions import Session, SessionStore
+
+EMBEDDINGS = {
+    "a": [1.0, 0.0],
+    "b": [0.9, 0.1],
+    "c": [0.0, 1.0],
+    "d": [0.1, 0.9],
+}
+
+
+def hit(chunk_id, query):
+    embedding = EMBEDDINGS[chunk_id]
+    distance = sum((x - q) ** 2 for x, q in zip(embedding, query))
+    return {
+        "id": chunk_id,
+        "document": f"text of {chunk_id}",
+        "metadata": {"source_file": f"{chunk_id}.pdf"},
+        "distance": distance,
+        "shard": "main",
+    }
+
+
+class FakeIndex:
+    def __init__(self):
+        self.searches = 0
+        self.fetched = []
+
+    def search(self, query_embedding, k):
+        self.searches += 1
+        hits = [hit(chunk_id, query_embedding) for chunk_id in EMBEDDINGS]
+        return sorted(hits, key=lambda h: h["distance"])[:k]
+
+    def get_embeddings(self, hits):
+        self.fetched.extend(h["id"] for h in hits)
+        return {h["id"]: EMBEDDINGS[h["id"]] for h in hits}
+
+
+def retrieve(session, index, query_embedding, k=2):
+    return session.retrieve(
+        "question", query_embedding, k, index.search, index.get_embeddings
+    )
+
+
+def test_similar_follow_up_reuses_last_search():
+    session, index = Session("s"), FakeIndex()
+    hits, mode = retrieve(session, index, [1.0, 0.0])
+    assert mode == "search" and [h["id"] for h in hits] == ["a", "b"]
+    assert all("embedding" not in h for h in session.chunks.values())
+
+    hits, mode = retrieve(session, index, [0.99, 0.01])
+    assert mode == "reuse" and [h["id"] for h in hits] == ["a", "b"]
+    assert index.searches == 1 and index.fetched == []
+
+
+def test_different_follow_up_searches_and_rescores_history():
+    session, index = Session("s"), FakeIndex()
+    retrieve(session, index, [1.0, 0.0])
+    hits, mode = retrieve(session, index, [0.5, 0.5], k=3)
+    assert mode == "extend" and index.searches == 2
+    # Remembered chunks not returned by the new search are read back by id.
+    assert sorted(index.fetched) == sorted(
+        {"a", "b"} - {h["id"] for h in index.search([0.5, 0.5], 3)}
+    )
+    distances = [h["distance"] for h in hits]
+    assert distances == sorted(distances)
+
+
+def test_store_evicts_least_recently_used_beyond_memory_budget():
+    index = FakeIndex()
+    store = SessionStore(max_bytes=60)
+    first = store.get_or_create()
+    retrieve(first, index, [1.0, 0.0])
+    store.record_mode("search")
+    assert first.size_bytes > 0
+
+    second = store.get_or_create()
+    retrieve(second, index, [0.0, 1.0])
+    store.record_mode("search")
+    assert first.size_bytes + second.size_bytes > 60
+    assert store.get_or_create(second.session_id) is second
+    assert store.get_or_create(first.session_id) is not first
+    assert store.metrics()["evicted"] >= 1
+
+
+def test_store_caps_session_count():
+    store = SessionStore(max_sessions=2)
+    ids = [store.get_or_create().session_id for _ in range(3)]
+    assert store.get_or_create(ids[0]).session_id != ids[0]
+    assert store.get_or_create(ids[2]).session_id == ids[2]
@@ -0,0 +1,104 @@
+import random
+
+import pytest
+from sharding import SearchResults, ShardedIndex
+
+
+def vector(center, rng):
+    return [center + rng.random() * 0.01 for _ in range(4)]
+
+
+def paper(i):
+    return {"source_file": f"p{i}.pdf", "title": f"Paper {i}", "doi": f"10.1/{i}"}
+
+
+def add_paper(index, i, rng, chunks=3):
+    metadata = paper(i)
+    shard_key = index.shard_for(metadata)
+    index.collection(shard_key).upsert(
+        ids=[f"p{i}_page0_chunk{j}" for j in range(chunks)],
+        embeddings=[vector(i, rng) for _ in range(chunks)],
+        documents=[f"chunk {j} of paper {i}" for j in range(chunks)],
+        metadatas=[{**metadata, "page": 0}] * chunks,
+    )
+    return metadata, shard_key
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = ShardedIndex(tmp_path / "index", strategy="doi_hash", num_shards=3)
+    rng = random.Random(0)
+    for i in range(6):
+        add_paper(index, i, rng)
+    return index
+
+
+def test_search_merges_shards_by_distance(index):
+    hits = index.search(vector(2, random.Random(1)), 4)
+    assert isinstance(hits, SearchResults) and not hits.partial
+    assert [hit["metadata"]["source_file"] for hit in hits[:3]] == ["p2.pdf"] * 3
+    assert hits[3]["metadata"]["source_file"] in ("p1.pdf", "p3.pdf")
+    assert len(index.shard_keys()) > 1
+
+
+def test_failing_shard_is_reported_as_partial(index, monkeypatch):
+    broken = index.shard_for(paper(2))
+    original = index.collection
+
+    def collection(shard_key, references=False):
+        if shard_key == broken:
+            raise RuntimeError("shard unavailable")
+        return original(shard_key, references)
+
+    monkeypatch.setattr(index, "collection", collection)
+    hits = index.search(vector(2, random.Random(1)), 3)
+    assert hits.partial and hits.failed_shards == [broken]
+    assert all(hit["shard"] != broken for hit in hits)
+
+
+def add_summary(index, metadata, shard_key, i):
+    index.upsert_document(metadata, shard_key, vector(i, random.Random(i)), "summary")
+
+
+def test_two_stage_search_uses_summary_shortlist(index):
+    manifest = {}
+    for i in range(6):
+        metadata, shard_key = paper(i), index.shard_for(paper(i))
+        add_summary(index, metadata, shard_key, i)
+        manifest[metadata["source_file"]] = shard_key
+    index.save_manifest(manifest)
+
+    assert index.summaries_complete()
+    hits = index.search_two_stage(vector(4, random.Random(1)), 3, shortlist_size=1)
+    assert {hit["metadata"]["source_file"] for hit in hits} == {"p4.pdf"}
+
+
+def test_two_stage_search_is_flat_with_partial_summaries(index):
+    manifest = {}
+    for i in range(6):
+        metadata, shard_key = paper(i), index.shard_for(paper(i))
+        manifest[metadata["source_file"]] = shard_key
+        if i < 2:
+            add_summary(index, metadata, shard_key, i)
+    index.save_manifest(manifest)
+
+    assert not index.summaries_complete()
+    # p4 has no summary; a shortlist of the summarised papers would miss it.
+    hits = index.search_two_stage(vector(4, random.Random(1)), 3, shortlist_size=2)
+    assert [hit["metadata"]["source_file"] for hit in hits] == ["p4.pdf"] * 3
+
+
+def test_drop_shard_removes_the_summaries_of_its_documents(index):
+    manifest = {}
+    for i in range(6):
+        metadata, shard_key = paper(i), index.shard_for(paper(i))
+        add_summary(index, metadata, shard_key, i)
+        manifest[metadata["source_file"]] = shard_key
+    index.save_manifest(manifest)
+    dropped = manifest["p0.pdf"]
+    index.record_missing_summary("p0.pdf")
+
+    index.drop_shard(dropped)
+    remaining = set(index.documents_collection().get()["ids"])
+    assert remaining == {name for name, key in manifest.items() if key != dropped}
+    assert index.load_documents_without_summary() == set()
@@ -0,0 +1,110 @@
+import numpy as np
+import text_store
+from langchain_core.documents import Document
+from text_store import TextStore
+
+CORE = {"source_file": "paper.pdf", "title": "Paper", "doi": "10.1/1", "year": 2024}
+
+
+def pages(count=3):
+    for page in range(count):
+        yield Document(
+            page_content=f"text of page {page}",
+            metadata={**CORE, "page": page, "total_pages": 3},
+        )
+
+
+def test_recorded_pages_round_trip(tmp_path):
+    store = TextStore(tmp_path)
+    writer = store.writer()
+    streamed = list(writer.recording(pages(), "hash"))
+    signature = np.arange(4, dtype=np.uint64)
+    writer.commit("hash", CORE, signature)
+    writer.close()
+
+    reopened = TextStore(tmp_path)
+    assert "hash" in reopened and len(reopened) == 1
+    core = reopened.core_metadata("hash", "renamed.pdf")
+    assert core == {**CORE, "source_file": "renamed.pdf"}
+    stored = list(reopened.iter_pages("hash", core))
+    assert [page.page_content for page in stored] == [
+        page.page_content for page in streamed
+    ]
+    assert stored[1].metadata == {**core, "page": 1, "total_pages": 3}
+    assert (reopened.minhash_signature("hash") == signature).all()
+
+
+def test_discarded_pages_are_not_stored(tmp_path):
+    store = TextStore(tmp_path)
+    writer = store.writer()
+    list(writer.recording(pages(), "hash"))
+    writer.discard()
+    writer.commit("hash", CORE, None)
+    writer.close()
+    assert "hash" not in TextStore(tmp_path)
+
+
+def stored_segments(directory):
+    return sorted(p.name for p in (directory / "pages").glob("part-*.parquet"))
+
+
+def test_long_document_is_flushed_in_row_groups(tmp_path, monkeypatch):
+    monkeypatch.setattr(text_store, "FLUSH_ROWS", 4)
+    store = TextStore(tmp_path)
+    writer = store.writer()
+    for page in writer.recording(pages(10), "hash"):
+        # Never more than FLUSH_ROWS pages are held in memory.
+        assert len(writer._buffer) < 4
+    writer.commit("hash", CORE, None)
+    writer.close(compact=False)
+
+    reopened = TextStore(tmp_path)
+    assert reopened.documents["hash"]["row_group_count"] == 3
+    assert reopened.documents["hash"]["page_count"] == 10
+    stored = list(reopened.iter_pages("hash", CORE))
+    assert [page.metadata["page"] for page in stored] == list(range(10))
+
+
+def test_discarded_rows_are_skipped_by_scans(tmp_path, monkeypatch):
+    monkeypatch.setattr(text_store, "FLUSH_ROWS", 2)
+    store = TextStore(tmp_path)
+    writer = store.writer()
+    list(writer.recording(pages(5), "failed"))
+    writer.discard()
+    list(writer.recording(pages(3), "hash"))
+    writer.commit("hash", CORE, None)
+    writer.close(compact=False)
+
+    hashes = {
+        value
+        for batch in TextStore(tmp_path).scan_pages()
+        for value in batch.column("content_hash").to_pylist()
+    }
+    assert hashes == {"hash"}
+
+
+def test_small_segments_are_compacted(tmp_path, monkeypatch):
+    monkeypatch.setattr(text_store, "COMPACT_MIN_SEGMENTS", 3)
+    store = TextStore(tmp_path)
+    for i in range(3):
+        writer = store.writer()
+        list(writer.recording(pages(), f"hash{i}"))
+        writer.commit(f"hash{i}", {**CORE, "source_file": f"p{i}.pdf"}, None)
+        if i < 2:
+            writer.close()
+            assert len(stored_segments(tmp_path)) == i + 1
+        else:
+            # The third small segment triggers a merge into one.
+            stale = TextStore(tmp_path)
+            writer.close()
+    assert len(stored_segments(tmp_path)) == 1
+
+    reopened = TextStore(tmp_path)
+    assert len(reopened) == 3
+    for i in range(3):
+        stored = list(reopened.iter_pages(f"hash{i}", CORE))
+        assert [page.page_content for page in stored] == [
+            f"text of page {page}" for page in range(3)
+        ]
+    # A store opened before the merge finds the pages in the new segment.
+    assert len(list(stale.iter_pages("hash0", CORE))) == 3
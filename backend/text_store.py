@@ -0,0 +1,469 @@
+"""
+Columnar store of extracted PDF text.
+
+Ingestion writes the page text and metadata of every parsed PDF once, keyed
+by the SHA-256 of the file's content, so re-chunking or re-embedding the
+corpus (and offline experiments such as the chunking benchmark) read text
+from here instead of parsing PDFs again.
+
+Layout under TEXT_STORE_DIRECTORY:
+
+    pages/part-*.parquet      one row per page, a run of row groups per document
+    documents/part-*.parquet  one row per document: hash, core metadata,
+                              MinHash signature and where its pages are
+
+Files are zstd-compressed Parquet, written once and never modified, and are
+read with memory mapping. Every ingestion run writes a segment of its own;
+small segments are merged into one once there are COMPACT_MIN_SEGMENTS of
+them. Requires pyarrow.
+
+    python text_store.py backfill   # store text of PDFs ingested earlier
+    python text_store.py compact    # merge small segments now
+    python text_store.py stats
+"""
+
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+from langchain_core.documents import Document
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pc = pq = None
+
+TEXT_STORE_DIRECTORY = Path(os.getenv("TEXT_STORE_DIRECTORY", "text_store"))
+TEXT_STORE_ENABLED = os.getenv("TEXT_STORE_ENABLED", "true").lower() == "true"
+COMPRESSION = "zstd"
+COMPRESSION_LEVEL = int(os.getenv("TEXT_STORE_ZSTD_LEVEL", "6"))
+HASH_READ_BYTES = 1 << 20
+# Pages of the document being recorded are written out as a row group once
+# this many pages or bytes of text are buffered.
+FLUSH_ROWS = int(os.getenv("TEXT_STORE_FLUSH_ROWS", "256"))
+FLUSH_BYTES = int(float(os.getenv("TEXT_STORE_FLUSH_MB", "16")) * (1 << 20))
+# Segments whose pages file is smaller than this are merged when a writer is
+# closed and at least COMPACT_MIN_SEGMENTS of them exist. 0 disables it.
+COMPACT_SEGMENT_BYTES = int(float(os.getenv("TEXT_STORE_COMPACT_MB", "8")) * (1 << 20))
+COMPACT_MIN_SEGMENTS = int(os.getenv("TEXT_STORE_COMPACT_MIN_SEGMENTS", "8"))
+
+# Core metadata lives in the documents table; every other page metadata field
+# (page, page_label, total_pages, ...) is kept as JSON next to the page text.
+CORE_FIELDS = ("source_file", "title", "doi", "year")
+
+_segment_counter = itertools.count()
+
+
+def available() -> bool:
+    return TEXT_STORE_ENABLED and pa is not None
+
+
+def content_hash(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while block := f.read(HASH_READ_BYTES):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _segment_name() -> str:
+    return (
+        f"part-{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}-"
+        f"{next(_segment_counter)}.parquet"
+    )
+
+
+def _pages_schema():
+    return pa.schema(
+        [
+            ("content_hash", pa.string()),
+            ("page", pa.int32()),
+            ("text", pa.large_string()),
+            ("metadata", pa.string()),
+        ]
+    )
+
+
+def _documents_schema():
+    return pa.schema(
+        [
+            ("content_hash", pa.string()),
+            ("source_file", pa.string()),
+            ("title", pa.string()),
+            ("doi", pa.string()),
+            ("year", pa.int32()),
+            ("page_count", pa.int32()),
+            ("minhash", pa.binary()),
+            ("segment", pa.string()),
+            # First row group of the document and how many it spans.
+            ("row_group", pa.int32()),
+            ("row_group_count", pa.int32()),
+        ]
+    )
+
+
+def _write_atomically(table, path: Path):
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    pq.write_table(
+        table,
+        tmp_path,
+        compression=COMPRESSION,
+        compression_level=COMPRESSION_LEVEL,
+    )
+    os.replace(tmp_path, path)
+
+
+class TextStore:
+    def __init__(self, directory: Path = TEXT_STORE_DIRECTORY):
+        if pa is None:
+            raise ImportError("The text store requires pyarrow.")
+        self.directory = directory
+        self.pages_directory = directory / "pages"
+        self.documents_directory = directory / "documents"
+        self.documents = {}
+        self.reload()
+
+    def reload(self):
+        """Reads the documents table, which is small: one row per PDF."""
+        self.documents = {}
+        if not self.documents_directory.exists():
+            return
+        for path in sorted(self.documents_directory.glob("part-*.parquet")):
+            table = pq.read_table(path, memory_map=True)
+            for row in table.to_pylist():
+                # Segments written before documents could span row groups.
+                row.setdefault("row_group_count", 1)
+                self.documents[row["content_hash"]] = row
+
+    def __contains__(self, content_hash: str) -> bool:
+        return content_hash in self.documents
+
+    def __len__(self):
+        return len(self.documents)
+
+    def core_metadata(self, content_hash: str, source_file: str) -> dict:
+        """
+        Core metadata as extract_metadata_from_pdf returns it. source_file is
+        the current name, since identical content may be stored under another.
+        """
+        row = self.documents[content_hash]
+        metadata = {
+            "source_file": source_file,
+            "title": row["title"],
+            "doi": row["doi"],
+        }
+        if row["year"] is not None:
+            metadata["year"] = row["year"]
+        return metadata
+
+    def minhash_signature(self, content_hash: str):
+        minhash = self.documents[content_hash]["minhash"]
+        if minhash is None:
+            return None
+        return np.frombuffer(minhash, dtype=np.uint64).copy()
+
+    def _page_table(self, row):
+        path = self.pages_directory / row["segment"]
+        if not path.exists():
+            # Merged into another segment by a compaction in another process.
+            self.reload()
+            row = self.documents[row["content_hash"]]
+            path = self.pages_directory / row["segment"]
+        parquet_file = pq.ParquetFile(path, memory_map=True)
+        first = row["row_group"]
+        return parquet_file.read_row_groups(
+            range(first, first + row["row_group_count"])
+        )
+
+    def iter_pages(self, content_hash: str, core_metadata: dict):
+        """Page Documents as ingestion.iter_pages yields them, without the PDF."""
+        table = self._page_table(self.documents[content_hash])
+        core = {k: core_metadata[k] for k in CORE_FIELDS if k in core_metadata}
+        for text, metadata in zip(
+            table.column("text").to_pylist(), table.column("metadata").to_pylist()
+        ):
+            yield Document(page_content=text, metadata={**json.loads(metadata), **core})
+
+    def scan_pages(self, columns=("content_hash", "page", "text"), batch_size=4096):
+        """
+        Streams record batches over every stored page, one memory-mapped
+        segment at a time, reading only the requested columns. Pages of
+        documents that were never committed are skipped.
+        """
+        stored = pa.array(list(self.documents), type=pa.string())
+        read_columns = list(dict.fromkeys(["content_hash", *columns]))
+        segments = sorted({row["segment"] for row in self.documents.values()})
+        for segment in segments:
+            parquet_file = pq.ParquetFile(
+                self.pages_directory / segment, memory_map=True
+            )
+            for batch in parquet_file.iter_batches(
+                batch_size=batch_size, columns=read_columns
+            ):
+                batch = batch.filter(
+                    pc.is_in(batch.column("content_hash"), value_set=stored)
+                )
+                yield batch.select(list(columns))
+
+    def writer(self):
+        return TextStoreWriter(self)
+
+    def compact(
+        self,
+        max_segment_bytes: int | None = None,
+        min_segments: int | None = None,
+    ) -> int:
+        """
+        Copies the documents of segments smaller than max_segment_bytes into
+        one new segment and deletes the old ones, if there are at least
+        min_segments of them. Returns the number of segments merged.
+        """
+        if max_segment_bytes is None:
+            max_segment_bytes = COMPACT_SEGMENT_BYTES
+        if min_segments is None:
+            min_segments = COMPACT_MIN_SEGMENTS
+        rows_by_segment = {}
+        for row in self.documents.values():
+            rows_by_segment.setdefault(row["segment"], []).append(row)
+        small = []
+        for segment in sorted(rows_by_segment):
+            try:
+                size = (self.pages_directory / segment).stat().st_size
+            except FileNotFoundError:
+                continue
+            if size < max_segment_bytes:
+                small.append(segment)
+        if len(small) < max(2, min_segments):
+            return 0
+
+        writer = TextStoreWriter(self)
+        for segment in small:
+            for row in sorted(rows_by_segment[segment], key=lambda r: r["row_group"]):
+                writer.copy(row, self._page_table(row))
+        writer.close(compact=False)
+        # The new documents segment is in place, so the old rows are no longer
+        # read; pages go last, once nothing refers to them.
+        for directory in (self.documents_directory, self.pages_directory):
+            for segment in small:
+                (directory / segment).unlink(missing_ok=True)
+        print(f"Merged {len(small)} text store segments into {writer.segment}.")
+        return len(small)
+
+
+class TextStoreWriter:
+    """
+    Collects the pages of documents as they are parsed and writes them to a
+    new pages segment, as a run of row groups per document of at most
+    FLUSH_ROWS pages or FLUSH_BYTES of text each, so that a long document is
+    never held in memory whole. The documents segment is written last when
+    the writer is closed, so documents from an interrupted run are simply
+    absent. Row groups of a document that is discarded after a flush stay in
+    the segment unreferenced until it is compacted.
+    """
+
+    def __init__(self, store: TextStore):
+        self.store = store
+        self.segment = _segment_name()
+        self._pages_writer = None
+        self._tmp_pages_path = None
+        self._row_groups = 0
+        self._document_rows = []
+        self._hashes = set()
+        self._content_hash = None
+        self.discard()
+
+    def recording(self, pages, content_hash: str):
+        """
+        Passes page Documents through, keeping only the rows commit() stores:
+        page number, text and the JSON of the non-core metadata.
+        """
+        self.discard()
+        self._content_hash = content_hash
+        for page_doc in pages:
+            metadata = {
+                k: v for k, v in page_doc.metadata.items() if k not in CORE_FIELDS
+            }
+            self._buffer.append(
+                (
+                    metadata.get("page"),
+                    page_doc.page_content,
+                    json.dumps(metadata, default=str),
+                )
+            )
+            self._buffer_bytes += len(page_doc.page_content)
+            if len(self._buffer) >= FLUSH_ROWS or self._buffer_bytes >= FLUSH_BYTES:
+                self._flush_buffer()
+            yield page_doc
+
+    def discard(self):
+        """Forgets the document recorded since the last recording() call."""
+        self._buffer = []
+        self._buffer_bytes = 0
+        self._first_row_group = None
+        self._page_count = 0
+
+    def commit(self, content_hash: str, core_metadata: dict, signature):
+        """Stores the pages recorded since the last recording() call."""
+        if content_hash in self.store or content_hash in self._hashes:
+            self.discard()
+            return
+        self._flush_buffer()
+        if not self._page_count:
+            return
+        self._hashes.add(content_hash)
+        self._add_document_row(
+            content_hash,
+            core_metadata,
+            signature.tobytes() if signature is not None else None,
+            self._page_count,
+            self._first_row_group,
+        )
+        self.discard()
+
+    def copy(self, row: dict, table):
+        """Copies a stored document (its documents row and page table)."""
+        first_row_group = self._row_groups
+        self._write_row_group(table)
+        self._add_document_row(
+            row["content_hash"], row, row["minhash"], row["page_count"], first_row_group
+        )
+
+    def _flush_buffer(self):
+        if not self._buffer:
+            return
+        rows = self._buffer
+        self._buffer = []
+        self._buffer_bytes = 0
+        if self._first_row_group is None:
+            self._first_row_group = self._row_groups
+        self._page_count += len(rows)
+        page_numbers, texts, metadata = zip(*rows)
+        self._write_row_group(
+            pa.table(
+                {
+                    "content_hash": [self._content_hash] * len(rows),
+                    "page": list(page_numbers),
+                    "text": list(texts),
+                    "metadata": list(metadata),
+                },
+                schema=_pages_schema(),
+            )
+        )
+
+    def _write_row_group(self, table):
+        if self._pages_writer is None:
+            self.store.pages_directory.mkdir(parents=True, exist_ok=True)
+            self._tmp_pages_path = self.store.pages_directory / f".{self.segment}.tmp"
+            self._pages_writer = pq.ParquetWriter(
+                self._tmp_pages_path,
+                _pages_schema(),
+                compression=COMPRESSION,
+                compression_level=COMPRESSION_LEVEL,
+            )
+        self._pages_writer.write_table(table, row_group_size=max(1, len(table)))
+        self._row_groups += 1
+
+    def _add_document_row(
+        self, content_hash, core_metadata, minhash, page_count, first_row_group
+    ):
+        self._document_rows.append(
+            {
+                "content_hash": content_hash,
+                "source_file": core_metadata["source_file"],
+                "title": core_metadata.get("title"),
+                "doi": core_metadata.get("doi"),
+                "year": core_metadata.get("year"),
+                "page_count": page_count,
+                "minhash": minhash,
+                "segment": self.segment,
+                "row_group": first_row_group,
+                "row_group_count": self._row_groups - first_row_group,
+            }
+        )
+
+    def close(self, compact: bool = True):
+        if self._pages_writer is None:
+            return
+        self._pages_writer.close()
+        os.replace(self._tmp_pages_path, self.store.pages_directory / self.segment)
+        self.store.documents_directory.mkdir(parents=True, exist_ok=True)
+        _write_atomically(
+            pa.Table.from_pylist(self._document_rows, schema=_documents_schema()),
+            self.store.documents_directory / self.segment,
+        )
+        for row in self._document_rows:
+            self.store.documents[row["content_hash"]] = row
+        print(
+            f"Stored text of {len(self._document_rows)} document(s) in "
+            f"{self.store.directory}."
+        )
+        self._pages_writer = None
+        self._document_rows = []
+        if compact and COMPACT_SEGMENT_BYTES > 0:
+            try:
+                self.store.compact()
+            except Exception as e:
+                # The new segment is already stored; merging can wait.
+                print(f"Error compacting text store segments: {e}")
+
+
+def backfill(pdf_directory: Path, store: TextStore):
+    """Parses and stores PDFs whose content is not in the store yet."""
+    from dedup import compute_minhash_signature
+    from langchain_community.document_loaders import PyPDFLoader
+    from utils import extract_metadata_from_pdf
+
+    writer = store.writer()
+    try:
+        for pdf_file in sorted(pdf_directory.glob("*.pdf")):
+            file_hash = content_hash(pdf_file)
+            if file_hash in store:
+                continue
+            print(f"Storing text of {pdf_file.name}...")
+            try:
+                core_metadata = extract_metadata_from_pdf(pdf_file)
+                pages = PyPDFLoader(str(pdf_file)).lazy_load()
+                for _ in writer.recording(pages, file_hash):
+                    pass
+                writer.commit(
+                    file_hash, core_metadata, compute_minhash_signature(pdf_file)
+                )
+            except Exception as e:
+                writer.discard()
+                print(f"Error storing text of {pdf_file.name}: {e}")
+    finally:
+        writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Columnar store of PDF text.")
+    parser.add_argument("--directory", type=Path, default=TEXT_STORE_DIRECTORY)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    backfill_parser = subparsers.add_parser("backfill")
+    backfill_parser.add_argument("--pdf-dir", type=Path, default=Path("pdf_documents"))
+    subparsers.add_parser("compact")
+    subparsers.add_parser("stats")
+    args = parser.parse_args()
+
+    store = TextStore(args.directory)
+    if args.command == "backfill":
+        backfill(args.pdf_dir, store)
+    elif args.command == "compact":
+        store.compact(min_segments=2)
+    elif args.command == "stats":
+        size = sum(p.stat().st_size for p in args.directory.rglob("*.parquet"))
+        pages = sum(row["page_count"] for row in store.documents.values())
+        print(f"Documents: {len(store)}")
+        print(f"Pages: {pages}")
+        print(f"Size on disk: {size / 1e6:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
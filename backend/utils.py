@@ -6,7 +6,7 @@ import fitz
 
 def extract_metadata_from_pdf(pdf_path: Path) -> dict:
     """
-    Extracts DOI and title from a PDF.
+    Extracts DOI, title and, when available, publication year from a PDF.
     Tries to get DOI and title from PDF metadata first, then from text.
     Does NOT extract full text here, as PyPDFLoader will handle that.
     """
@@ -59,11 +59,31 @@ def extract_metadata_from_pdf(pdf_path: Path) -> dict:
                                     ):
                                         metadata["title"] = potential_title
                                         break
+
+        year = _extract_publication_year(doc, pdf_meta)
+        if year:
+            metadata["year"] = year
     except Exception as e:
         print(f"Error extracting metadata for {pdf_path}: {e}")
     return metadata
 
 
+def _extract_publication_year(doc, pdf_meta) -> int | None:
+    """Publication year from the first page, falling back to the PDF creation date."""
+    if doc.page_count:
+        text = doc.load_page(0).get_text("text")
+        match = re.search(
+            r"Published(?: online)?:?\s+\d{1,2}\s+[A-Za-z]+\s+((?:19|20)\d{2})", text
+        )
+        if match:
+            return int(match.group(1))
+    creation_date = (pdf_meta or {}).get("creationDate") or ""
+    match = re.match(r"^D:((?:19|20)\d{2})", creation_date)
+    if match:
+        return int(match.group(1))
+    return None
+
+
 def construct_nature_url_from_doi(doi: str) -> str:
     if doi and doi != "Unknown DOI" and doi.startswith("10."):
         return f"https://doi.org/{doi}"
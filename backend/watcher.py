@@ -0,0 +1,197 @@
+"""
+Watch-mode ingestion.
+
+Watches PDF_DIRECTORY and ingests each PDF as soon as the downloader has
+finished writing it, so new papers become searchable within seconds of
+download without a full directory scan. File events come from watchfiles
+(inotify on Linux); without it, or with --poll, the directory is polled.
+
+    python watcher.py            # ingest files missed while stopped, then watch
+    python watcher.py --poll     # poll instead, e.g. on network filesystems
+"""
+
+import argparse
+import os
+import threading
+import time
+from pathlib import Path
+
+from pdf_files import ARIA2_CONTROL_SUFFIX, PDF_MAGIC
+
+try:
+    import watchfiles
+except ImportError:
+    watchfiles = None
+
+SETTLE_SECONDS = float(os.getenv("WATCH_SETTLE_SECONDS", "2"))
+POLL_SECONDS = float(os.getenv("WATCH_POLL_SECONDS", "5"))
+# How often pending files are re-checked while waiting for them to settle.
+TICK_SECONDS = 0.5
+
+
+def has_pdf_header(path: Path) -> bool:
+    try:
+        with open(path, "rb") as f:
+            return f.read(len(PDF_MAGIC)) == PDF_MAGIC
+    except OSError:
+        return False
+
+
+class DownloadDebouncer:
+    """
+    Tracks PDFs that changed and reports each one once it looks complete:
+    no aria2c control file next to it, a non-empty file with a PDF header,
+    and size and mtime unchanged for settle_seconds.
+    """
+
+    def __init__(self, settle_seconds: float = SETTLE_SECONDS):
+        self.settle_seconds = settle_seconds
+        # path -> (size, mtime_ns, stable_since), or None until first seen.
+        self._pending = {}
+
+    def touch(self, path: Path):
+        if path.suffix == ARIA2_CONTROL_SUFFIX:
+            # "paper.pdf.aria2" changing or disappearing concerns "paper.pdf".
+            path = path.with_suffix("")
+        if path.suffix.lower() == ".pdf":
+            self._pending.setdefault(path, None)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def ready(self, now: float | None = None):
+        """Removes and returns the pending files that have settled."""
+        now = time.monotonic() if now is None else now
+        ready = []
+        for path, previous in list(self._pending.items()):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                del self._pending[path]
+                continue
+            if stat.st_size == 0 or Path(f"{path}{ARIA2_CONTROL_SUFFIX}").exists():
+                self._pending[path] = None
+                continue
+
+            snapshot = (stat.st_size, stat.st_mtime_ns)
+            if previous is None or previous[:2] != snapshot:
+                self._pending[path] = (*snapshot, now)
+                continue
+            if now - previous[2] < self.settle_seconds:
+                continue
+
+            del self._pending[path]
+            if has_pdf_header(path):
+                ready.append(path)
+            else:
+                print(f"Ignoring {path.name}: not a PDF file.")
+        return ready
+
+
+class PdfWatcher:
+    """
+    Feeds settled PDFs from directory to ingest(pdf_files). On start, files
+    that are not in the processed-files log of the served index (downloaded
+    while the watcher was not running) are queued as well.
+    """
+
+    def __init__(self, directory: Path, ingest, force_polling: bool = False):
+        self.directory = directory
+        self.ingest = ingest
+        self.force_polling = force_polling
+        self.debouncer = DownloadDebouncer()
+
+    def catch_up(self):
+        # Imported here so that the debouncer can be used without credentials.
+        from ingestion import index, load_processed_files_log
+
+        processed = load_processed_files_log(index.current().base_directory)
+        missed = [p for p in self.directory.glob("*.pdf") if p.name not in processed]
+        for path in missed:
+            self.debouncer.touch(path)
+        if missed:
+            print(f"Queued {len(missed)} file(s) not ingested yet.")
+
+    def run(self, stop_event: threading.Event | None = None):
+        stop_event = stop_event or threading.Event()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.catch_up()
+        self._ingest_ready()
+        if watchfiles is not None and not self.force_polling:
+            print(f"Watching {self.directory} for new PDFs...")
+            self._run_watchfiles(stop_event)
+        else:
+            print(f"Polling {self.directory} for new PDFs every {POLL_SECONDS}s...")
+            self._run_polling(stop_event)
+
+    def _run_watchfiles(self, stop_event):
+        for changes in watchfiles.watch(
+            self.directory,
+            watch_filter=None,
+            recursive=False,
+            stop_event=stop_event,
+            rust_timeout=int(TICK_SECONDS * 1000),
+            yield_on_timeout=True,
+        ):
+            for _, path in changes:
+                self.debouncer.touch(Path(path))
+            self._ingest_ready()
+
+    def _snapshot(self):
+        snapshot = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.name.endswith((".pdf", ARIA2_CONTROL_SUFFIX)):
+                    stat = entry.stat()
+                    snapshot[entry.name] = (stat.st_size, stat.st_mtime_ns)
+        return snapshot
+
+    def _run_polling(self, stop_event):
+        # Files present at start were handled by catch_up().
+        known = self._snapshot()
+        while not stop_event.wait(
+            TICK_SECONDS if len(self.debouncer) else POLL_SECONDS
+        ):
+            seen = self._snapshot()
+            changed = {name for name in seen if known.get(name) != seen[name]}
+            # Removed control files mean a download has just finished.
+            changed.update(name for name in known if name not in seen)
+            for name in changed:
+                self.debouncer.touch(self.directory / name)
+            known = seen
+            self._ingest_ready()
+
+    def _ingest_ready(self):
+        ready = self.debouncer.ready()
+        if not ready:
+            return
+        names = ", ".join(p.name for p in ready)
+        print(f"Ingesting {len(ready)} new file(s): {names}")
+        start = time.monotonic()
+        try:
+            self.ingest(ready)
+        except Exception as e:
+            print(f"Error ingesting watched files: {e}")
+            return
+        print(f"Watched files ingested in {time.monotonic() - start:.1f}s.")
+
+
+def main():
+    from ingestion import PDF_DIRECTORY, ingest_pdfs
+
+    parser = argparse.ArgumentParser(description="Ingest PDFs as they are downloaded.")
+    parser.add_argument("--directory", type=Path, default=PDF_DIRECTORY)
+    parser.add_argument(
+        "--poll", action="store_true", help="Poll instead of using file events."
+    )
+    args = parser.parse_args()
+
+    watcher = PdfWatcher(args.directory, ingest_pdfs, force_polling=args.poll)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        print("Stopped watching.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,7 @@
+// Returned by the backend with the first answer and sent with every follow-up,
+// so that the questions asked on this page share one session.
+let sessionId = null;
+
 async function sendQuery() {
     const query = document.getElementById("query").value;
     const responseBox = document.getElementById("response");
@@ -9,11 +13,12 @@ async function sendQuery() {
             headers: {
                 "Content-Type": "application/json"
             },
-            body: JSON.stringify({ query })
+            body: JSON.stringify({ query, session_id: sessionId })
         });
 
         const data = await res.json();
         if (res.ok) {
+            sessionId = data.session_id || sessionId;
             const rawMarkdown = data.answer || "";
             const html = marked.parse(rawMarkdown);  // Render Markdown to HTML
             responseBox.innerHTML = `<strong>Answer:</strong><br>${html}`;